@@ -0,0 +1,282 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import encryption as enc
+import main
+
+
+def _init_worker(usr_data_dir: str, options: dict):
+    """Give a worker process the data directory and embedding options of its parent."""
+    main.UsrDataDir = usr_data_dir
+    main.SaveProfile = options["profile"]
+    main.BitsPerChannel = options["bits_per_channel"]
+    main.ChannelMask = options["channel_mask"]
+
+
+class AsyncStegaPass:
+    """
+    Asyncio counterparts of register_user, login_user, add_password and get_password.
+
+    Key derivation, encryption and steganography run in a process pool, so
+    concurrent requests spread over the cores. Lookups of records in the same
+    image that arrive together share one decode, and adds for one user that
+    arrive while a previous batch is being written are embedded per image and
+    committed to services.json with a single journal write.
+
+    File reads and writes in this process, i.e. vault lookups and commits and
+    the capacity checks of images, run in the loop's default thread pool, so
+    none of them stalls the requests of other connections.
+    """
+
+    def __init__(self, workers: int = None, executor=None):
+        """
+        Creates the API and, unless one is given, its worker pool.
+
+        Args:
+            workers (int): The number of worker processes. Defaults to the
+                number of CPUs.
+            executor (concurrent.futures.Executor): An executor to run CPU-bound
+                work in instead of a new process pool.
+        """
+        self._own_executor = executor is None
+        if executor is None:
+            # Spawned rather than forked: a fork would copy the event loop's
+            # sockets and any thread's locks into the workers
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(main.UsrDataDir, main.embed_options()),
+            )
+        self.executor = executor
+        self._locks = {}
+        self._reads = {}
+        self._adds = {}
+
+    def _lock(self, username: str):
+        """Return the lock serializing changes to a user's files."""
+        return self._locks.setdefault(username, asyncio.Lock())
+
+    async def _run(self, func, *args):
+        """Run CPU-bound work in the executor."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
+
+    async def _run_io(self, func, *args):
+        """Run blocking file work of this process in the loop's thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def register_user(self, username: str, password: str):
+        """Register a new user; returns the key file contents, or None if the user exists."""
+        async with self._lock(username):
+            return await self._run(main.register_user, username, password)
+
+    async def login_user(self, username: str, password: str):
+        """Authenticate a user; returns their encryption key, or None."""
+        # Login may rewrite the key file with new KDF parameters
+        async with self._lock(username):
+            return await self._run(main.login_user, username, password)
+
+    async def get_password(self, username: str, service: str, key: bytes, cache=None):
+        """
+        Retrieve a password for a specific user, using the session cache if given.
+
+        Returns None if the service does not exist or holds a file.
+        """
+        service_data = await self._run_io(_lookup, username, service)
+        if not service_data or "file" in service_data:
+            return None
+        image_path = service_data["image_path"]
+        record = service_data.get("record")
+        if cache is not None:
+            password = cache.get(image_path, record)
+            if password is not None:
+                return password
+
+        # Join the decode of this image that is still gathering requests, if any
+        loop = asyncio.get_running_loop()
+        batch = self._reads.get((image_path, key))
+        if batch is None:
+            batch = self._reads[(image_path, key)] = {}
+            loop.create_task(self._decode_batch(image_path, key, batch))
+        future = batch.get(record)
+        if future is None:
+            future = batch[record] = loop.create_future()
+        password = await future
+        if cache is not None:
+            cache.put(image_path, record, password)
+        return password
+
+    async def search_services(self, username: str, query: str, limit: int = 10):
+        """Return the service names of a user matching an as-you-type query."""
+        return await self._run_io(main.search_services, username, query, limit)
+
+    async def close_vault(self, username: str):
+        """Persist and drop a user's vault."""
+        await self._run_io(main.close_user_vault, username)
+
+    async def _decode_batch(self, image_path: str, key: bytes, batch: dict):
+        """Decode every record requested from an image during one loop iteration."""
+        await asyncio.sleep(0)
+        del self._reads[(image_path, key)]
+        records = list(batch)
+        try:
+            results = await self._run(
+                main.decode_password_results, image_path, records, key
+            )
+        except Exception as e:
+            _fail(list(batch.values()), e)
+            return
+        # Each request gets its own record's outcome, so a corrupt record
+        # does not fail the intact ones decoded with it
+        for record, (password, error) in zip(records, results):
+            future = batch[record]
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(password)
+            else:
+                future.set_exception(error)
+
+    async def add_password(
+        self,
+        username: str,
+        service: str,
+        password: str,
+        key: bytes,
+        img_name: str = None,
+    ):
+        """
+        Add a new password for a specific user, picking an image if none is given.
+
+        Raises:
+            ValueError: If the image cannot take the password.
+        """
+        loop = asyncio.get_running_loop()
+        pending = self._adds.get(username)
+        if pending is None:
+            pending = self._adds[username] = []
+            loop.create_task(self._commit_adds(username))
+        future = loop.create_future()
+        pending.append((service, password, key, img_name or None, future))
+        await future
+
+    async def _commit_adds(self, username: str):
+        """Embed and commit every add queued for a user, one worker task per image."""
+        await asyncio.sleep(0)
+        async with self._lock(username):
+            # Adds that arrived while the previous batch was written join this one
+            batch = self._adds.pop(username)
+            try:
+                # Other processes, e.g. the GUI or a CLI import, write the
+                # user's files under the same lock
+                lock = await self._run_io(main.lock_user, username)
+                try:
+                    await self._embed_adds(username, batch)
+                finally:
+                    lock.close()
+            except Exception as e:
+                _fail([entry[4] for entry in batch], e)
+
+    async def _embed_adds(self, username: str, batch: list):
+        """Embed a batch of adds, grouped by image, and commit the successful ones."""
+        groups = {}
+        for entry in batch:
+            groups.setdefault(entry[3], []).append(entry)
+
+        jobs, failures = await self._run_io(_plan_adds, username, groups)
+        for entries, error in failures:
+            _fail([entry[4] for entry in entries], error)
+
+        results = await asyncio.gather(
+            *(
+                self._run(
+                    main.encode_batch,
+                    username,
+                    img_name,
+                    [entry[1] for entry in entries],
+                    entries[0][2],
+                    main.embed_options(),
+                )
+                for img_name, entries in jobs.items()
+            ),
+            return_exceptions=True,
+        )
+        services = {}
+        done = []
+        for entries, result in zip(jobs.values(), results):
+            if isinstance(result, Exception):
+                _fail([entry[4] for entry in entries], result)
+                continue
+            img_out_path, record_ids = result
+            for entry, record_id in zip(entries, record_ids):
+                services[entry[0]] = {"image_path": img_out_path, "record": record_id}
+                done.append(entry[4])
+
+        await self._run_io(_commit, username, services)
+        for future in done:
+            if not future.done():
+                future.set_result(None)
+
+    def close(self):
+        """Stop the worker pool, if this object created it."""
+        if self._own_executor:
+            self.executor.shutdown()
+
+
+def _lookup(username: str, service: str):
+    """Return the stored data for a user's service, or None."""
+    return main.user_vault(username).get(service)
+
+
+def _commit(username: str, services: dict):
+    """Add services to a user's vault with a single journal write."""
+    main.user_vault(username).set_many(services)
+
+
+def _plan_adds(username: str, groups: dict):
+    """
+    Check which images queued adds, grouped by image name, can go into.
+
+    Adds without an image, under None, share the smallest image with room
+    for all of them, merged with the adds that name it explicitly. Returns
+    the adds per image and a list of (adds, error) pairs for the ones that
+    cannot be embedded.
+    """
+    groups = dict(groups)
+    auto = groups.pop(None, [])
+    jobs = {}
+    failures = []
+    for img_name, entries in sorted(groups.items()):
+        try:
+            main.check_image(username, img_name, _size(entries), len(entries))
+        except ValueError as e:
+            failures.append((entries, e))
+            continue
+        jobs[img_name] = entries
+    if auto:
+        try:
+            img_name = main.choose_image(username, None, _size(auto), len(auto))
+            if img_name in jobs:
+                entries = jobs[img_name] + auto
+                main.check_image(username, img_name, _size(entries), len(entries))
+            jobs[img_name] = jobs.get(img_name, []) + auto
+        except ValueError as e:
+            failures.append((auto, e))
+    return jobs, failures
+
+
+def _size(entries: list) -> int:
+    """Return the encrypted size of the passwords of queued adds."""
+    return sum(
+        len(entry[1].encode("utf8")) + enc.nonce_len + enc.tag_len for entry in entries
+    )
+
+
+def _fail(futures: list, error: Exception):
+    """Fail every future that is still waiting."""
+    for future in futures:
+        if not future.done():
+            future.set_exception(error)
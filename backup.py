@@ -0,0 +1,260 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import time
+
+from instrumentation import span
+
+MANIFEST_NAME = "manifest.json"
+FORMAT_VERSION = 1
+COPY_PIECE = 1024 * 1024
+
+
+def _hash_open_file(f) -> str:
+    """Return the SHA-256 hex digest of an open file from its start, and rewind it."""
+    f.seek(0)
+    digest = hashlib.sha256()
+    for piece in iter(lambda: f.read(COPY_PIECE), b""):
+        digest.update(piece)
+    f.seek(0)
+    return digest.hexdigest()
+
+
+class _HashingReader:
+    """Wraps a file, hashing everything read from it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+
+def read_manifest(archive_path: str) -> dict:
+    """
+    Reads the manifest of a backup archive without reading the rest of it.
+
+    Raises:
+        ValueError: If the file is not a StegaPass backup archive.
+
+    Returns:
+        dict: The manifest.
+    """
+    with tarfile.open(archive_path, "r|") as tar:
+        member = tar.next()
+        if member is None or member.name != MANIFEST_NAME:
+            raise ValueError(f"{archive_path} is not a StegaPass backup.")
+        manifest = json.load(tar.extractfile(member))
+    if manifest.get("version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported backup version {manifest.get('version')}.")
+    return manifest
+
+
+def backup_files(
+    root: str, paths: list, out_path: str, base_path: str = None, info: dict = None
+):
+    """
+    Streams files into a tar archive, led by a manifest of their hashes.
+
+    With a base archive, files whose mtime and size match its manifest are
+    not read at all, and files whose contents did not change are not stored
+    again: their manifest entries point at the archive that holds them.
+    The archive is written to a temporary file and renamed into place.
+
+    Args:
+        root (str): The directory the paths are relative to.
+        paths (list[str]): The relative paths of the files to back up, with
+            "/" separators. Paths that do not exist are skipped.
+        out_path (str): The archive to write.
+        base_path (str): The previous archive of the same files, if any. It
+            and the archives it refers to must stay next to the new one.
+        info (dict): Extra details stored in the manifest under "info".
+
+    Raises:
+        ValueError: If a file changed while it was being backed up.
+
+    Returns:
+        dict: The manifest written.
+    """
+    archive_name = os.path.basename(out_path)
+    base = read_manifest(base_path)["files"] if base_path else {}
+
+    files = {}
+    with span("backup.scan"):
+        for path in paths:
+            full_path = os.path.join(root, path)
+            try:
+                stat = os.stat(full_path)
+            except FileNotFoundError:
+                continue
+            old = base.get(path)
+            if (
+                old is not None
+                and old["mtime_ns"] == stat.st_mtime_ns
+                and old["size"] == stat.st_size
+            ):
+                files[path] = dict(old)
+                continue
+            with open(full_path, "rb") as f:
+                digest = _hash_open_file(f)
+            entry = {
+                "sha256": digest,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "archive": archive_name,
+            }
+            if old is not None and old["sha256"] == digest:
+                entry["archive"] = old["archive"]
+            files[path] = entry
+
+    manifest = {
+        "version": FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "base": os.path.basename(base_path) if base_path else None,
+        "info": info or {},
+        "files": files,
+    }
+    data = json.dumps(manifest, indent=4).encode("utf8")
+    tmp_path = out_path + ".tmp"
+    try:
+        with span("backup.write"), tarfile.open(tmp_path, "w|") as tar:
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+            for path, entry in files.items():
+                if entry["archive"] != archive_name:
+                    continue
+                with open(os.path.join(root, path), "rb") as f:
+                    info = tarfile.TarInfo(path)
+                    info.size = entry["size"]
+                    info.mtime = entry["mtime_ns"] // 1_000_000_000
+                    reader = _HashingReader(f)
+                    tar.addfile(info, reader)
+                    if reader.digest.hexdigest() != entry["sha256"]:
+                        raise ValueError(f"{path} changed during the backup.")
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return manifest
+
+
+def _safe_path(path: str) -> bool:
+    """Check that an archive path stays inside the directory it is restored to."""
+    parts = path.split("/")
+    return (
+        bool(path) and not os.path.isabs(path) and ".." not in parts and "" not in parts
+    )
+
+
+def _extract(archive_path: str, wanted: dict, stage_dir: str):
+    """
+    Streams the wanted members of an archive into a staging directory.
+
+    Every member is hashed as it is written and checked against its manifest
+    entry before it is kept.
+
+    Raises:
+        ValueError: If a member is corrupt or missing.
+    """
+    remaining = dict(wanted)
+    with tarfile.open(archive_path, "r|") as tar:
+        for member in tar:
+            entry = remaining.pop(member.name, None)
+            if entry is None or not member.isfile():
+                continue
+            out_path = os.path.join(stage_dir, *member.name.split("/"))
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            digest = hashlib.sha256()
+            size = 0
+            src = tar.extractfile(member)
+            with open(out_path, "wb") as dst:
+                for piece in iter(lambda: src.read(COPY_PIECE), b""):
+                    digest.update(piece)
+                    size += len(piece)
+                    dst.write(piece)
+            if digest.hexdigest() != entry["sha256"] or size != entry["size"]:
+                raise ValueError(f"{member.name} in {archive_path} is corrupt.")
+            os.utime(out_path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+    if remaining:
+        missing = ", ".join(sorted(remaining))
+        raise ValueError(f"{archive_path} is missing {missing}.")
+
+
+def restore_files(
+    archive_path: str, dst_dir: str, replace: bool = False, keep: tuple = ()
+):
+    """
+    Restores a backup archive, and the earlier archives it builds on, to a directory.
+
+    Files are verified against the manifest as they stream into a staging
+    directory, which only replaces dst_dir once everything checked out.
+
+    Args:
+        archive_path (str): The newest archive of the backup.
+        dst_dir (str): The directory to restore to.
+        replace (bool): Whether to replace dst_dir if it exists.
+        keep (tuple[str]): Paths relative to dst_dir that the backup does not
+            cover, moved over from the directory being replaced.
+
+    Raises:
+        FileExistsError: If dst_dir exists and replace is not set.
+        FileNotFoundError: If an archive the backup builds on is missing.
+        ValueError: If an archive is corrupt.
+
+    Returns:
+        dict: The manifest of the restored backup.
+    """
+    if os.path.exists(dst_dir) and not replace:
+        raise FileExistsError(f"{dst_dir} already exists.")
+    manifest = read_manifest(archive_path)
+    by_archive = {}
+    for path, entry in manifest["files"].items():
+        if not _safe_path(path):
+            raise ValueError(f"Refusing to restore {path!r} outside {dst_dir}.")
+        by_archive.setdefault(entry["archive"], {})[path] = entry
+
+    archive_dir = os.path.dirname(os.path.abspath(archive_path))
+    parent, name = os.path.split(os.path.abspath(dst_dir))
+    stage_dir = os.path.join(parent, f".{name}.restore")
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    os.makedirs(stage_dir)
+    try:
+        with span("backup.restore"):
+            for archive_name, wanted in sorted(by_archive.items()):
+                if archive_name == os.path.basename(archive_path):
+                    path = archive_path
+                else:
+                    path = os.path.join(archive_dir, archive_name)
+                if not os.path.exists(path):
+                    raise FileNotFoundError(
+                        f"The backup needs {archive_name}, next to it."
+                    )
+                _extract(path, wanted, stage_dir)
+
+        if os.path.exists(dst_dir):
+            for path in keep:
+                if os.path.exists(os.path.join(dst_dir, path)):
+                    os.makedirs(
+                        os.path.dirname(os.path.join(stage_dir, path)), exist_ok=True
+                    )
+                    os.replace(
+                        os.path.join(dst_dir, path), os.path.join(stage_dir, path)
+                    )
+            old_dir = os.path.join(parent, f".{name}.old")
+            shutil.rmtree(old_dir, ignore_errors=True)
+            os.replace(dst_dir, old_dir)
+            os.replace(stage_dir, dst_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.replace(stage_dir, dst_dir)
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    return manifest
@@ -0,0 +1,586 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import encryption as enc
+import main
+import steganography as steg
+from server import VaultServer
+
+Resolutions = (0.3, 2, 12, 50)
+Modes = ("RGB", "RGBA", "L")
+PayloadSizes = (64, 4096, 65536)
+Seed = 1234
+# Modules that must not be imported before their first use by each entry
+# point; customtkinter needs PIL.Image to draw, so the GUI may load it
+StartupForbidden = {
+    "main": ("numpy", "PIL.Image", "Cryptodome"),
+    "gui": ("numpy", "Cryptodome"),
+}
+
+
+def synthetic_image(megapixels: float, mode: str, seed: int = Seed):
+    """
+    Generates a reproducible, photo-like test image.
+
+    A smooth gradient with low-amplitude noise compresses roughly like a
+    photograph, unlike pure noise or flat colour.
+
+    Args:
+        megapixels (float): The approximate size of the image.
+        mode (str): The Pillow mode, "RGB", "RGBA" or "L".
+        seed (int): The random seed.
+
+    Returns:
+        PIL.Image.Image: The generated image.
+    """
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    rng = np.random.default_rng(seed)
+
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None, None]
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    phase = np.arange(bands, dtype=np.float32)[None, None, :] * 40
+    pixels = (x + y) / 2 + phase
+    pixels += rng.normal(0, 6, (height, width, bands)).astype(np.float32)
+    pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+    if bands == 1:
+        pixels = pixels[:, :, 0]
+    return Image.fromarray(pixels, mode)
+
+
+def measure(func, repeat: int):
+    """
+    Times a function several times.
+
+    Args:
+        func (callable): The function to time, called without arguments.
+        repeat (int): The number of timed runs.
+
+    Returns:
+        dict: The min, median and mean run time in seconds and the run count.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "runs": repeat,
+    }
+
+
+def bench_stego(
+    workdir: str,
+    megapixels: float,
+    mode: str,
+    payloads,
+    profiles,
+    bits_per_channel,
+    repeat: int,
+):
+    """Time saving with each output profile, encode and decode for one carrier image."""
+    results = []
+    params = {"megapixels": megapixels, "mode": mode}
+    carrier = os.path.join(workdir, f"carrier_{megapixels}_{mode}.png")
+    out_path = os.path.join(workdir, "encoded.png")
+    image = synthetic_image(megapixels, mode)
+    image.save(carrier)
+    capacity = image.width * image.height * len(image.getbands()) // 8
+
+    pixels = np.asarray(image)
+    for profile in profiles:
+        save_path = os.path.join(workdir, "saved" + steg.profile_extension(profile))
+        try:
+            seconds = measure(
+                lambda: steg.save_pixels(pixels, save_path, profile), repeat
+            )
+        except ValueError:
+            # The format cannot hold this mode losslessly
+            continue
+        results.append(
+            {
+                "name": "save",
+                "params": dict(params, profile=profile),
+                "seconds": seconds,
+                "bytes": os.path.getsize(save_path),
+            }
+        )
+    for size in payloads:
+        if size + 4 > capacity:
+            continue
+        data = os.urandom(size)
+        case = dict(params, payload=size)
+        results.append(
+            {
+                "name": "encode",
+                "params": case,
+                "seconds": measure(
+                    lambda: steg.encode_img(carrier, data, out_path), repeat
+                ),
+            }
+        )
+        results.append(
+            {
+                "name": "decode",
+                "params": case,
+                "seconds": measure(lambda: steg.decode_img(out_path), repeat),
+            }
+        )
+        for bits in bits_per_channel:
+            if size > steg.container_capacity(image.size, mode, 1, bits):
+                continue
+            record_case = dict(case, bits_per_channel=bits)
+            results.append(
+                {
+                    "name": "encode_records",
+                    "params": record_case,
+                    "seconds": measure(
+                        lambda: steg.encode_records(
+                            carrier, [data], out_path, 1, bits_per_channel=bits
+                        ),
+                        repeat,
+                    ),
+                }
+            )
+            results.append(
+                {
+                    "name": "decode_record",
+                    "params": record_case,
+                    "seconds": measure(lambda: steg.decode_record(out_path, 0), repeat),
+                }
+            )
+    return results
+
+
+def bench_kdf(configured: dict, repeat: int):
+    """Time key derivation with the default and the configured KDF parameters."""
+    results = []
+    cases = {enc.format_kdf_params(p): p for p in (enc.DEFAULT_KDF, configured)}
+    for params in cases.values():
+        results.append(
+            {
+                "name": "kdf",
+                "params": {"kdf": enc.format_kdf_params(params)},
+                "seconds": measure(lambda: enc.time_kdf(params), repeat),
+            }
+        )
+    return results
+
+
+def bench_round_trip(workdir: str, megapixels: float, mode: str, repeat: int):
+    """Time add_password and get_password against a throwaway user."""
+    username = "bench"
+    user_dir = os.path.join(main.UsrDataDir, username)
+    shutil.rmtree(user_dir, ignore_errors=True)
+    main.register_user(username, "bench-password")
+    key = main.login_user(username, "bench-password")
+
+    # A fresh carrier for every run, so each add creates a new container
+    img_names = iter(range(repeat))
+    for i in range(repeat):
+        shutil.copy(
+            os.path.join(workdir, f"carrier_{megapixels}_{mode}.png"),
+            os.path.join(user_dir, main.InputDir, f"{i}.png"),
+        )
+    params = {"megapixels": megapixels, "mode": mode}
+
+    def add():
+        img_name = str(next(img_names))
+        main.add_password(username, "service", "correct horse battery", key, img_name)
+
+    results = [
+        {"name": "add_password", "params": params, "seconds": measure(add, repeat)},
+        {
+            "name": "get_password",
+            "params": params,
+            "seconds": measure(
+                lambda: main.get_password(username, "service", key), repeat
+            ),
+        },
+    ]
+    main.close_user_vault(username)
+    shutil.rmtree(user_dir, ignore_errors=True)
+    return results
+
+
+def environment():
+    """Describe the machine and code version the results were taken on."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pillow": Image.__version__,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def run(args):
+    """Run the suite and write the results as JSON."""
+    configured = main.load_kdf_params()
+    workdir = tempfile.mkdtemp(prefix="stegapass-bench-")
+    main.UsrDataDir = os.path.join(workdir, "user_data")
+    results = []
+    try:
+        results += bench_kdf(configured, args.repeat)
+        for megapixels in args.resolutions:
+            for mode in args.modes:
+                print(f"Benchmarking {megapixels} MP {mode}...")
+                results += bench_stego(
+                    workdir,
+                    megapixels,
+                    mode,
+                    args.payloads,
+                    args.profiles,
+                    args.bits_per_channel,
+                    args.repeat,
+                )
+                results += bench_round_trip(workdir, megapixels, mode, args.repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    write_report(results, args.output)
+
+
+def write_report(results: list, output: str):
+    """Write results as JSON next to the environment and print a summary."""
+    report = {"environment": environment(), "results": results}
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+    for result in results:
+        size = f"{result['bytes'] / 1024:10.0f} KiB" if "bytes" in result else ""
+        latency = result.get("latency_ms")
+        if latency:
+            size = (
+                f" p95 {latency['p95']:8.2f} ms p99 {latency['p99']:8.2f} ms"
+                f" {result['throughput']:8.1f} ops/s"
+            )
+        print(
+            f"{case_name(result):60} {result['seconds']['median'] * 1000:10.2f} ms"
+            + size
+        )
+    print(f"Results written to {output}")
+
+
+def latency_result(name: str, params: dict, latencies: list, elapsed: float):
+    """Summarize the latencies of a load phase, with throughput over its wall time."""
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "name": name,
+        "params": params,
+        "seconds": {
+            "min": min(latencies),
+            "median": statistics.median(latencies),
+            "mean": statistics.fmean(latencies),
+            "runs": len(latencies),
+        },
+        "latency_ms": {
+            "p50": cuts[49] * 1000,
+            "p95": cuts[94] * 1000,
+            "p99": cuts[98] * 1000,
+            "max": max(latencies) * 1000,
+        },
+        "throughput": len(latencies) / elapsed,
+    }
+
+
+async def _call(reader, writer, op: str, **params):
+    """Send one request to the server and return the reply, timing it."""
+    start = time.perf_counter()
+    writer.write(json.dumps({"op": op, **params}).encode("utf8") + b"\n")
+    await writer.drain()
+    reply = json.loads(await reader.readline())
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    return reply, time.perf_counter() - start
+
+
+async def _load_phase(connections, requests):
+    """
+    Run one phase of the load test.
+
+    Every connection sends its requests one after another, and connections
+    run concurrently. requests(i) yields the (op, params) of connection i.
+    Returns the latency of each request and the wall time of the phase.
+    """
+    latencies = []
+
+    async def client(i, reader, writer):
+        for op, params in requests(i):
+            _, elapsed = await _call(reader, writer, op, **params)
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(client(i, reader, writer) for i, (reader, writer) in enumerate(connections))
+    )
+    return latencies, time.perf_counter() - start
+
+
+async def load_test(workdir: str, args):
+    """Register users, then measure login, add and get under concurrent clients."""
+    users = [f"user{i}" for i in range(args.users)]
+    params = {"clients": args.clients, "users": args.users, "workers": args.workers}
+    adds_per_user = -(-args.clients * args.requests // args.users)
+    carrier = synthetic_image(0.3, "RGB")
+
+    server = VaultServer(args.workers)
+    socket_path = os.path.join(workdir, "bench.sock")
+    listener = await server.start(socket_path)
+    connections = [
+        await asyncio.open_unix_connection(socket_path) for _ in range(args.clients)
+    ]
+    results = []
+    try:
+        reader, writer = connections[0]
+        for username in users:
+            await _call(reader, writer, "register", username=username, password="pw")
+            image_dir = os.path.join(main.UsrDataDir, username, main.InputDir)
+            for i in range(adds_per_user // steg.DEFAULT_SLOTS + 1):
+                carrier.save(os.path.join(image_dir, f"carrier{i}.png"))
+
+        sessions = {}
+
+        def logins(i):
+            username = users[i % len(users)]
+            yield "login", {"username": username, "password": "pw"}
+
+        latencies, elapsed = await _load_phase(connections, logins)
+        results.append(latency_result("server_login", params, latencies, elapsed))
+        for username in users:
+            reply, _ = await _call(
+                reader, writer, "login", username=username, password="pw"
+            )
+            sessions[username] = reply["session"]
+
+        def adds(i):
+            session = sessions[users[i % len(users)]]
+            for n in range(args.requests):
+                yield "add", {
+                    "session": session,
+                    "service": f"service-{i}-{n}",
+                    "password": f"password-{i}-{n}",
+                }
+
+        latencies, elapsed = await _load_phase(connections, adds)
+        results.append(latency_result("server_add", params, latencies, elapsed))
+
+        def gets(i):
+            session = sessions[users[i % len(users)]]
+            for n in range(args.requests):
+                yield "get", {"session": session, "service": f"service-{i}-{n}"}
+
+        latencies, elapsed = await _load_phase(connections, gets)
+        results.append(latency_result("server_get", params, latencies, elapsed))
+    finally:
+        for _, writer in connections:
+            writer.close()
+            await writer.wait_closed()
+        # Let the handlers see the closed connections before the loop stops
+        await asyncio.sleep(0.1)
+        listener.close()
+        await listener.wait_closed()
+        server.close()
+    return results
+
+
+def run_server(args):
+    """Run the server load test and write the results as JSON."""
+    workdir = tempfile.mkdtemp(prefix="stegapass-bench-")
+    main.UsrDataDir = os.path.join(workdir, "user_data")
+    try:
+        results = asyncio.run(load_test(workdir, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    write_report(results, args.output)
+
+
+def import_times(module: str):
+    """
+    Imports a module in a fresh interpreter under -X importtime.
+
+    Returns:
+        dict: The cumulative import time in microseconds of every module loaded.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr}")
+    times = {}
+    for line in proc.stderr.splitlines():
+        parts = line.removeprefix("import time:").split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            times[parts[2].strip()] = int(parts[1])
+    return times
+
+
+def run_startup(args):
+    """
+    Time importing each entry point and check no heavy module loads early.
+
+    Exits with an error if a forbidden module is imported or the median
+    import time is over --max-ms.
+    """
+    results = []
+    failures = []
+    for module in args.modules:
+        import_times(module)  # Compile any stale bytecode outside the timing
+        runs = [import_times(module) for _ in range(args.repeat)]
+        seconds = [times[module] / 1e6 for times in runs]
+        loaded = [
+            forbidden
+            for forbidden in StartupForbidden.get(module, ())
+            if any(
+                name == forbidden or name.startswith(forbidden + ".")
+                for name in runs[0]
+            )
+        ]
+        results.append(
+            {
+                "name": "startup_import",
+                "params": {"module": module},
+                "seconds": {
+                    "min": min(seconds),
+                    "median": statistics.median(seconds),
+                    "mean": statistics.fmean(seconds),
+                    "runs": args.repeat,
+                },
+                "eager_imports": loaded,
+            }
+        )
+        if loaded:
+            failures.append(f"{module} imports {', '.join(loaded)} at startup")
+        median_ms = statistics.median(seconds) * 1000
+        if args.max_ms is not None and median_ms > args.max_ms:
+            failures.append(
+                f"{module} takes {median_ms:.1f} ms to import, over {args.max_ms} ms"
+            )
+
+    write_report(results, args.output)
+    if failures:
+        sys.exit("Startup regression: " + "; ".join(failures))
+
+
+def case_name(result: dict):
+    """Identify a result across runs by its stage and parameters."""
+    params = ",".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+    return f"{result['name']}[{params}]"
+
+
+def compare(args):
+    """Print the median time of every case in two result files side by side."""
+    with open(args.old, "r") as f:
+        old = {case_name(r): r for r in json.load(f)["results"]}
+    with open(args.new, "r") as f:
+        new = {case_name(r): r for r in json.load(f)["results"]}
+
+    print(f"{'case':60} {'old ms':>10} {'new ms':>10} {'ratio':>7}")
+    for name in sorted(old.keys() & new.keys()):
+        before = old[name]["seconds"]["median"]
+        after = new[name]["seconds"]["median"]
+        ratio = after / before if before else float("inf")
+        print(f"{name:60} {before * 1000:10.2f} {after * 1000:10.2f} {ratio:7.2f}")
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="StegaPass benchmark suite")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument(
+        "--resolutions", type=float, nargs="+", default=list(Resolutions)
+    )
+    run_parser.add_argument("--modes", nargs="+", default=list(Modes))
+    run_parser.add_argument(
+        "--payloads", type=int, nargs="+", default=list(PayloadSizes)
+    )
+    run_parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=sorted(steg.SAVE_PROFILES),
+        default=sorted(steg.SAVE_PROFILES),
+        help="Output profiles to time saving with",
+    )
+    run_parser.add_argument(
+        "--bits-per-channel",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Embedding widths to time container encode and decode with",
+    )
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--output", default="bench_results.json")
+    run_parser.set_defaults(func=run)
+
+    server_parser = subparsers.add_parser(
+        "server", help="Measure server throughput and tail latency under load"
+    )
+    server_parser.add_argument(
+        "--clients", type=int, default=16, help="Concurrent client connections"
+    )
+    server_parser.add_argument("--users", type=int, default=4)
+    server_parser.add_argument(
+        "--requests", type=int, default=20, help="Adds and gets per client"
+    )
+    server_parser.add_argument(
+        "--workers", type=int, default=None, help="Server worker processes"
+    )
+    server_parser.add_argument("--output", default="bench_server.json")
+    server_parser.set_defaults(func=run_server)
+
+    startup_parser = subparsers.add_parser(
+        "startup", help="Check the import time of the entry points with -X importtime"
+    )
+    startup_parser.add_argument("--modules", nargs="+", default=list(StartupForbidden))
+    startup_parser.add_argument("--repeat", type=int, default=5)
+    startup_parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="Fail if the median import time of a module is over this budget",
+    )
+    startup_parser.add_argument("--output", default="bench_startup.json")
+    startup_parser.set_defaults(func=run_startup)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.set_defaults(func=compare)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
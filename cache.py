@@ -0,0 +1,85 @@
+import os
+import time
+from collections import OrderedDict
+
+
+class SecretCache:
+    """
+    Bounded LRU cache of decrypted secrets for a logged-in session.
+
+    Entries are keyed by image path and record id together with the image's
+    mtime and size, so a rewritten image is never served from the cache.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 128):
+        """
+        Creates an empty cache.
+
+        Args:
+            ttl (float): Seconds an entry stays valid after it was stored.
+            max_entries (int): The number of entries kept before the least
+                recently used one is evicted.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def _key(self, image_path: str, record):
+        """Build the cache key for an image, or None if the image is missing."""
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        return image_path, record, stat.st_mtime_ns, stat.st_size
+
+    def get(self, image_path: str, record=None):
+        """
+        Returns the cached secret for an image record, if it is still fresh.
+
+        Args:
+            image_path (str): The path to the stego image.
+            record (int): The record id within the image, or None for
+                single-secret images.
+
+        Returns:
+            str: The cached secret, or None on a miss.
+        """
+        key = self._key(image_path, record)
+        entry = self._entries.get(key)
+        if entry is not None:
+            secret, expires = entry
+            if time.monotonic() < expires:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return secret
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, image_path: str, record, secret: str):
+        """
+        Stores a decrypted secret for an image record.
+
+        Args:
+            image_path (str): The path to the stego image.
+            record (int): The record id within the image, or None.
+            secret (str): The decrypted secret.
+        """
+        key = self._key(image_path, record)
+        if key is None:
+            return
+        self._entries[key] = (secret, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def wipe(self):
+        """Drop every cached secret and reset the counters."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,8 +1,15 @@
 import base64
+import lzma
+import struct
+import time
+import zlib
 
-from Cryptodome.Cipher import AES
-from Cryptodome.Protocol.KDF import PBKDF2
-from Cryptodome.Random import get_random_bytes
+from instrumentation import span
+from lazy import lazy_import
+
+AES = lazy_import("Cryptodome.Cipher.AES")
+KDF = lazy_import("Cryptodome.Protocol.KDF")
+Random = lazy_import("Cryptodome.Random")
 
 nonce_len = 16
 tag_len = 16
@@ -10,6 +17,25 @@ KEY_SIZE = 32
 SALT_SIZE = 16
 ITERATIONS = 100_000
 
+# Key files start with a header recording the KDF and its parameters
+KEY_FILE_PREFIX = b"$stegapass$1$"
+KDFS = ("pbkdf2", "scrypt")
+DEFAULT_KDF = {"kdf": "pbkdf2", "iterations": ITERATIONS}
+MAX_SCRYPT_N = 2**20
+
+# Encrypted file streams: a header (magic, version, compression, chunk size and
+# a random stream id), then frames of (length, final flag, ciphertext, nonce,
+# tag). Each chunk authenticates the header, its index and its final flag, so
+# chunks cannot be reordered, dropped, truncated or moved between streams.
+STREAM_MAGIC = b"SPF"
+STREAM_VERSION = 1
+STREAM_HEADER = struct.Struct(">3sBBI16s")
+FRAME_HEADER = struct.Struct(">IB")
+CHUNK_AAD = struct.Struct(">IB")
+CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+COMPRESSIONS = ("none", "zlib", "lzma")
+
 
 def encrypt_pwd(password: str, key: bytes) -> tuple[bytes, bytes, bytes]:
     """
@@ -85,11 +111,305 @@ def separate_data(
     return ciphertext, nonce, tag
 
 
-def gen_key(password: str) -> bytes:
-    """Generate a key from a password."""
-    salt = get_random_bytes(SALT_SIZE)
-    key = PBKDF2(password, salt, dkLen=KEY_SIZE, count=ITERATIONS)
-    return base64.b64encode(salt + key)
+def _seal_chunk(key: bytes, header: bytes, index: int, final: bool, data: bytes):
+    """Encrypt one chunk of a file stream and frame it."""
+    cipher = AES.new(key, AES.MODE_EAX)
+    cipher.update(header + CHUNK_AAD.pack(index, final))
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    frame = FRAME_HEADER.pack(len(ciphertext), final)
+    return frame + add_data(ciphertext, cipher.nonce, tag)
+
+
+def encrypt_stream(src, key: bytes, compression: str = "zlib", chunk_size=CHUNK_SIZE):
+    """
+    Compresses and encrypts a binary file into authenticated chunks.
+
+    The file is read `chunk_size` bytes at a time and each chunk is encrypted
+    as soon as enough compressed data is buffered, so memory use is bounded by
+    a few chunks whatever the size of the file.
+
+    Args:
+        src (BinaryIO): The file to encrypt, opened for binary reading.
+        key (bytes): The AES encryption key.
+        compression (str): "zlib", "lzma" or "none".
+        chunk_size (int): The number of compressed bytes per encrypted chunk.
+
+    Raises:
+        ValueError: If the compression or chunk size is not supported.
+
+    Yields:
+        bytes: The stream header, then one framed chunk at a time.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression!r}.")
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError(f"Chunk size must be between 1 and {MAX_CHUNK_SIZE}.")
+    header = STREAM_HEADER.pack(
+        STREAM_MAGIC,
+        STREAM_VERSION,
+        COMPRESSIONS.index(compression),
+        chunk_size,
+        Random.get_random_bytes(16),
+    )
+    yield header
+
+    if compression == "zlib":
+        compressor = zlib.compressobj()
+    elif compression == "lzma":
+        compressor = lzma.LZMACompressor()
+    else:
+        compressor = None
+
+    buffer = bytearray()
+    index = 0
+    while True:
+        block = src.read(chunk_size)
+        if compressor is None:
+            buffer += block
+        elif block:
+            buffer += compressor.compress(block)
+        else:
+            buffer += compressor.flush()
+        # Only seal chunks that more data follows, so the last one is flagged final
+        while len(buffer) > chunk_size:
+            yield _seal_chunk(key, header, index, False, bytes(buffer[:chunk_size]))
+            del buffer[:chunk_size]
+            index += 1
+        if not block:
+            break
+    yield _seal_chunk(key, header, index, True, bytes(buffer))
+
+
+def _read_exact(pieces, buffer: bytearray, size: int) -> bytes:
+    """Take `size` bytes off the front of buffer, refilling it from pieces."""
+    while len(buffer) < size:
+        piece = next(pieces, None)
+        if piece is None:
+            raise ValueError("File stream is truncated.")
+        buffer += piece
+    data = bytes(buffer[:size])
+    del buffer[:size]
+    return data
+
+
+def _inflate(decompressor, data: bytes, limit: int):
+    """Decompress data in pieces of at most `limit` bytes."""
+    if decompressor is None:
+        yield data
+        return
+    if isinstance(decompressor, lzma.LZMADecompressor):
+        yield decompressor.decompress(data, limit)
+        while not decompressor.needs_input and not decompressor.eof:
+            yield decompressor.decompress(b"", limit)
+        return
+    yield decompressor.decompress(data, limit)
+    while decompressor.unconsumed_tail:
+        yield decompressor.decompress(decompressor.unconsumed_tail, limit)
+
+
+def _open_chunks(pieces, key: bytes):
+    """
+    Parses and authenticates the chunks of a file stream.
+
+    Raises:
+        ValueError: If the stream is corrupt, truncated or was tampered with,
+            or the key is wrong.
+
+    Yields:
+        tuple[bytes, bool]: The stream header first, then the compressed
+            plaintext of each chunk and whether it is the final one.
+    """
+    pieces = iter(pieces)
+    buffer = bytearray()
+    header = _read_exact(pieces, buffer, STREAM_HEADER.size)
+    magic, version, compression, chunk_size, _ = STREAM_HEADER.unpack(header)
+    if magic != STREAM_MAGIC:
+        raise ValueError("Data is not an encrypted file stream.")
+    if version != STREAM_VERSION or compression >= len(COMPRESSIONS):
+        raise ValueError(f"Unsupported file stream version {version}.")
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError("File stream header is corrupt.")
+    yield header, False
+
+    index = 0
+    final = False
+    while not final:
+        length, final = FRAME_HEADER.unpack(
+            _read_exact(pieces, buffer, FRAME_HEADER.size)
+        )
+        if length > chunk_size:
+            raise ValueError(f"Chunk {index} of the file stream is corrupt.")
+        blob = _read_exact(pieces, buffer, length + nonce_len + tag_len)
+        ciphertext, nonce, tag = separate_data(blob, nonce_len, tag_len)
+        cipher = AES.new(key, AES.MODE_EAX, nonce)
+        cipher.update(header + CHUNK_AAD.pack(index, final))
+        yield cipher.decrypt_and_verify(ciphertext, tag), bool(final)
+        index += 1
+
+
+def decrypt_stream(pieces, key: bytes, dst) -> int:
+    """
+    Decrypts and decompresses a file stream written by encrypt_stream.
+
+    The stream may arrive in pieces of any size; only one chunk and its
+    decompressed output are held in memory at a time. Every chunk is
+    authenticated before any of its plaintext is written.
+
+    Args:
+        pieces (Iterable[bytes]): The stream, e.g. from steganography.decode_stream.
+        key (bytes): The AES encryption key.
+        dst (BinaryIO): The file to write the plaintext to.
+
+    Raises:
+        ValueError: If the stream is corrupt, truncated or was tampered with,
+            or the key is wrong.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    chunks = _open_chunks(pieces, key)
+    header, _ = next(chunks)
+    _, _, compression, chunk_size, _ = STREAM_HEADER.unpack(header)
+    compression = COMPRESSIONS[compression]
+    if compression == "zlib":
+        decompressor = zlib.decompressobj()
+    elif compression == "lzma":
+        decompressor = lzma.LZMADecompressor()
+    else:
+        decompressor = None
+
+    written = 0
+    for data, _ in chunks:
+        for plain in _inflate(decompressor, data, chunk_size):
+            dst.write(plain)
+            written += len(plain)
+
+    if decompressor is not None and not decompressor.eof:
+        raise ValueError("File stream is truncated.")
+    return written
+
+
+def reencrypt_stream(pieces, old_key: bytes, new_key: bytes):
+    """
+    Re-encrypts a file stream under a new key without decompressing it.
+
+    The stream keeps its compression and chunk size and gets a new stream id.
+
+    Args:
+        pieces (Iterable[bytes]): The stream encrypted with old_key.
+        old_key (bytes): The AES key the stream is encrypted with.
+        new_key (bytes): The AES key to encrypt it with.
+
+    Raises:
+        ValueError: If the stream is corrupt or old_key is wrong.
+
+    Yields:
+        bytes: The new stream header, then one framed chunk at a time.
+    """
+    chunks = _open_chunks(pieces, old_key)
+    header, _ = next(chunks)
+    *fields, _ = STREAM_HEADER.unpack(header)
+    header = STREAM_HEADER.pack(*fields, Random.get_random_bytes(16))
+    yield header
+    for index, (data, final) in enumerate(chunks):
+        yield _seal_chunk(new_key, header, index, final, data)
+
+
+def format_kdf_params(params: dict) -> str:
+    """
+    Formats KDF parameters as they appear in a key file header.
+
+    Args:
+        params (dict): The KDF name under "kdf" and its integer parameters.
+
+    Returns:
+        str: The parameters as "<kdf>$<name>=<value>,...".
+    """
+    values = ",".join(f"{k}={v}" for k, v in sorted(params.items()) if k != "kdf")
+    return f"{params['kdf']}${values}"
+
+
+def parse_kdf_params(text: str) -> dict:
+    """
+    Parses KDF parameters written by format_kdf_params.
+
+    Args:
+        text (str): The parameters as "<kdf>$<name>=<value>,...".
+
+    Raises:
+        ValueError: If the KDF is unknown or a parameter is malformed.
+
+    Returns:
+        dict: The KDF name under "kdf" and its integer parameters.
+    """
+    kdf, _, values = text.partition("$")
+    if kdf not in KDFS:
+        raise ValueError(f"Unknown KDF {kdf!r}.")
+    params = {"kdf": kdf}
+    for item in filter(None, values.split(",")):
+        name, _, value = item.partition("=")
+        params[name] = int(value)
+    return params
+
+
+def derive_key(password: str, salt: bytes, params: dict) -> bytes:
+    """
+    Derives a key from a password with the KDF described by params.
+
+    Args:
+        password (str): The master password.
+        salt (bytes): The random salt.
+        params (dict): "pbkdf2" with "iterations", or "scrypt" with "n", "r" and "p".
+
+    Raises:
+        ValueError: If the KDF is unknown.
+
+    Returns:
+        bytes: A KEY_SIZE byte key.
+    """
+    with span(f"enc.{params['kdf']}"):
+        if params["kdf"] == "pbkdf2":
+            return KDF.PBKDF2(
+                password, salt, dkLen=KEY_SIZE, count=params["iterations"]
+            )
+        if params["kdf"] == "scrypt":
+            return KDF.scrypt(
+                password, salt, KEY_SIZE, N=params["n"], r=params["r"], p=params["p"]
+            )
+    raise ValueError(f"Unknown KDF {params['kdf']!r}.")
+
+
+def gen_key(password: str, params: dict = None, data_key: bytes = None) -> bytes:
+    """
+    Generate a key file blob protecting a data key with a password.
+
+    The data key is wrapped with AES-EAX under a key derived from the password;
+    the header recording the KDF and its parameters is authenticated with it.
+
+    Args:
+        password (str): The master password.
+        params (dict): The KDF parameters. Defaults to DEFAULT_KDF.
+        data_key (bytes): The AES key to protect. A random one is generated
+            if not given.
+
+    Returns:
+        bytes: The key file contents.
+    """
+    params = params or DEFAULT_KDF
+    data_key = data_key or Random.get_random_bytes(KEY_SIZE)
+    salt = Random.get_random_bytes(SALT_SIZE)
+    header = KEY_FILE_PREFIX + format_kdf_params(params).encode("ascii")
+
+    cipher = AES.new(derive_key(password, salt, params), AES.MODE_EAX)
+    cipher.update(header)
+    wrapped, tag = cipher.encrypt_and_digest(data_key)
+    return b"$".join(
+        [
+            header,
+            base64.b64encode(salt),
+            base64.b64encode(add_data(wrapped, cipher.nonce, tag)),
+        ]
+    )
 
 
 def load_key(path: str) -> bytes:
@@ -98,15 +418,115 @@ def load_key(path: str) -> bytes:
         return f.read()
 
 
+def key_params(stored_key: bytes) -> dict:
+    """
+    Reads the KDF parameters a key file was created with.
+
+    Key files without a header are the original format: base64 of the salt and
+    the PBKDF2 key itself, derived with ITERATIONS iterations.
+
+    Args:
+        stored_key (bytes): The key file contents.
+
+    Returns:
+        dict: The KDF parameters.
+    """
+    if not stored_key.startswith(KEY_FILE_PREFIX):
+        return {"kdf": "pbkdf2", "iterations": ITERATIONS}
+    header = stored_key.rsplit(b"$", 2)[0]
+    return parse_kdf_params(header[len(KEY_FILE_PREFIX) :].decode("ascii"))
+
+
+def unlock_key(password: str, stored_key: bytes):
+    """
+    Recovers the AES data key from a key file with the master password.
+
+    Args:
+        password (str): The master password.
+        stored_key (bytes): The key file contents, in either format.
+
+    Returns:
+        bytes: The data key, or None if the password is wrong.
+    """
+    if not stored_key.startswith(KEY_FILE_PREFIX):
+        decoded_data = base64.b64decode(stored_key)
+        salt, key = decoded_data[:SALT_SIZE], decoded_data[SALT_SIZE:]
+        derived_key = derive_key(password, salt, key_params(stored_key))
+        return key if key == derived_key else None
+
+    header, salt, blob = stored_key.rsplit(b"$", 2)
+    params = parse_kdf_params(header[len(KEY_FILE_PREFIX) :].decode("ascii"))
+    wrapped, nonce, tag = separate_data(base64.b64decode(blob), nonce_len, tag_len)
+    kek = derive_key(password, base64.b64decode(salt), params)
+    cipher = AES.new(kek, AES.MODE_EAX, nonce)
+    cipher.update(header)
+    try:
+        return cipher.decrypt_and_verify(wrapped, tag)
+    except ValueError:
+        return None
+
+
 def verify_key(password: str, stored_key: bytes) -> bool:
-    """Verify if the password-derived key matches the stored key."""
-    decoded_data = base64.b64decode(stored_key)
-    salt, key = decoded_data[:SALT_SIZE], decoded_data[SALT_SIZE:]
-    derived_key = PBKDF2(password, salt, dkLen=KEY_SIZE, count=ITERATIONS)
-    return key == derived_key
+    """Verify if the password unlocks the stored key."""
+    return unlock_key(password, stored_key) is not None
+
+
+def needs_rehash(stored_key: bytes, params: dict) -> bool:
+    """Check whether a key file should be rewritten with the given KDF parameters."""
+    return not stored_key.startswith(KEY_FILE_PREFIX) or key_params(stored_key) != dict(
+        params
+    )
 
 
 def extract_key(stored_key: bytes) -> bytes:
-    """Extract the actual AES key from the stored key."""
+    """
+    Extract the actual AES key from a stored key in the original format.
+
+    Raises:
+        ValueError: If the key file wraps its key; use unlock_key instead.
+    """
+    if stored_key.startswith(KEY_FILE_PREFIX):
+        raise ValueError("Key file is password protected; use unlock_key.")
     decoded_data = base64.b64decode(stored_key)
     return decoded_data[SALT_SIZE:]
+
+
+def time_kdf(params: dict, password: str = "calibration") -> float:
+    """Time a single key derivation with the given parameters, in seconds."""
+    salt = Random.get_random_bytes(SALT_SIZE)
+    start = time.perf_counter()
+    derive_key(password, salt, params)
+    return time.perf_counter() - start
+
+
+def calibrate_kdf(kdf: str = "pbkdf2", target: float = 0.25) -> dict:
+    """
+    Picks KDF parameters that take about `target` seconds on this machine.
+
+    PBKDF2 iterations scale linearly with time and are never set below
+    ITERATIONS. scrypt keeps r=8, p=1 and picks the largest power of two for n
+    whose estimated time stays within 1.5 times the target, up to MAX_SCRYPT_N.
+
+    Args:
+        kdf (str): "pbkdf2" or "scrypt".
+        target (float): The wanted derivation time in seconds.
+
+    Raises:
+        ValueError: If the KDF is unknown.
+
+    Returns:
+        dict: The chosen KDF parameters.
+    """
+    if kdf == "pbkdf2":
+        probe = {"kdf": "pbkdf2", "iterations": 20_000}
+        elapsed = min(time_kdf(probe) for _ in range(3))
+        iterations = int(probe["iterations"] * target / elapsed) // 1000 * 1000
+        return {"kdf": "pbkdf2", "iterations": max(ITERATIONS, iterations)}
+    if kdf == "scrypt":
+        params = {"kdf": "scrypt", "n": 2**14, "r": 8, "p": 1}
+        elapsed = min(time_kdf(params) for _ in range(3))
+        while params["n"] < MAX_SCRYPT_N and elapsed * 2 <= target * 1.5:
+            params["n"] *= 2
+            elapsed *= 2
+        return params
+    raise ValueError(f"Unknown KDF {kdf!r}.")
@@ -1,20 +1,47 @@
-import os
-import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import filedialog
 
 import customtkinter as ctk
 import pyperclip
 
-from main import UsrDataDir, add_password, get_password, login_user, register_user
+import main
+import steganography as steg
+from cache import SecretCache
+from main import (
+    add_password,
+    close_user_vault,
+    get_password,
+    import_image,
+    login_user,
+    register_user,
+    search_services,
+)
 
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("blue")
 
+# Milliseconds between checks for a finished background task
+PollInterval = 50
+# Service names suggested while typing on the Get Password screen
+MaxSuggestions = 6
+
 
 class PasswordManager(ctk.CTk):
-    def __init__(self):
+    def __init__(self, cache_ttl=None):
         super().__init__()
 
+        # Decrypted passwords are only cached when a TTL is given
+        self.cache_ttl = cache_ttl
+        self.secret_cache = None
+
+        # Key derivation and image work run off the Tk main thread, one task
+        # at a time, so a cancelled write never overlaps the next one
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = None
+        # The last cancelled task, which may still be running
+        self.cancelled = None
+
         self.title("Main Menu")
         self.geometry("400x300")
 
@@ -54,10 +81,14 @@ class PasswordManager(ctk.CTk):
             username = username_field.get()
             master_password = password_field.get()
             if username and master_password:
-                register_user(username.strip(), master_password.strip())
-                username_field.delete(0, "end")
-                password_field.delete(0, "end")
-                self.return_to_main_menu()
+                self.run_task(
+                    "Registering...",
+                    register_user,
+                    username.strip(),
+                    master_password.strip(),
+                    on_done=lambda _: self.main_menu(),
+                    on_cancel=self.main_menu,
+                )
 
         ctk.CTkButton(self, text="Register", command=on_register_pressed).pack(pady=5)
         ctk.CTkButton(self, text="Back", command=self.main_menu).pack(pady=5)
@@ -83,16 +114,26 @@ class PasswordManager(ctk.CTk):
             username = username_field.get()
             master_password = password_field.get()
             if username and master_password:
-                key = login_user(username.strip(), master_password.strip())
-                if key:
-                    self.user_sub_menu(username, key)
-                else:
-                    ctk.CTkLabel(self, text="Invalid username or password").pack()
-                    username_field.delete(0, "end")
-                    password_field.delete(0, "end")
+                self.run_task(
+                    "Logging in...",
+                    login_user,
+                    username.strip(),
+                    master_password.strip(),
+                    on_done=lambda key: on_login_done(username, key),
+                    on_cancel=self.login,
+                )
             else:
                 ctk.CTkLabel(self, text="Please enter a username and password").pack()
 
+        def on_login_done(username, key):
+            if key:
+                if self.cache_ttl:
+                    self.secret_cache = SecretCache(self.cache_ttl)
+                self.user_sub_menu(username, key)
+            else:
+                self.login()
+                ctk.CTkLabel(self, text="Invalid username or password").pack()
+
         ctk.CTkButton(self, text="Login", command=on_login_pressed).pack(pady=5)
         ctk.CTkButton(self, text="Back", command=self.main_menu).pack(pady=5)
 
@@ -121,14 +162,9 @@ class PasswordManager(ctk.CTk):
         def browse_and_copy_image(self):
             file_path = filedialog.askopenfilename(filetypes=[("PNG files", "*.png")])
             if file_path:
-                target_dir = os.path.join(
-                    UsrDataDir, username, "ImageStorage", "OriginalImages"
-                )
-                os.makedirs(target_dir, exist_ok=True)
-                shutil.copy(file_path, target_dir)
-                print(f"File copied to {target_dir}")
+                img_name = import_image(username, file_path)
                 self.clear_window()
-                ctk.CTkLabel(self, text="Image copied successfully").pack(pady=10)
+                ctk.CTkLabel(self, text=f"Image added as {img_name}").pack(pady=10)
                 ctk.CTkButton(
                     self, text="OK", command=lambda: self.user_sub_menu(username, key)
                 ).pack(pady=5)
@@ -137,7 +173,37 @@ class PasswordManager(ctk.CTk):
             self, text="Add Image", command=lambda: browse_and_copy_image(self)
         ).pack(pady=5)
 
-        ctk.CTkButton(self, text="Logout", command=self.main_menu).pack(pady=5)
+        ctk.CTkButton(self, text="Logout", command=lambda: self.logout(username)).pack(
+            pady=5
+        )
+
+    def logout(self, username):
+        """
+        Wipes cached passwords, persists the user's services and returns to the main menu.
+
+        Waits for a cancelled task that is still writing the user's services first.
+
+        Parameters:
+        username (str): The username of the logged-in user.
+        """
+        if self.cancelled is not None and not self.cancelled.done():
+            self.clear_window()
+            ctk.CTkLabel(self, text="Finishing the cancelled task...").pack(pady=10)
+
+            def wait():
+                if self.cancelled.done():
+                    self.logout(username)
+                else:
+                    self.after(PollInterval, wait)
+
+            self.after(PollInterval, wait)
+            return
+        self.cancelled = None
+        if self.secret_cache is not None:
+            self.secret_cache.wipe()
+            self.secret_cache = None
+        close_user_vault(username)
+        self.main_menu()
 
     def add_service(self, username, key):
         """
@@ -158,7 +224,9 @@ class PasswordManager(ctk.CTk):
         password_field = ctk.CTkEntry(self, show="*")
         password_field.pack(pady=5)
 
-        ctk.CTkLabel(self, text="Enter image name:", font=("Arial", 20)).pack(pady=10)
+        ctk.CTkLabel(
+            self, text="Enter image name (blank to pick one):", font=("Arial", 20)
+        ).pack(pady=10)
         img_name_field = ctk.CTkEntry(self)
         img_name_field.pack(pady=5)
 
@@ -167,30 +235,41 @@ class PasswordManager(ctk.CTk):
             password = password_field.get().strip()
             img_name = img_name_field.get().strip()
 
-            if service and password and img_name:
-                try:
-                    self.clear_window()
-                    add_password(username, service, password, key, img_name)
-                    ctk.CTkLabel(self, text="Service added successfully").pack(pady=10)
-                    ctk.CTkButton(
-                        self,
-                        text="OK",
-                        command=lambda: self.user_sub_menu(username, key),
-                    ).pack(pady=5)
-                except Exception as e:
-                    print(str(e))
-                    ctk.CTkLabel(
-                        self,
-                        text=f"Image {img_name}.png does not exist in /ImageStorage/OriginalImages/",
-                    ).pack(pady=10)
-                    ctk.CTkButton(
-                        self,
-                        text="OK",
-                        command=lambda: self.user_sub_menu(username, key),
-                    ).pack(pady=5)
+            if service and password:
+                self.run_task(
+                    "Adding service...",
+                    add_password,
+                    username,
+                    service,
+                    password,
+                    key,
+                    img_name,
+                    on_done=lambda _: on_add_done(),
+                    on_cancel=lambda: self.user_sub_menu(username, key),
+                    on_error=on_add_failed,
+                )
             else:
                 ctk.CTkLabel(self, text="Please fill in all fields").pack()
 
+        def on_add_done():
+            self.clear_window()
+            ctk.CTkLabel(self, text="Service added successfully").pack(pady=10)
+            ctk.CTkButton(
+                self,
+                text="OK",
+                command=lambda: self.user_sub_menu(username, key),
+            ).pack(pady=5)
+
+        def on_add_failed(e):
+            print(str(e))
+            self.clear_window()
+            ctk.CTkLabel(self, text=str(e)).pack(pady=10)
+            ctk.CTkButton(
+                self,
+                text="OK",
+                command=lambda: self.user_sub_menu(username, key),
+            ).pack(pady=5)
+
         ctk.CTkButton(self, text="Submit", command=on_submit_pressed).pack(pady=20)
 
     def get_password(self, username, key):
@@ -207,41 +286,155 @@ class PasswordManager(ctk.CTk):
         ctk.CTkLabel(self, text="Enter service name:", font=("Arial", 20)).pack(pady=10)
         service_field = ctk.CTkEntry(self)
         service_field.pack(pady=5)
+        suggestion_frame = ctk.CTkFrame(self, fg_color="transparent")
+        suggestion_frame.pack(pady=5)
+
+        def pick_suggestion(name):
+            service_field.delete(0, "end")
+            service_field.insert(0, name)
+            show_suggestions()
+
+        def show_suggestions(event=None):
+            # Answered from the in-memory index, so this is cheap on every key
+            for widget in suggestion_frame.winfo_children():
+                widget.destroy()
+            query = service_field.get()
+            for name in search_services(username, query, MaxSuggestions):
+                if name == query:
+                    continue
+                ctk.CTkButton(
+                    suggestion_frame,
+                    text=name,
+                    fg_color="transparent",
+                    border_width=1,
+                    command=lambda name=name: pick_suggestion(name),
+                ).pack(pady=2)
+
+        service_field.bind("<KeyRelease>", show_suggestions)
 
         def on_submit_pressed():
             service = service_field.get().strip()
             if service:
-                password = get_password(username, service, key)
-                service_field.delete(0, "end")
-                self.clear_window()
-                if password:
-                    ctk.CTkLabel(
-                        self,
-                        text=f"Password for {service} : {password}",
-                        font=("Arial", 20),
-                    ).pack(pady=10)
-                    ctk.CTkButton(
-                        self, text="Copy", command=lambda: pyperclip.copy(password)
-                    ).pack(pady=5)
-                    ctk.CTkButton(
-                        self,
-                        text="OK",
-                        command=lambda: self.user_sub_menu(username, key),
-                    ).pack(pady=5)
-                else:
-                    ctk.CTkLabel(
-                        self, text="Service not found", font=("Arial", 20)
-                    ).pack(pady=10)
-                    ctk.CTkButton(
-                        self,
-                        text="OK",
-                        command=lambda: self.user_sub_menu(username, key),
-                    ).pack(pady=5)
+                self.run_task(
+                    "Decoding password...",
+                    get_password,
+                    username,
+                    service,
+                    key,
+                    self.secret_cache,
+                    on_done=lambda password: on_password_ready(service, password),
+                    on_cancel=lambda: self.user_sub_menu(username, key),
+                    on_error=lambda e: self.show_error(
+                        e, lambda: self.user_sub_menu(username, key)
+                    ),
+                )
             else:
                 ctk.CTkLabel(self, text="Please enter the service name").pack()
 
+        def on_password_ready(service, password):
+            self.clear_window()
+            if password:
+                ctk.CTkLabel(
+                    self,
+                    text=f"Password for {service} : {password}",
+                    font=("Arial", 20),
+                ).pack(pady=10)
+                ctk.CTkButton(
+                    self, text="Copy", command=lambda: pyperclip.copy(password)
+                ).pack(pady=5)
+                ctk.CTkButton(
+                    self,
+                    text="OK",
+                    command=lambda: self.user_sub_menu(username, key),
+                ).pack(pady=5)
+            else:
+                ctk.CTkLabel(self, text="Service not found", font=("Arial", 20)).pack(
+                    pady=10
+                )
+                ctk.CTkButton(
+                    self,
+                    text="OK",
+                    command=lambda: self.user_sub_menu(username, key),
+                ).pack(pady=5)
+
         ctk.CTkButton(self, text="Submit", command=on_submit_pressed).pack(pady=20)
 
+    def run_task(self, message, func, *args, on_done, on_cancel, on_error=None):
+        """
+        Runs func(*args) on the worker pool while showing a busy screen with a Cancel button.
+
+        The callbacks are always called on the Tk main thread. Cancelling returns
+        to the previous screen at once; a task that has already started still
+        finishes in the background, but its result is ignored. Tasks run one
+        after another, so the next one waits for it, and logging out waits too.
+
+        Parameters:
+        message (str): The text shown while the task runs.
+        func (callable): The blocking function to run.
+        on_done (callable): Called with the result of func.
+        on_cancel (callable): Called when the user presses Cancel.
+        on_error (callable): Called with the exception raised by func. Defaults
+            to showing the error and returning to the main menu.
+        """
+        self.clear_window()
+        ctk.CTkLabel(self, text=message, font=("Arial", 20)).pack(pady=10)
+        progress = ctk.CTkProgressBar(self, mode="indeterminate")
+        progress.pack(pady=10)
+        progress.start()
+
+        future = self.executor.submit(func, *args)
+        self.task = future
+
+        def on_cancel_pressed():
+            if not future.cancel():
+                self.cancelled = future
+            self.task = None
+            on_cancel()
+
+        def poll():
+            # A newer task or a cancel has replaced this one
+            if self.task is not future:
+                return
+            if not future.done():
+                self.after(PollInterval, poll)
+                return
+            self.task = None
+            error = future.exception()
+            if error is None:
+                on_done(future.result())
+            elif on_error is not None:
+                on_error(error)
+            else:
+                self.show_error(error)
+
+        ctk.CTkButton(self, text="Cancel", command=on_cancel_pressed).pack(pady=5)
+        ctk.CTkLabel(
+            self, text="Cancel does not undo an add or registration that has started."
+        ).pack(pady=5)
+        self.after(PollInterval, poll)
+
+    def show_error(self, error, back=None):
+        """
+        Displays an error raised by a background task.
+
+        Parameters:
+        error (Exception): The error to display.
+        back (callable): Shows the screen to return to. Defaults to the main
+            menu, for tasks run before a user is logged in.
+        """
+        print(str(error))
+        self.clear_window()
+        ctk.CTkLabel(self, text=f"Error: {error}").pack(pady=10)
+        ctk.CTkButton(self, text="OK", command=back or self.main_menu).pack(pady=5)
+
+    def destroy(self):
+        """
+        Stops the worker pool without waiting for running tasks and closes the window.
+        """
+        self.task = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        super().destroy()
+
     def clear_window(self):
         """
         Clear all widgets from the current window.
@@ -251,5 +444,23 @@ class PasswordManager(ctk.CTk):
 
 
 if __name__ == "__main__":
-    app = PasswordManager()
+    parser = argparse.ArgumentParser(description="StegaPass password manager")
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help="Cache decrypted passwords for this many seconds during a session",
+    )
+    parser.add_argument(
+        "--save-profile",
+        choices=sorted(steg.SAVE_PROFILES),
+        default=main.SaveProfile,
+        help="Output format for new stego images",
+    )
+    args = parser.parse_args()
+    main.SaveProfile = args.save_profile
+
+    app = PasswordManager(args.cache_ttl)
+    # Idle callbacks run after the pending redraws, so the window shows first
+    app.after_idle(main.warm_up)
     app.mainloop()
@@ -0,0 +1,179 @@
+import functools
+import json
+import math
+import sys
+import time
+
+_sinks = []
+
+
+class _NullSpan:
+    """Span returned while no sink is installed; entering it does nothing."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Times a named stage and reports it to every installed sink."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        for sink in _sinks:
+            sink.record(self.name, elapsed)
+        return False
+
+
+def span(name: str):
+    """
+    Returns a context manager that times a named stage.
+
+    While no sink is installed this returns a shared no-op object, so
+    instrumented code pays for one call and one list check.
+
+    Args:
+        name (str): The stage name, e.g. "add_password.encrypt".
+
+    Returns:
+        A context manager.
+    """
+    if not _sinks:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def timed(name: str):
+    """
+    Decorates a function so that each call is recorded as a span.
+
+    Args:
+        name (str): The stage name.
+
+    Returns:
+        The decorator.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_sink(sink):
+    """Install a sink; it receives every span recorded from now on."""
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    """Uninstall a sink."""
+    _sinks.remove(sink)
+
+
+def enabled() -> bool:
+    """Check whether any sink is installed."""
+    return bool(_sinks)
+
+
+class LogSink:
+    """Writes one line per finished span."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def record(self, name: str, elapsed: float):
+        print(f"[profile] {name}: {elapsed * 1000:.2f} ms", file=self.stream)
+
+
+class HistogramSink:
+    """
+    Aggregates span durations per name in memory.
+
+    Durations are counted in power-of-two millisecond buckets, alongside
+    count, total, min and max.
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def record(self, name: str, elapsed: float):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = {
+                "count": 0,
+                "total": 0.0,
+                "min": math.inf,
+                "max": 0.0,
+                "buckets": {},
+            }
+        stats["count"] += 1
+        stats["total"] += elapsed
+        stats["min"] = min(stats["min"], elapsed)
+        stats["max"] = max(stats["max"], elapsed)
+        bucket = _bucket(elapsed)
+        stats["buckets"][bucket] = stats["buckets"].get(bucket, 0) + 1
+
+    def to_dict(self) -> dict:
+        """Return the aggregated stats, with times in milliseconds."""
+        return {
+            name: {
+                "count": stats["count"],
+                "total_ms": stats["total"] * 1000,
+                "mean_ms": stats["total"] * 1000 / stats["count"],
+                "min_ms": stats["min"] * 1000,
+                "max_ms": stats["max"] * 1000,
+                "buckets_ms": {
+                    f"<={bound}": count
+                    for bound, count in sorted(stats["buckets"].items())
+                },
+            }
+            for name, stats in self.stats.items()
+        }
+
+    def summary(self) -> str:
+        """Format the aggregated stats as a table, slowest total first."""
+        lines = [f"{'stage':36} {'count':>6} {'total ms':>10} {'mean ms':>10}"]
+        stats = sorted(self.to_dict().items(), key=lambda i: -i[1]["total_ms"])
+        for name, s in stats:
+            lines.append(
+                f"{name:36} {s['count']:6} {s['total_ms']:10.2f} {s['mean_ms']:10.2f}"
+            )
+        return "\n".join(lines)
+
+    def export_json(self, path: str):
+        """Write the aggregated stats to a JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+
+def _bucket(elapsed: float) -> float:
+    """Return the upper bound in ms of the power-of-two bucket for a duration."""
+    ms = elapsed * 1000
+    if ms <= 0.0625:
+        return 0.0625
+    return 2.0 ** math.ceil(math.log2(ms))
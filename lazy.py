@@ -0,0 +1,78 @@
+import importlib
+import sys
+import threading
+
+
+class LazyModule:
+    """
+    Stands in for a module that is imported on first attribute access.
+
+    numpy, Pillow and Cryptodome take most of the start-up time, so modules
+    bind them through this proxy and only pay for them once they are used.
+    Imports go through importlib, whose per-module locks make first use safe
+    from several threads at once, e.g. the GUI and a warm-up thread.
+    """
+
+    def __init__(self, name: str):
+        """
+        Creates the proxy without importing anything.
+
+        Args:
+            name (str): The absolute name of the module, e.g. "PIL.Image".
+        """
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        """Import the module, once, and return it."""
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._name)
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name: str):
+    """Return a module if it is already imported, or a LazyModule standing in for it."""
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+
+def _import_all(names):
+    """Import modules one after another, ignoring the ones that fail."""
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            # The failure surfaces again, with its traceback, on first use
+            pass
+
+
+def warm_up(names) -> threading.Thread:
+    """
+    Imports modules in a background thread, so first use does not wait for them.
+
+    Args:
+        names (Iterable[str]): The absolute names of the modules to import.
+
+    Returns:
+        threading.Thread: The daemon thread doing the imports.
+    """
+    thread = threading.Thread(
+        target=_import_all, args=(tuple(names),), name="warm-up", daemon=True
+    )
+    thread.start()
+    return thread
@@ -1,32 +1,165 @@
+import argparse
+import concurrent.futures
+import csv
+import functools
 import json
 import os
+import shutil
 from getpass import getpass
 
+import backup
 import encryption as enc
+import lazy
+import manifest as mft
 import steganography as steg
+import store
+import vault as vlt
+from cache import SecretCache
+from instrumentation import HistogramSink, LogSink, add_sink, span, timed
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+np = lazy.lazy_import("numpy")
 
 UsrDataFile = "services.json"
 UsrDataDir = "user_data"
 InputDir = "ImageStorage/OriginalImages/"
 OutputDir = "ImageStorage/SteganoImages/"
+KdfConfigFile = "kdf.json"
+ManifestFile = "manifest.json"
+RekeyFile = "rekey.json"
+RekeyDir = "rekey"
+VerifyFile = "verify.json"
+# Carrier images shared by all users, named by content hash
+StoreDir = ".images"
+SaveProfile = "default"
+BitsPerChannel = 1
+ChannelMask = None
+# Imported in the background while the first prompt or window is shown,
+# key derivation first since login needs it before any image
+WarmModules = (
+    "Cryptodome.Cipher.AES",
+    "Cryptodome.Protocol.KDF",
+    "numpy",
+    "PIL.Image",
+    "PIL.PngImagePlugin",
+)
 
 
-def load_user_data(username: str):
-    """Load user data from JSON file."""
+def warm_up():
+    """Start importing the key derivation and image libraries in the background."""
+    return lazy.warm_up(WarmModules)
+
+
+def check_username(username: str):
+    """Reject user names that would reach outside the data directory."""
+    if (
+        not username
+        or username.startswith(".")
+        or os.path.basename(username) != username
+    ):
+        raise ValueError("Invalid username.")
+
+
+def lock_user(username: str):
+    """
+    Block until holding the exclusive lock on a user's files, and return it.
+
+    Every process changing a user's stego images or services holds it: the
+    menu, the GUI, the CLI commands and the server. It lives next to the
+    user's directory, so restoring over that directory keeps it. Closing the
+    returned file releases it. Without flock (Windows) nothing is locked.
+    """
+    os.makedirs(UsrDataDir, exist_ok=True)
+    lock = open(os.path.join(UsrDataDir, f".{username}.lock"), "ab")
+    if fcntl is not None:
+        with span("lock_user"):
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    return lock
+
+
+def with_user_lock(func):
+    """Decorates a function taking a user name first so that it holds the user's lock."""
+
+    @functools.wraps(func)
+    def wrapper(username, *args, **kwargs):
+        with lock_user(username):
+            return func(username, *args, **kwargs)
+
+    return wrapper
+
+
+def user_vault(username: str):
+    """Return the session's in-memory vault of a user's services."""
     usr_data_file = os.path.join(UsrDataDir, username, UsrDataFile)
-    if not os.path.exists(usr_data_file):
-        return {}
-    with open(usr_data_file, "r") as f:
-        return json.load(f)
+    return vlt.open_vault(usr_data_file, username)
+
+
+def close_user_vault(username: str):
+    """Persist and drop the session's vault of a user's services."""
+    vlt.close_vault(os.path.join(UsrDataDir, username, UsrDataFile))
+
+
+def load_user_data(username: str):
+    """Load user data as stored in the JSON file."""
+    return {username: dict(user_vault(username).services)}
 
 
 def save_user_data(username: str, data: dict):
-    """Save user data to JSON file."""
-    usr_data_file = os.path.join(UsrDataDir, username, UsrDataFile)
-    with open(usr_data_file, "w") as f:
-        json.dump(data, f, indent=4)
+    """Atomically save user data to the JSON file."""
+    user_vault(username).replace(data.get(username, {}))
+
+
+def load_kdf_params():
+    """Load the KDF parameters picked by calibrate, or the defaults."""
+    config_file = os.path.join(UsrDataDir, KdfConfigFile)
+    if not os.path.exists(config_file):
+        return dict(enc.DEFAULT_KDF)
+    with open(config_file, "r") as f:
+        return json.load(f)
+
+
+def save_kdf_params(params: dict):
+    """Save the KDF parameters used for new and rehashed key files."""
+    os.makedirs(UsrDataDir, exist_ok=True)
+    with open(os.path.join(UsrDataDir, KdfConfigFile), "w") as f:
+        json.dump(params, f, indent=4)
+
+
+def write_atomic(path: str, data: bytes):
+    """Atomically replace a file."""
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
 
+def write_key_file(key_file: str, key: bytes):
+    """Atomically replace a key file."""
+    write_atomic(key_file, key)
 
+
+def load_rekey_checkpoint(username: str):
+    """Load the checkpoint of an unfinished master password change, if any."""
+    checkpoint_file = os.path.join(UsrDataDir, username, RekeyFile)
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, "r") as f:
+        return json.load(f)
+
+
+def save_rekey_checkpoint(username: str, checkpoint: dict):
+    """Atomically save the checkpoint of a master password change."""
+    checkpoint_file = os.path.join(UsrDataDir, username, RekeyFile)
+    write_atomic(checkpoint_file, json.dumps(checkpoint, indent=4).encode("utf8"))
+
+
+@timed("register_user")
 def register_user(username: str, password: str):
     """Register a new user and create an encryption key."""
     user_dir = os.path.join(UsrDataDir, username)
@@ -38,13 +171,15 @@ def register_user(username: str, password: str):
     image_dir = os.path.join(user_dir, "ImageStorage")
     os.makedirs(os.path.join(image_dir, "OriginalImages"))
     os.makedirs(os.path.join(image_dir, "SteganoImages"))
-    key = enc.gen_key(password)
-    with open(key_file, "wb") as f:
-        f.write(key)
+    with span("register_user.kdf"):
+        key = enc.gen_key(password, load_kdf_params())
+    with span("register_user.write_key"):
+        write_key_file(key_file, key)
     print(f"User {username} registered.")
     return key
 
 
+@timed("login_user")
 def login_user(username: str, password: str):
     """Authenticate an existing user and load their encryption key."""
     user_dir = os.path.join(UsrDataDir, username)
@@ -52,52 +187,1090 @@ def login_user(username: str, password: str):
     if not os.path.exists(key_file):
         print("User does not exist.")
         return None
+    checkpoint = load_rekey_checkpoint(username)
+    if checkpoint is not None and checkpoint["state"] == "commit":
+        print("A master password change is unfinished; run rekey again to finish it.")
+        return None
 
-    stored_key = enc.load_key(key_file)
-    if enc.verify_key(password, stored_key):
-        print(f"User {username} logged in.")
-        return enc.extract_key(stored_key)
-    else:
+    with span("login_user.load_key"):
+        stored_key = enc.load_key(key_file)
+    with span("login_user.kdf"):
+        key = enc.unlock_key(password, stored_key)
+    if key is None:
         print("Incorrect password.")
         return None
 
+    # Re-wrap the same data key when the KDF parameters are out of date
+    params = load_kdf_params()
+    if enc.needs_rehash(stored_key, params):
+        with span("login_user.rehash"):
+            write_key_file(key_file, enc.gen_key(password, params, key))
+    print(f"User {username} logged in.")
+    return key
+
+
+def find_stego_image(username: str, img_name: str):
+    """Return the path of an existing stego container for an image name, if any."""
+    for ext in steg.FORMAT_EXTENSIONS.values():
+        img_out_path = os.path.join(UsrDataDir, username, OutputDir, f"{img_name}{ext}")
+        if os.path.exists(img_out_path) and steg.is_container(img_out_path):
+            return img_out_path
+    return None
+
+
+def find_legacy_image(username: str, img_name: str):
+    """Return the path of a stego image with an image name that is not a container, if any."""
+    for ext in steg.FORMAT_EXTENSIONS.values():
+        img_out_path = os.path.join(UsrDataDir, username, OutputDir, f"{img_name}{ext}")
+        if os.path.exists(img_out_path) and not steg.is_container(img_out_path):
+            return img_out_path
+    return None
+
+
+def check_not_legacy(username: str, img_name: str):
+    """Raise ValueError if an image name holds a single secret from an older version."""
+    if find_legacy_image(username, img_name) is not None:
+        raise ValueError(
+            f"Image {img_name} holds a password from an older version; "
+            "choose another image."
+        )
+
+
+def image_manifest(username: str):
+    """Return the capacity manifest of a user's carrier images, refreshing changed ones."""
+    user_dir = os.path.join(UsrDataDir, username)
+    return mft.load_manifest(
+        os.path.join(user_dir, InputDir), os.path.join(user_dir, ManifestFile)
+    )
+
+
+def image_store():
+    """Return the directory of the carrier images shared by all users."""
+    return os.path.join(UsrDataDir, StoreDir)
+
+
+def import_image(username: str, src_path: str, img_name: str = None):
+    """
+    Add a carrier image to a user's OriginalImages through the shared image store.
+
+    The carrier is a hard link to the store's copy, so importing the same
+    photo again, or for another user, takes no extra space. A name already
+    used by a different carrier or by a stego image gets a numeric suffix
+    instead of replacing it. Returns the image name.
+    """
+    img_name = img_name or os.path.splitext(os.path.basename(src_path))[0]
+    image_dir = os.path.join(UsrDataDir, username, InputDir)
+    os.makedirs(image_dir, exist_ok=True)
+    with span("import_image.hash"):
+        digest = store.hash_file(src_path)
+
+    name = img_name
+    suffix = 1
+    while True:
+        img_inp_path = os.path.join(image_dir, f"{name}.png")
+        if os.path.exists(img_inp_path):
+            if store.hash_file(img_inp_path) == digest:
+                print(f"Image {name} is already imported.")
+                return name
+        elif not any(
+            os.path.exists(
+                os.path.join(UsrDataDir, username, OutputDir, f"{name}{ext}")
+            )
+            for ext in steg.FORMAT_EXTENSIONS.values()
+        ):
+            break
+        suffix += 1
+        name = f"{img_name}-{suffix}"
+
+    with span("import_image.link"):
+        store.import_file(image_store(), src_path, img_inp_path, digest)
+    print(f"Image {name} imported for user {username}.")
+    return name
+
 
-def add_password(username: str, service: str, password: str, key: bytes, img_name: str):
-    """Add a new password for a specific user."""
-    user_data = load_user_data(username)
-    user_services = user_data.get(username, {})
+def collect_images():
+    """
+    Deduplicate every user's carrier images into the shared store, then delete
+    the stored images no carrier uses any more.
 
-    ciphertext, nonce, tag = enc.encrypt_pwd(password, key)
-    encrypted_data = enc.add_data(ciphertext, nonce, tag)
+    Returns the number of bytes freed.
+    """
+    store_dir = image_store()
+    freed = 0
+    with os.scandir(UsrDataDir) as users:
+        for user in users:
+            image_dir = os.path.join(user.path, InputDir)
+            if user.name == StoreDir or not os.path.isdir(image_dir):
+                continue
+            with os.scandir(image_dir) as it:
+                for item in it:
+                    if item.is_file() and item.name.endswith(".png"):
+                        freed += store.adopt_file(store_dir, item.path)
+    deleted, collected = store.collect_garbage(store_dir)
+    print(
+        f"Freed {(freed + collected) / 1024:.0f} KiB; "
+        f"deleted {deleted} unused stored images."
+    )
+    return freed + collected
+
+
+def image_space(username: str, img_name: str, entry: dict = None):
+    """
+    Return the record bytes and index slots an image name can still take.
+
+    Existing containers are measured from their header and index; new ones
+    from the manifest entry of the carrier, so no image is decoded in full.
+    Legacy single-secret images have no room, since writing would replace them.
+    """
+    if find_legacy_image(username, img_name) is not None:
+        return 0, 0
+    img_out_path = find_stego_image(username, img_name)
+    if img_out_path is not None:
+        return steg.container_space(img_out_path)
+    if entry is None or entry["mode"] is None:
+        return 0, 0
+    try:
+        capacity = steg.container_capacity(
+            (entry["width"], entry["height"]),
+            entry["mode"],
+            steg.DEFAULT_SLOTS,
+            BitsPerChannel,
+            ChannelMask,
+        )
+    except ValueError:
+        return 0, 0
+    return capacity, steg.DEFAULT_SLOTS
+
+
+def pick_image(username: str, size: int, count: int = 1):
+    """Return the smallest carrier image with room for `count` records of `size` bytes in all."""
+    entries = image_manifest(username)
+    carriers = sorted(
+        (entry["capacity_bits"], name[: -len(".png")])
+        for name, entry in entries.items()
+        if name.endswith(".png") and entry["mode"] is not None
+    )
+    for _, img_name in carriers:
+        free, slots = image_space(username, img_name, entries[f"{img_name}.png"])
+        if slots >= count and free >= size:
+            return img_name
+    return None
+
+
+def check_image(username: str, img_name: str, size: int, count: int = 1):
+    """Raise ValueError if an image cannot take `count` records of `size` bytes in all."""
+    check_not_legacy(username, img_name)
+    entry = image_manifest(username).get(f"{img_name}.png")
+    if entry is None and find_stego_image(username, img_name) is None:
+        raise ValueError(f"Image {img_name}.png does not exist in OriginalImages.")
+    free, slots = image_space(username, img_name, entry)
+    if slots < count:
+        raise ValueError("Container index is full.")
+    if free < size:
+        raise ValueError("Data is too large to fit in the given image.")
+
+
+def choose_image(username: str, img_name: str, size: int, count: int = 1):
+    """Check the given image can take `count` records of `size` bytes, or pick one."""
+    if img_name:
+        check_image(username, img_name, size, count)
+        return img_name
+    img_name = pick_image(username, size, count)
+    if img_name is None:
+        raise ValueError("No image in OriginalImages has room left.")
+    print(f"Using image {img_name}.")
+    return img_name
+
+
+def embed_options():
+    """Return the options new stego containers are written with."""
+    return {
+        "profile": SaveProfile,
+        "bits_per_channel": BitsPerChannel,
+        "channel_mask": ChannelMask,
+    }
+
+
+def store_records(
+    username: str,
+    img_name: str,
+    records: list,
+    profile: str = None,
+    bits_per_channel: int = None,
+    channel_mask: int = None,
+):
+    """Embed encrypted records into a user's image, appending if it holds a container."""
+    img_inp_path, img_out_path, profile, exists = _stego_target(
+        username, img_name, profile
+    )
+    if exists:
+        record_ids = steg.append_records(img_out_path, records, profile=profile)
+    else:
+        slots = max(steg.DEFAULT_SLOTS, len(records))
+        record_ids = steg.encode_records(
+            img_inp_path,
+            records,
+            img_out_path,
+            slots,
+            profile,
+            bits_per_channel or BitsPerChannel,
+            channel_mask if channel_mask is not None else ChannelMask,
+        )
+    return img_out_path, record_ids
+
+
+def store_stream(username: str, img_name: str, chunks, profile: str = None):
+    """Embed an encrypted file stream into a user's image as a single record."""
+    img_inp_path, img_out_path, profile, exists = _stego_target(
+        username, img_name, profile
+    )
+    if exists:
+        record_id = steg.append_stream(img_out_path, chunks, profile=profile)
+    else:
+        record_id = steg.encode_stream(
+            img_inp_path,
+            chunks,
+            img_out_path,
+            profile=profile,
+            bits_per_channel=BitsPerChannel,
+            channel_mask=ChannelMask,
+        )
+    return img_out_path, record_id
+
+
+def _stego_target(username: str, img_name: str, profile: str = None):
+    """
+    Work out where records for an image name are embedded.
+
+    Returns the carrier path, the stego image path, the save profile and
+    whether the stego image already holds a container.
+
+    Raises:
+        ValueError: If the image name holds a legacy single-secret image.
+    """
+    check_not_legacy(username, img_name)
+    profile = profile or SaveProfile
+    ext = steg.profile_extension(profile)
     img_inp_path = os.path.join(UsrDataDir, username, InputDir, f"{img_name}.png")
-    img_out_path = os.path.join(UsrDataDir, username, OutputDir, f"{img_name}.png")
-    steg.encode_img(img_inp_path, encrypted_data, img_out_path)
 
-    user_services[service] = {"image_path": img_out_path}
+    # Services sharing an image are appended as new records of its container,
+    # which keeps the format it was created with
+    img_out_path = find_stego_image(username, img_name)
+    if img_out_path is not None:
+        if not img_out_path.endswith(ext):
+            profile = None
+        return img_inp_path, img_out_path, profile, True
+    img_out_path = os.path.join(UsrDataDir, username, OutputDir, f"{img_name}{ext}")
+    return img_inp_path, img_out_path, profile, False
+
 
-    user_data[username] = user_services
-    save_user_data(username, user_data)
+@timed("add_password")
+@with_user_lock
+def add_password(
+    username: str, service: str, password: str, key: bytes, img_name: str = None
+):
+    """Add a new password for a specific user, picking an image if none is given."""
+    with span("add_password.encrypt"):
+        ciphertext, nonce, tag = enc.encrypt_pwd(password, key)
+        encrypted_data = enc.add_data(ciphertext, nonce, tag)
+    with span("add_password.pick"):
+        img_name = choose_image(username, img_name, len(encrypted_data))
+    with span("add_password.embed"):
+        img_out_path, (record_id,) = store_records(username, img_name, [encrypted_data])
+
+    with span("add_password.index"):
+        user_vault(username).set(
+            service, {"image_path": img_out_path, "record": record_id}
+        )
     print(f"Password for {service} added for user {username}.")
 
 
-def get_password(username: str, service: str, key: bytes):
-    """Retrieve a password for a specific user."""
-    user_data = load_user_data(username)
-    user_services = user_data.get(username, {})
-    service_data = user_services.get(service)
+@timed("add_file")
+@with_user_lock
+def add_file(
+    username: str,
+    service: str,
+    file_path: str,
+    key: bytes,
+    img_name: str,
+    compression: str = "zlib",
+):
+    """Compress, encrypt and embed a file, e.g. an SSH key, for a specific user."""
+    with open(file_path, "rb") as src:
+        chunks = enc.encrypt_stream(src, key, compression)
+        img_out_path, record_id = store_stream(username, img_name, chunks)
+
+    with span("add_file.index"):
+        user_vault(username).set(
+            service,
+            {
+                "image_path": img_out_path,
+                "record": record_id,
+                "file": os.path.basename(file_path),
+            },
+        )
+    print(f"File for {service} added for user {username}.")
+
+
+def _encrypted_size(password: str) -> int:
+    """Return the size of a password record once encrypted."""
+    return len(password.encode("utf8")) + enc.nonce_len + enc.tag_len
+
+
+def _spread_entries(username: str, entries: list, batches: dict, workers: int):
+    """
+    Add bulk import entries without an image to the batches of carrier images.
+
+    The carriers with the most room left, after the batches already naming
+    them, take the entries; one carrier per worker, so every worker encodes
+    an image of its own. Other carriers are only used once those are full.
+    Returns (service, error message) pairs for the entries that fit nowhere.
+    """
+    room = {}
+    for name, entry in image_manifest(username).items():
+        if not name.endswith(".png") or entry["mode"] is None:
+            continue
+        img_name = name[: -len(".png")]
+        free, slots = image_space(username, img_name, entry)
+        named = batches.get(img_name, [])
+        free -= sum(_encrypted_size(e["password"]) for e in named)
+        slots -= len(named)
+        if free > 0 and slots > 0:
+            room[img_name] = [free, slots]
+    count = workers or os.cpu_count() or 1
+    chosen = sorted(room, key=lambda name: -room[name][0])[:count]
+
+    failures = []
+    # Largest first, so small entries fill the gaps that are left
+    for entry in sorted(entries, key=lambda e: -_encrypted_size(e["password"])):
+        size = _encrypted_size(entry["password"])
+        fits = [name for name in chosen if room[name][1] and room[name][0] >= size]
+        if not fits:
+            fits = [name for name in room if room[name][1] and room[name][0] >= size]
+            if not fits:
+                failures.append(
+                    (entry["service"], "No image in OriginalImages has room left.")
+                )
+                continue
+            chosen.append(fits[0])
+        img_name = max(fits, key=lambda name: room[name][0])
+        room[img_name][0] -= size
+        room[img_name][1] -= 1
+        batches.setdefault(img_name, []).append(entry)
+    return failures
+
+
+def encode_batch(
+    username: str, img_name: str, passwords: list, key: bytes, options: dict
+):
+    """Encrypt passwords and embed them into one image; runs in a worker process."""
+    records = [enc.add_data(*enc.encrypt_pwd(password, key)) for password in passwords]
+    return store_records(username, img_name, records, **options)
+
+
+@with_user_lock
+def add_passwords_bulk(username: str, entries: list, key: bytes, workers: int = None):
+    """
+    Add many passwords for a user, encoding each image in a worker process.
+
+    Entries are dicts with "service" (or "name", as in password manager
+    exports), "password" and optionally "image" keys. Entries sharing an
+    image are embedded into it together. Entries without one are spread
+    over the carriers with the most room, one per worker, so the import
+    scales with the cores. services.json is written once at the end, and a
+    failing image only fails the entries using it.
+
+    Returns a tuple of the number of services added and a list of
+    (service, error message) pairs for the entries that failed.
+    """
+    failures = []
+    batches = {}
+    auto = []
+    for entry in entries:
+        service = entry.get("service") or entry.get("name")
+        if not service or not entry.get("password"):
+            failures.append((service or "?", "service and password are required"))
+            continue
+        entry = dict(entry, service=service)
+        if entry.get("image"):
+            batches.setdefault(entry["image"], []).append(entry)
+        else:
+            auto.append(entry)
+    if auto:
+        with span("add_passwords_bulk.pick"):
+            failures += _spread_entries(username, auto, batches, workers)
+
+    results = {}
+    if workers == 1:
+        for img_name, batch in batches.items():
+            passwords = [entry["password"] for entry in batch]
+            try:
+                results[img_name] = encode_batch(
+                    username, img_name, passwords, key, embed_options()
+                )
+            except Exception as e:
+                results[img_name] = e
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                img_name: executor.submit(
+                    encode_batch,
+                    username,
+                    img_name,
+                    [entry["password"] for entry in batch],
+                    key,
+                    embed_options(),
+                )
+                for img_name, batch in batches.items()
+            }
+            for img_name, future in futures.items():
+                try:
+                    results[img_name] = future.result()
+                except Exception as e:
+                    results[img_name] = e
+
+    added_services = {}
+    for img_name, batch in batches.items():
+        result = results[img_name]
+        if isinstance(result, Exception):
+            failures.extend((entry["service"], str(result)) for entry in batch)
+            continue
+        img_out_path, record_ids = result
+        for entry, record_id in zip(batch, record_ids):
+            added_services[entry["service"]] = {
+                "image_path": img_out_path,
+                "record": record_id,
+            }
+
+    user_vault(username).set_many(added_services)
+    added = len(added_services)
+    print(f"Imported {added} services for user {username}, {len(failures)} failed.")
+    return added, failures
+
+
+def _rekey_image(
+    image_path: str, records: list, old_key: bytes, new_key: bytes, out_path: str
+):
+    """
+    Re-encrypt the records of one stego image under a new key; runs in a worker process.
+
+    records is a sorted list of (record id, is file) pairs. The new image is
+    written to out_path with the embedding mode of the old one. Returns a list
+    of (old record id, new record id) pairs.
+    """
+    if not steg.is_container(image_path):
+        # A legacy single-secret image, which several services may point at
+        # since older versions overwrote images when a name was reused
+        encrypted_data = steg.decode_img(image_path)
+        cipher, nonce, tag = enc.separate_data(
+            encrypted_data, enc.nonce_len, enc.tag_len
+        )
+        password = enc.decrypt_pwd(cipher, nonce, tag, old_key)
+        steg.encode_img(
+            image_path, enc.add_data(*enc.encrypt_pwd(password, new_key)), out_path
+        )
+        return [[None, None] for _ in records]
+
+    header = steg.read_header(image_path)
+    # Services without a record id whose legacy image was since replaced by a
+    # container have nothing left to re-encrypt
+    lost = [[None, None] for record_id, _ in records if record_id is None]
+    records = [record for record in records if record[0] is not None]
+    new_records = []
+    for record_id, is_file in records:
+        if is_file:
+            pieces = steg.decode_stream(image_path, record_id)
+            new_records.append(b"".join(enc.reencrypt_stream(pieces, old_key, new_key)))
+            continue
+        encrypted_data = steg.decode_record(image_path, record_id)
+        cipher, nonce, tag = enc.separate_data(
+            encrypted_data, enc.nonce_len, enc.tag_len
+        )
+        password = enc.decrypt_pwd(cipher, nonce, tag, old_key)
+        new_records.append(enc.add_data(*enc.encrypt_pwd(password, new_key)))
+
+    # The old image is the carrier, so the new one keeps its pixels and format
+    new_ids = steg.encode_records(
+        image_path,
+        new_records,
+        out_path,
+        max(header.slots, len(new_records)),
+        bits_per_channel=header.bits_per_channel,
+        channel_mask=header.channel_mask,
+    )
+    return lost + [[old, new] for (old, _), new in zip(records, new_ids)]
+
+
+@timed("rekey_user")
+@with_user_lock
+def rekey_user(
+    username: str, old_password: str, new_password: str, workers: int = None
+):
+    """
+    Change a user's master password and re-encrypt every service under a new key.
+
+    Images are re-encrypted in worker processes into a staging directory next
+    to SteganoImages, and each finished image is recorded in a checkpoint, so
+    running rekey again after an interruption resumes where it stopped. Once
+    every image is staged, the new services.json is written into the
+    checkpoint and it is marked committed; from then on the change is rolled
+    forward: the staged images, the key file and services.json are moved into
+    place, then the checkpoint is removed.
+
+    Returns True if the master password was changed.
+    """
+    user_dir = os.path.join(UsrDataDir, username)
+    key_file = os.path.join(user_dir, "encryption_key.bin")
+    stage_dir = os.path.join(user_dir, RekeyDir)
+    if not os.path.exists(key_file):
+        print("User does not exist.")
+        return False
+
+    checkpoint = load_rekey_checkpoint(username)
+    old_key = None
+    if checkpoint is None or checkpoint["state"] == "running":
+        old_key = enc.unlock_key(old_password, enc.load_key(key_file))
+        if old_key is None:
+            print("Incorrect password.")
+            return False
+
+    if checkpoint is None:
+        new_key = os.urandom(enc.KEY_SIZE)
+        stored_key = enc.gen_key(new_password, load_kdf_params(), new_key)
+        checkpoint = {
+            "state": "running",
+            "key_file": stored_key.decode("ascii"),
+            "images": {},
+        }
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        os.makedirs(stage_dir)
+        save_rekey_checkpoint(username, checkpoint)
+    else:
+        new_key = enc.unlock_key(new_password, checkpoint["key_file"].encode("ascii"))
+        if new_key is None:
+            print("The new password does not match the unfinished change.")
+            return False
+        print("Resuming the unfinished master password change.")
+
+    if checkpoint["state"] == "running":
+        if not _rekey_images(username, checkpoint, old_key, new_key, workers):
+            return False
+
+    with span("rekey_user.commit"):
+        for image_path in checkpoint["images"]:
+            staged_path = os.path.join(stage_dir, os.path.basename(image_path))
+            if os.path.exists(staged_path):
+                os.replace(staged_path, image_path)
+        write_key_file(key_file, checkpoint["key_file"].encode("ascii"))
+        user_vault(username).replace(checkpoint["services"])
+        close_user_vault(username)
+        os.remove(os.path.join(user_dir, RekeyFile))
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    print(f"Master password changed for user {username}.")
+    return True
+
+
+@with_user_lock
+def abort_rekey(username: str, password: str):
+    """
+    Discard an unfinished master password change that has not been committed.
+
+    Nothing is moved into place before the commit, so the staged images and
+    the checkpoint are deleted and the old password stays valid. A committed
+    change can only be rolled forward. Returns True if a change was discarded.
+    """
+    user_dir = os.path.join(UsrDataDir, username)
+    checkpoint = load_rekey_checkpoint(username)
+    if checkpoint is None:
+        print("No master password change is unfinished.")
+        return False
+    if checkpoint["state"] != "running":
+        print("The master password change is committed; run rekey again to finish it.")
+        return False
+    key_file = os.path.join(user_dir, "encryption_key.bin")
+    if enc.unlock_key(password, enc.load_key(key_file)) is None:
+        print("Incorrect password.")
+        return False
+    os.remove(os.path.join(user_dir, RekeyFile))
+    shutil.rmtree(os.path.join(user_dir, RekeyDir), ignore_errors=True)
+    print(f"Discarded the unfinished master password change of user {username}.")
+    return True
+
+
+def _rekey_images(
+    username: str, checkpoint: dict, old_key: bytes, new_key: bytes, workers: int
+):
+    """
+    Stage re-encrypted copies of a user's images and commit the checkpoint.
+
+    Images already staged are skipped unless they changed since. Returns
+    False if some image failed; the checkpoint keeps the finished ones.
+    """
+    stage_dir = os.path.join(UsrDataDir, username, RekeyDir)
+    services = user_vault(username).services
+    batches = {}
+    for data in services.values():
+        batches.setdefault(data["image_path"], []).append(
+            [data.get("record"), "file" in data]
+        )
+
+    pending = {}
+    for image_path, records in batches.items():
+        records.sort(key=lambda r: -1 if r[0] is None else r[0])
+        done = checkpoint["images"].get(image_path)
+        if (
+            done is None
+            or not os.path.exists(image_path)
+            or done["mtime_ns"] != os.stat(image_path).st_mtime_ns
+            or [old for old, _ in done["records"]] != [r[0] for r in records]
+        ):
+            pending[image_path] = records
+
+    def finish(image_path, records):
+        checkpoint["images"][image_path] = {
+            "records": records,
+            "mtime_ns": os.stat(image_path).st_mtime_ns,
+        }
+        save_rekey_checkpoint(username, checkpoint)
+
+    failures = []
+    if workers == 1:
+        for image_path, records in pending.items():
+            staged_path = os.path.join(stage_dir, os.path.basename(image_path))
+            try:
+                finish(
+                    image_path,
+                    _rekey_image(image_path, records, old_key, new_key, staged_path),
+                )
+            except Exception as e:
+                failures.append((image_path, e))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    _rekey_image,
+                    image_path,
+                    records,
+                    old_key,
+                    new_key,
+                    os.path.join(stage_dir, os.path.basename(image_path)),
+                ): image_path
+                for image_path, records in pending.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    finish(futures[future], future.result())
+                except Exception as e:
+                    failures.append((futures[future], e))
+    for image_path, error in failures:
+        print(f"Failed to re-encrypt {image_path}: {error}")
+    if failures:
+        print("Run rekey again to retry; finished images are kept.")
+        return False
+
+    new_services = {}
+    for service, data in services.items():
+        data = dict(data)
+        if "record" in data:
+            records = dict(
+                map(tuple, checkpoint["images"][data["image_path"]]["records"])
+            )
+            data["record"] = records[data["record"]]
+        new_services[service] = data
+    checkpoint["services"] = new_services
+    checkpoint["state"] = "commit"
+    save_rekey_checkpoint(username, checkpoint)
+    return True
+
+
+def _describe_error(error: Exception) -> str:
+    """Describe why a record failed to verify."""
+    if isinstance(error, KeyError):
+        return f"Record {error} is missing from the container."
+    return f"{type(error).__name__}: {error}"
+
+
+def _verify_image(image_path: str, records: list, key: bytes):
+    """
+    Decode and authenticate the records of one stego image; runs in a worker process.
+
+    records is a sorted list of (record id, is file) pairs. Returns an error
+    message per record, or None for records that are intact.
+    """
+    errors = {}
+    passwords = [record for record, is_file in records if not is_file]
+    if passwords:
+        results = decode_password_results(image_path, passwords, key)
+        for record, (_, error) in zip(passwords, results):
+            if error is not None:
+                errors[record] = _describe_error(error)
+    with open(os.devnull, "wb") as sink:
+        for record, is_file in records:
+            if is_file:
+                try:
+                    enc.decrypt_stream(
+                        steg.decode_stream(image_path, record), key, sink
+                    )
+                except Exception as e:
+                    errors[record] = _describe_error(e)
+    return [errors.get(record) for record, _ in records]
+
+
+@timed("verify_user")
+def verify_user(username: str, key: bytes, workers: int = None, full: bool = False):
+    """
+    Decode and authenticate every service of a user and report the broken ones.
+
+    Images are checked in worker processes. Images found intact are recorded
+    in verify.json with their mtime, size and records, and later scans skip
+    them until one of those changes, unless full is set.
+
+    Returns a dict with the "broken" services as (service, error) pairs, the
+    "missing" services whose image is gone, the "orphaned" files in
+    SteganoImages that no service uses, and the numbers of images "checked"
+    and skipped as unchanged ("cached").
+    """
+    user_dir = os.path.join(UsrDataDir, username)
+    cache_file = os.path.join(user_dir, VerifyFile)
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, "r") as f:
+                cache = json.load(f)
+        except json.JSONDecodeError:
+            cache = {}
+
+    batches = {}
+    for service, data in user_vault(username).services.items():
+        batches.setdefault(data["image_path"], []).append(
+            [data.get("record"), "file" in data, service]
+        )
+
+    report = {"broken": [], "missing": [], "orphaned": [], "checked": 0, "cached": 0}
+    new_cache = {}
+    pending = {}
+    for image_path, entries in batches.items():
+        entries.sort(key=lambda e: (-1 if e[0] is None else e[0], e[2]))
+        if not os.path.exists(image_path):
+            report["missing"] += [service for _, _, service in entries]
+            continue
+        stat = os.stat(image_path)
+        entry = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "records": [[record, is_file] for record, is_file, _ in entries],
+        }
+        if not full and cache.get(image_path) == entry:
+            new_cache[image_path] = entry
+            report["cached"] += 1
+        else:
+            pending[image_path] = entry
+
+    def finish(image_path, errors):
+        report["checked"] += 1
+        for (_, _, service), error in zip(batches[image_path], errors):
+            if error is not None:
+                report["broken"].append((service, error))
+        if not any(errors):
+            new_cache[image_path] = pending[image_path]
+
+    if workers == 1:
+        for image_path, entry in pending.items():
+            finish(image_path, _verify_image(image_path, entry["records"], key))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    _verify_image, image_path, entry["records"], key
+                ): image_path
+                for image_path, entry in pending.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                image_path = futures[future]
+                try:
+                    errors = future.result()
+                except Exception as e:
+                    errors = [_describe_error(e)] * len(batches[image_path])
+                finish(image_path, errors)
+
+    used = {os.path.normpath(image_path) for image_path in batches}
+    stego_dir = os.path.join(user_dir, OutputDir)
+    if os.path.isdir(stego_dir):
+        with os.scandir(stego_dir) as it:
+            for item in it:
+                if item.is_file() and os.path.normpath(item.path) not in used:
+                    report["orphaned"].append(item.path)
+
+    if new_cache != cache:
+        write_atomic(cache_file, json.dumps(new_cache, indent=4).encode("utf8"))
+    report["broken"].sort()
+    report["missing"].sort()
+    report["orphaned"].sort()
+    return report
+
+
+@timed("backup_user")
+@with_user_lock
+def backup_user(username: str, out_path: str, base_path: str = None):
+    """
+    Stream a user's key file, services.json and stego images into a backup archive.
+
+    With the previous archive as base_path, only files that changed since it
+    are read and stored. Carrier images are not backed up. Returns the
+    manifest written, or None.
+    """
+    user_dir = os.path.join(UsrDataDir, username)
+    if not os.path.exists(os.path.join(user_dir, "encryption_key.bin")):
+        print("User does not exist.")
+        return None
+    # Only a committed change leaves the files on disk out of step; a running
+    # one has not touched them yet
+    checkpoint = load_rekey_checkpoint(username)
+    if checkpoint is not None and checkpoint["state"] == "commit":
+        print("A master password change is unfinished; run rekey again to finish it.")
+        return None
+
+    # The vault comes first: images are written before the services pointing
+    # at them, so every image a backed-up service needs is at least as new
+    paths = ["encryption_key.bin", UsrDataFile, UsrDataFile + vlt.JournalSuffix]
+    stego_dir = os.path.join(user_dir, OutputDir)
+    if os.path.isdir(stego_dir):
+        paths += [
+            f"{OutputDir}{name}"
+            for name in sorted(os.listdir(stego_dir))
+            if not name.endswith(".tmp")
+        ]
+    manifest = backup.backup_files(
+        user_dir, paths, out_path, base_path, {"username": username}
+    )
+    stored = sum(
+        entry["archive"] == os.path.basename(out_path)
+        for entry in manifest["files"].values()
+    )
+    print(
+        f"Backed up {len(manifest['files'])} files of user {username} to "
+        f"{out_path}, {stored} of them new or changed."
+    )
+    return manifest
+
+
+@timed("restore_user")
+def restore_user(archive_path: str, replace: bool = False):
+    """
+    Restore the user of a backup archive and the earlier archives it builds on.
+
+    Every file is verified as it is streamed out, and the user's directory is
+    only replaced once all of them checked out; its carrier images are kept.
+    The user keeps their name, since services.json refers to their images by
+    path. Returns the user name, or None.
+    """
+    username = backup.read_manifest(archive_path)["info"].get("username")
+    try:
+        check_username(username)
+    except ValueError:
+        print(f"Refusing to restore {archive_path}: it names an invalid user.")
+        return None
+    user_dir = os.path.join(UsrDataDir, username)
+    close_user_vault(username)
+    try:
+        with lock_user(username):
+            manifest = backup.restore_files(
+                archive_path,
+                user_dir,
+                replace,
+                keep=(InputDir.rstrip("/"), ManifestFile),
+            )
+    except FileExistsError:
+        print(f"User {username} already exists; use --replace to restore over it.")
+        return None
+    os.makedirs(os.path.join(user_dir, InputDir), exist_ok=True)
+    os.makedirs(os.path.join(user_dir, OutputDir), exist_ok=True)
+    print(
+        f"Restored {len(manifest['files'])} files of user {username} "
+        f"from the backup of {manifest['created']}."
+    )
+    return username
+
+
+def load_import_file(path: str):
+    """Load bulk import entries from a CSV file or a JSON list of objects."""
+    if path.lower().endswith(".json"):
+        with open(path, "r") as f:
+            entries = json.load(f)
+        if not isinstance(entries, list):
+            raise ValueError("JSON import file must hold a list of entries.")
+        return entries
+    with open(path, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def embed_password(image, password: str, key: bytes, out=None, profile=None):
+    """
+    Encrypt a password into an in-memory image, with no file or vault involved.
+
+    image may be the contents of an image file, a binary file object or a
+    pixel array; a container it already holds gets the password appended.
+    The result is written to `out`, a writable binary file object, if given,
+    and otherwise returned: as a new pixel array for array input, as image
+    file contents for the rest. decode_password reads it back with the
+    record id. Returns a tuple of (encoded image or None, record id).
+    """
+    with span("embed_password.encrypt"):
+        record = enc.add_data(*enc.encrypt_pwd(password, key))
+    pixels = steg.load_pixels(image)
+    if steg.is_container(pixels):
+        (record_id,) = steg.embed_records(pixels, [record], append=True)
+    else:
+        (record_id,) = steg.embed_records(
+            pixels,
+            [record],
+            bits_per_channel=BitsPerChannel,
+            channel_mask=ChannelMask,
+        )
+    if out is not None:
+        steg.save_pixels(pixels, out, profile or SaveProfile)
+        return None, record_id
+    if isinstance(image, np.ndarray):
+        return pixels, record_id
+    return steg.image_bytes(pixels, profile or SaveProfile), record_id
+
+
+def decode_password(image_path, record: int, key: bytes):
+    """
+    Decode and decrypt one password record; record is None for single-secret images.
+
+    image_path may also be an in-memory image: file contents, a binary file
+    object or a pixel array.
+    """
+    return decode_passwords(image_path, [record], key)[0]
+
+
+def decode_passwords(image_path, records: list, key: bytes):
+    """Decode and decrypt several password records of one image, decoding it once."""
+    with span("get_password.decode"):
+        if records == [None]:
+            encrypted_records = [steg.decode_img(image_path)]
+        else:
+            encrypted_records = steg.decode_records(image_path, records)
+    with span("get_password.decrypt"):
+        passwords = []
+        for encrypted_data in encrypted_records:
+            cipher, nonce, tag = enc.separate_data(
+                encrypted_data, enc.nonce_len, enc.tag_len
+            )
+            passwords.append(enc.decrypt_pwd(cipher, nonce, tag, key))
+        return passwords
+
+
+def decode_password_results(image_path, records: list, key: bytes):
+    """
+    Decode and decrypt several password records of one image, each failing on its own.
+
+    The records are extracted together, decoding the image once, and then
+    decrypted one by one, so a corrupt or missing record does not fail its
+    neighbours. Returns a (password, error) pair per record, where error is
+    the exception the record raised, or None.
+    """
+    with span("get_password.decode"):
+        try:
+            if records == [None]:
+                extracted = [(steg.decode_img(image_path), None)]
+            else:
+                extracted = [
+                    (data, None) for data in steg.decode_records(image_path, records)
+                ]
+        except KeyError:
+            # A record missing from the index; extract the others one by one
+            extracted = []
+            for record in records:
+                try:
+                    extracted.append(
+                        (steg.decode_records(image_path, [record])[0], None)
+                    )
+                except Exception as e:
+                    extracted.append((None, e))
+        except Exception as e:
+            extracted = [(None, e)] * len(records)
+    with span("get_password.decrypt"):
+        results = []
+        for encrypted_data, error in extracted:
+            if error is None:
+                try:
+                    cipher, nonce, tag = enc.separate_data(
+                        encrypted_data, enc.nonce_len, enc.tag_len
+                    )
+                    results.append((enc.decrypt_pwd(cipher, nonce, tag, key), None))
+                    continue
+                except Exception as e:
+                    error = e
+            results.append((None, error))
+        return results
+
+
+@timed("search_services")
+def search_services(username: str, query: str, limit: int = 10):
+    """Return service names matching a partly typed or misspelt name."""
+    return user_vault(username).search.search(query, limit)
+
+
+@timed("get_password")
+def get_password(username: str, service: str, key: bytes, cache=None):
+    """Retrieve a password for a specific user, using the session cache if given."""
+    with span("get_password.lookup"):
+        service_data = user_vault(username).get(service)
 
     if not service_data:
         print(f"Service {service} not found for user {username}.")
+        suggestions = search_services(username, service, 5)
+        if suggestions:
+            print(f"Did you mean: {', '.join(suggestions)}?")
+        return
+
+    if "file" in service_data:
+        print(f"Service {service} holds a file; use get-file to retrieve it.")
         return
 
     image_path = service_data["image_path"]
-    encrypted_data = steg.decode_img(image_path)
-    cipher, nonce, tag = enc.separate_data(encrypted_data, enc.nonce_len, enc.tag_len)
-    decrypted_pwd = enc.decrypt_pwd(cipher, nonce, tag, key)
+    record = service_data.get("record")
+    if cache is not None:
+        decrypted_pwd = cache.get(image_path, record)
+        if decrypted_pwd is not None:
+            return decrypted_pwd
+
+    decrypted_pwd = decode_password(image_path, record, key)
+    if cache is not None:
+        cache.put(image_path, record, decrypted_pwd)
     return decrypted_pwd
 
 
-def main_menu():
+@timed("get_file")
+def get_file(username: str, service: str, key: bytes, out_path: str = None):
+    """
+    Extract a file stored with add_file to out_path, or its original name.
+
+    The file is streamed out chunk by chunk and only moved into place once
+    every chunk has been authenticated. Returns the path written, or None.
+    """
+    service_data = user_vault(username).get(service)
+    if not service_data or "file" not in service_data:
+        print(f"File {service} not found for user {username}.")
+        return None
+
+    out_path = out_path or service_data["file"]
+    pieces = steg.decode_stream(service_data["image_path"], service_data["record"])
+    tmp_path = out_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as dst:
+            enc.decrypt_stream(pieces, key, dst)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"File for {service} written to {out_path}.")
+    return out_path
+
+
+def main_menu(cache_ttl: float = None):
     """Display the main menu and handle user input."""
     while True:
         print("\nMain Menu")
@@ -115,35 +1288,325 @@ def main_menu():
             password = getpass("Enter your master password: ").strip()
             key = login_user(username, password)
             if key:
-                user_sub_menu(username, key)
+                cache = SecretCache(cache_ttl) if cache_ttl else None
+                user_sub_menu(username, key, cache)
         elif choice == "3":
             break
         else:
             print("Invalid option. Please choose again.")
 
 
-def user_sub_menu(username, key):
+def user_sub_menu(username, key, cache=None):
     """Display the user sub-menu after login."""
     while True:
         print(f"\nUser Menu - {username}")
         print("1. Add Service")
         print("2. Get Password")
-        print("3. Logout")
+        print("3. Add File")
+        print("4. Get File")
+        print("5. Logout")
         choice = input("Choose an option: ").strip()
 
         if choice == "1":
             service = input("Enter service name: ").strip()
             password = getpass("Enter password: ").strip()
-            img_name = input("Enter image name: ").strip()
-            add_password(username, service, password, key, img_name)
+            img_name = input("Enter image name (blank to pick one): ").strip()
+            try:
+                add_password(username, service, password, key, img_name)
+            except ValueError as e:
+                print(e)
         elif choice == "2":
             service = input("Enter service name: ").strip()
-            get_password(username, service, key)
+            get_password(username, service, key, cache)
         elif choice == "3":
+            service = input("Enter service name: ").strip()
+            file_path = input("Enter file path: ").strip()
+            img_name = input("Enter image name: ").strip()
+            if not img_name:
+                print("An image name is required.")
+                continue
+            try:
+                add_file(username, service, file_path, key, img_name)
+            except (ValueError, OSError) as e:
+                print(e)
+        elif choice == "4":
+            service = input("Enter service name: ").strip()
+            out_path = input("Enter output path (blank for original name): ").strip()
+            get_file(username, service, key, out_path or None)
+        elif choice == "5":
+            if cache is not None:
+                cache.wipe()
+            close_user_vault(username)
             break
         else:
             print("Invalid option. Please choose again.")
 
 
+def import_command(args):
+    """Bulk import services for a user from a CSV or JSON file."""
+    password = getpass("Enter your master password: ").strip()
+    key = login_user(args.username, password)
+    if not key:
+        return
+    entries = load_import_file(args.file)
+    _, failures = add_passwords_bulk(args.username, entries, key, args.workers)
+    for service, error in failures:
+        print(f"Failed to import {service}: {error}")
+
+
+def add_file_command(args):
+    """Store a file for a user."""
+    password = getpass("Enter your master password: ").strip()
+    key = login_user(args.username, password)
+    if key:
+        add_file(
+            args.username, args.service, args.file, key, args.image, args.compression
+        )
+
+
+def get_file_command(args):
+    """Extract a stored file for a user."""
+    password = getpass("Enter your master password: ").strip()
+    key = login_user(args.username, password)
+    if key:
+        get_file(args.username, args.service, key, args.output)
+
+
+def rekey_command(args):
+    """Change a user's master password, re-encrypting every service."""
+    if args.abort:
+        password = getpass("Enter your current master password: ").strip()
+        abort_rekey(args.username, password)
+        return
+    old_password = getpass("Enter your current master password: ").strip()
+    new_password = getpass("Enter a new master password: ").strip()
+    if getpass("Repeat the new master password: ").strip() != new_password:
+        print("Passwords do not match.")
+        return
+    rekey_user(args.username, old_password, new_password, args.workers)
+
+
+def verify_command(args):
+    """Check every service of a user; exits with status 1 if anything is wrong."""
+    password = getpass("Enter your master password: ").strip()
+    key = login_user(args.username, password)
+    if not key:
+        raise SystemExit(1)
+    report = verify_user(args.username, key, args.workers, args.full)
+    for service, error in report["broken"]:
+        print(f"Broken: {service}: {error}")
+    for service in report["missing"]:
+        print(f"Missing image: {service}")
+    for path in report["orphaned"]:
+        print(f"Orphaned: {path}")
+    print(
+        f"Checked {report['checked']} images, {report['cached']} unchanged since "
+        f"the last scan: {len(report['broken'])} broken, "
+        f"{len(report['missing'])} missing, {len(report['orphaned'])} orphaned."
+    )
+    if report["broken"] or report["missing"]:
+        raise SystemExit(1)
+
+
+def import_image_command(args):
+    """Add a carrier image for a user."""
+    import_image(args.username, args.file, args.name)
+
+
+def gc_command(args):
+    """Deduplicate carrier images and delete unused stored ones."""
+    collect_images()
+
+
+def backup_command(args):
+    """Back up a user to an archive."""
+    backup_user(args.username, args.archive, args.base)
+
+
+def restore_command(args):
+    """Restore a user from an archive."""
+    restore_user(args.archive, args.replace)
+
+
+def calibrate_command(args):
+    """Pick KDF parameters that hit the target login time on this machine."""
+    params = enc.calibrate_kdf(args.kdf, args.target_ms / 1000)
+    elapsed = enc.time_kdf(params)
+    save_kdf_params(params)
+    print(f"Using {enc.format_kdf_params(params)} ({elapsed * 1000:.0f} ms).")
+    print("Existing key files are upgraded on their next login.")
+
+
+def parse_args(argv=None):
+    """Parse command line arguments; no subcommand starts the interactive menu."""
+    parser = argparse.ArgumentParser(description="StegaPass password manager")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Log the time spent in each stage and print a summary on exit",
+    )
+    parser.add_argument(
+        "--profile-json",
+        metavar="FILE",
+        default=None,
+        help="Also write the per-stage timing histogram to a JSON file",
+    )
+    parser.add_argument(
+        "--save-profile",
+        choices=sorted(steg.SAVE_PROFILES),
+        default=SaveProfile,
+        help="Output format for new stego images: 'fast' for quick saves, "
+        "'small' for archival, or a specific lossless format",
+    )
+    parser.add_argument(
+        "--bits-per-channel",
+        type=int,
+        choices=range(1, steg.MAX_BITS_PER_CHANNEL + 1),
+        default=BitsPerChannel,
+        help="Low bits per channel in new stego images; more bits hold more data",
+    )
+    parser.add_argument(
+        "--channel-mask",
+        type=lambda value: int(value, 0),
+        default=ChannelMask,
+        help="Channels used in new stego images, e.g. 0b0111 to skip alpha",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help="Cache decrypted passwords for this many seconds during a session",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    import_parser = subparsers.add_parser(
+        "import", help="Bulk import services from a CSV or JSON file"
+    )
+    import_parser.add_argument("username")
+    import_parser.add_argument(
+        "file",
+        help="CSV with service (or name) and password columns and an optional "
+        "image column, or a JSON list of such objects",
+    )
+    import_parser.add_argument(
+        "--workers", type=int, default=None, help="Number of worker processes"
+    )
+    import_parser.set_defaults(func=import_command)
+
+    add_file_parser = subparsers.add_parser(
+        "add-file", help="Store a file such as an SSH key or recovery codes"
+    )
+    add_file_parser.add_argument("username")
+    add_file_parser.add_argument("service")
+    add_file_parser.add_argument("file")
+    add_file_parser.add_argument("image", help="Image name to embed the file into")
+    add_file_parser.add_argument(
+        "--compression", choices=enc.COMPRESSIONS, default="zlib"
+    )
+    add_file_parser.set_defaults(func=add_file_command)
+
+    get_file_parser = subparsers.add_parser("get-file", help="Extract a stored file")
+    get_file_parser.add_argument("username")
+    get_file_parser.add_argument("service")
+    get_file_parser.add_argument(
+        "--output", default=None, help="Path to write to; defaults to the file name"
+    )
+    get_file_parser.set_defaults(func=get_file_command)
+
+    rekey_parser = subparsers.add_parser(
+        "rekey", help="Change a master password and re-encrypt every service"
+    )
+    rekey_parser.add_argument("username")
+    rekey_parser.add_argument(
+        "--workers", type=int, default=None, help="Number of worker processes"
+    )
+    rekey_parser.add_argument(
+        "--abort",
+        action="store_true",
+        help="Discard an unfinished change that has not been committed yet",
+    )
+    rekey_parser.set_defaults(func=rekey_command)
+
+    verify_parser = subparsers.add_parser(
+        "verify", help="Decode and authenticate every service and report broken ones"
+    )
+    verify_parser.add_argument("username")
+    verify_parser.add_argument(
+        "--workers", type=int, default=None, help="Number of worker processes"
+    )
+    verify_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Re-check images that have not changed since the last scan",
+    )
+    verify_parser.set_defaults(func=verify_command)
+
+    import_image_parser = subparsers.add_parser(
+        "import-image", help="Add a PNG carrier image to a user's OriginalImages"
+    )
+    import_image_parser.add_argument("username")
+    import_image_parser.add_argument("file")
+    import_image_parser.add_argument(
+        "--name", default=None, help="Image name; defaults to the file name"
+    )
+    import_image_parser.set_defaults(func=import_image_command)
+
+    gc_parser = subparsers.add_parser(
+        "gc", help="Deduplicate carrier images and delete unused stored ones"
+    )
+    gc_parser.set_defaults(func=gc_command)
+
+    backup_parser = subparsers.add_parser(
+        "backup", help="Back up a user's key, services and stego images"
+    )
+    backup_parser.add_argument("username")
+    backup_parser.add_argument("archive", help="Archive file to write")
+    backup_parser.add_argument(
+        "--base",
+        default=None,
+        help="Previous archive; only files changed since it are stored",
+    )
+    backup_parser.set_defaults(func=backup_command)
+
+    restore_parser = subparsers.add_parser(
+        "restore", help="Restore the user of a backup archive"
+    )
+    restore_parser.add_argument(
+        "archive", help="Newest archive; the ones it builds on must be next to it"
+    )
+    restore_parser.add_argument(
+        "--replace", action="store_true", help="Replace the user if it exists"
+    )
+    restore_parser.set_defaults(func=restore_command)
+
+    calibrate_parser = subparsers.add_parser(
+        "calibrate", help="Tune the key derivation to a target login time"
+    )
+    calibrate_parser.add_argument("--kdf", choices=enc.KDFS, default="pbkdf2")
+    calibrate_parser.add_argument(
+        "--target-ms", type=float, default=250, help="Target login time in ms"
+    )
+    calibrate_parser.set_defaults(func=calibrate_command)
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    main_menu()
+    args = parse_args()
+    SaveProfile = args.save_profile
+    BitsPerChannel = args.bits_per_channel
+    ChannelMask = args.channel_mask
+    histogram = None
+    if args.profile or args.profile_json:
+        add_sink(LogSink())
+        histogram = add_sink(HistogramSink())
+    try:
+        if args.command:
+            args.func(args)
+        else:
+            warm_up()
+            main_menu(args.cache_ttl)
+    finally:
+        if histogram is not None:
+            print(histogram.summary())
+            if args.profile_json:
+                histogram.export_json(args.profile_json)
@@ -0,0 +1,81 @@
+import json
+import os
+
+from instrumentation import span
+from lazy import lazy_import
+
+Image = lazy_import("PIL.Image")
+
+
+def _read_entry(path: str, stat) -> dict:
+    """
+    Reads the size and mode of an image from its header, without decoding pixels.
+
+    Files Pillow cannot open get an entry with mode None, so they are not
+    opened again until they change.
+    """
+    entry = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            bands = len(image.getbands())
+            entry.update(
+                width=width,
+                height=height,
+                mode=image.mode,
+                capacity_bits=width * height * bands,
+            )
+    except (OSError, Image.UnidentifiedImageError):
+        entry.update(width=0, height=0, mode=None, capacity_bits=0)
+    return entry
+
+
+def load_manifest(image_dir: str, manifest_path: str) -> dict:
+    """
+    Returns the capacity manifest of every file in an image directory.
+
+    Entries are cached in a JSON file keyed by file name and reused while
+    the file's mtime and size are unchanged; only new or modified files are
+    opened, and only their headers are read. The cache is rewritten
+    atomically when anything changed.
+
+    Args:
+        image_dir (str): The directory holding the carrier images.
+        manifest_path (str): The path of the JSON cache.
+
+    Returns:
+        dict: A mapping of file name to an entry with "mtime_ns", "size",
+            "width", "height", "mode" (None for files that are not images)
+            and "capacity_bits", the number of pixel values.
+    """
+    cached = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r") as f:
+                cached = json.load(f)
+        except json.JSONDecodeError:
+            cached = {}
+
+    manifest = {}
+    changed = False
+    with span("manifest.scan"), os.scandir(image_dir) as it:
+        for item in it:
+            if not item.is_file():
+                continue
+            stat = item.stat()
+            entry = cached.get(item.name)
+            if (
+                entry is None
+                or entry["mtime_ns"] != stat.st_mtime_ns
+                or entry["size"] != stat.st_size
+            ):
+                entry = _read_entry(item.path, stat)
+                changed = True
+            manifest[item.name] = entry
+
+    if changed or manifest.keys() != cached.keys():
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_path, manifest_path)
+    return manifest
@@ -0,0 +1,179 @@
+import heapq
+
+# Key under which a trie node marks the end of a name
+_END = None
+
+
+def _normalize(name: str) -> str:
+    """Return the form names are matched in: case-folded, surrounding space removed."""
+    return name.strip().casefold()
+
+
+def _trigrams(key: str) -> set:
+    """Split a normalized name into trigrams, padded so short names still have some."""
+    padded = f"  {key} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class ServiceIndex:
+    """
+    In-memory search index over service names.
+
+    A trie answers prefix queries and a trigram index answers fuzzy ones.
+    Both match case-insensitively and are updated as services are added and
+    removed, so queries never touch services.json or any image.
+    """
+
+    def __init__(self, names=()):
+        """
+        Builds the index.
+
+        Args:
+            names (Iterable[str]): The service names to index.
+        """
+        self._trie = {}
+        self._postings = {}
+        self._names = {}
+        self._sizes = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return sum(len(names) for names in self._names.values())
+
+    def __contains__(self, name: str):
+        return name in self._names.get(_normalize(name), ())
+
+    def add(self, name: str):
+        """Index a service name; adding it again does nothing."""
+        key = _normalize(name)
+        names = self._names.get(key)
+        if names is not None:
+            names.add(name)
+            return
+        self._names[key] = {name}
+
+        node = self._trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[_END] = True
+
+        trigrams = _trigrams(key)
+        self._sizes[key] = len(trigrams)
+        for trigram in trigrams:
+            self._postings.setdefault(trigram, set()).add(key)
+
+    def remove(self, name: str):
+        """Drop a service name from the index, if it is there."""
+        key = _normalize(name)
+        names = self._names.get(key)
+        if names is None or name not in names:
+            return
+        names.discard(name)
+        if names:
+            return
+        del self._names[key]
+        del self._sizes[key]
+
+        # Walk down recording the path, then prune nodes left empty
+        path = [self._trie]
+        for char in key:
+            path.append(path[-1][char])
+        del path[-1][_END]
+        for depth in range(len(key), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][key[depth - 1]]
+
+        for trigram in _trigrams(key):
+            postings = self._postings[trigram]
+            postings.discard(key)
+            if not postings:
+                del self._postings[trigram]
+
+    def _expand(self, keys):
+        """Map normalized keys back to the service names, in order."""
+        return [name for key in keys for name in sorted(self._names[key])]
+
+    def prefix(self, query: str, limit: int = 10):
+        """
+        Finds the service names starting with a query.
+
+        Args:
+            query (str): The prefix, matched case-insensitively.
+            limit (int): The maximum number of names returned.
+
+        Returns:
+            list[str]: Up to `limit` names, shortest and then alphabetically first.
+        """
+        node = self._trie
+        for char in _normalize(query):
+            node = node.get(char)
+            if node is None:
+                return []
+
+        # Breadth first, so shorter completions come before longer ones
+        keys = []
+        level = [(_normalize(query), node)]
+        while level and len(keys) < limit:
+            next_level = []
+            for key, node in level:
+                if _END in node:
+                    keys.append(key)
+                next_level.extend(
+                    (key + char, child)
+                    for char, child in sorted(
+                        (c, n) for c, n in node.items() if c is not _END
+                    )
+                )
+            level = next_level
+        return self._expand(keys)[:limit]
+
+    def fuzzy(self, query: str, limit: int = 10, min_score: float = 0.2):
+        """
+        Finds the service names most similar to a query, tolerating typos.
+
+        Similarity is the Jaccard index of the padded trigram sets.
+
+        Args:
+            query (str): The query, matched case-insensitively.
+            limit (int): The maximum number of names returned.
+            min_score (float): The lowest similarity returned, from 0 to 1.
+
+        Returns:
+            list[str]: Up to `limit` names, most similar first.
+        """
+        trigrams = _trigrams(_normalize(query))
+        shared = {}
+        for trigram in trigrams:
+            for key in self._postings.get(trigram, ()):
+                shared[key] = shared.get(key, 0) + 1
+
+        scored = []
+        for key, count in shared.items():
+            score = count / (len(trigrams) + self._sizes[key] - count)
+            if score >= min_score:
+                scored.append((score, key))
+        best = heapq.nsmallest(limit, scored, key=lambda s: (-s[0], s[1]))
+        return self._expand(key for _, key in best)[:limit]
+
+    def search(self, query: str, limit: int = 10):
+        """
+        Finds service names for an as-you-type query.
+
+        Prefix matches come first, followed by fuzzy matches.
+
+        Args:
+            query (str): The text typed so far.
+            limit (int): The maximum number of names returned.
+
+        Returns:
+            list[str]: Up to `limit` distinct names.
+        """
+        if not _normalize(query):
+            return []
+        names = self.prefix(query, limit)
+        if len(names) < limit:
+            seen = set(names)
+            names += [n for n in self.fuzzy(query, limit) if n not in seen]
+        return names[:limit]
@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import socket
+
+import main
+from async_api import AsyncStegaPass
+from instrumentation import span
+
+SocketPath = "stegapass.sock"
+
+
+class ServerError(Exception):
+    """An error reported by the vault server in reply to a request."""
+
+
+class VaultServer:
+    """
+    Serves register, login, add, get and search to local clients.
+
+    Requests and replies are JSON objects, one per line. Session keys stay in
+    this process; the work is done by an AsyncStegaPass, which runs key
+    derivation, encryption and steganography in a process pool, serializes
+    writes per user and coalesces concurrent reads and adds.
+    """
+
+    def __init__(self, workers: int = None):
+        """
+        Creates the server and its worker pool.
+
+        Args:
+            workers (int): The number of worker processes. Defaults to the
+                number of CPUs.
+        """
+        self.api = AsyncStegaPass(workers)
+        self.sessions = {}
+        self.handlers = {
+            "register": self.register,
+            "login": self.login,
+            "logout": self.logout,
+            "add": self.add,
+            "get": self.get,
+            "search": self.search,
+        }
+
+    def _session(self, session: str):
+        """Return the user name and key of a session."""
+        try:
+            return self.sessions[session]
+        except KeyError:
+            raise ValueError("Not logged in.") from None
+
+    async def register(self, username: str, password: str):
+        main.check_username(username)
+        if await self.api.register_user(username, password) is None:
+            raise ValueError("User already exists.")
+        return {}
+
+    async def login(self, username: str, password: str):
+        main.check_username(username)
+        key = await self.api.login_user(username, password)
+        if key is None:
+            raise ValueError("Incorrect username or password.")
+        session = secrets.token_urlsafe(32)
+        self.sessions[session] = (username, key)
+        return {"session": session}
+
+    async def logout(self, session: str):
+        username, _ = self.sessions.pop(session, (None, None))
+        if username is not None and all(
+            u != username for u, _ in self.sessions.values()
+        ):
+            await self.api.close_vault(username)
+        return {}
+
+    async def add(self, session: str, service: str, password: str, image: str = None):
+        username, key = self._session(session)
+        await self.api.add_password(username, service, password, key, image)
+        return {}
+
+    async def get(self, session: str, service: str):
+        username, key = self._session(session)
+        # Images are replaced by an atomic rename, so reads need no lock
+        password = await self.api.get_password(username, service, key)
+        if password is None:
+            raise ValueError(f"Service {service} not found.")
+        return {"password": password}
+
+    async def search(self, session: str, query: str, limit: int = 10):
+        username, _ = self._session(session)
+        return {"services": await self.api.search_services(username, query, limit)}
+
+    async def handle(self, reader, writer):
+        """Answer the requests of one connection, in order."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    handler = self.handlers[request.pop("op")]
+                    with span(f"server.{handler.__name__}"):
+                        reply = {"ok": True, **await handler(**request)}
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e) or type(e).__name__}
+                writer.write(json.dumps(reply).encode("utf8") + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, path: str = SocketPath, port: int = None):
+        """
+        Starts listening on a Unix socket, or on localhost when a port is given.
+
+        The socket file is only accessible to the user running the server.
+
+        Returns:
+            asyncio.AbstractServer: The listening server.
+        """
+        if port is not None:
+            return await asyncio.start_server(self.handle, "127.0.0.1", port)
+        if os.path.exists(path):
+            os.remove(path)
+        old_umask = os.umask(0o177)
+        try:
+            return await asyncio.start_unix_server(self.handle, path)
+        finally:
+            os.umask(old_umask)
+
+    def close(self):
+        """Persist every open vault and stop the worker pool."""
+        for username in {u for u, _ in self.sessions.values()}:
+            main.close_user_vault(username)
+        self.sessions.clear()
+        self.api.close()
+
+
+class Client:
+    """Blocking client for scripts, talking to a VaultServer."""
+
+    def __init__(self, path: str = SocketPath, port: int = None):
+        if port is not None:
+            self.sock = socket.create_connection(("127.0.0.1", port))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        self.file = self.sock.makefile("rwb")
+
+    def call(self, op: str, **params):
+        """
+        Sends a request and waits for the reply.
+
+        Raises:
+            ServerError: If the server could not carry out the request.
+
+        Returns:
+            dict: The reply fields.
+        """
+        self.file.write(json.dumps({"op": op, **params}).encode("utf8") + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ServerError("Server closed the connection.")
+        reply = json.loads(line)
+        if not reply.pop("ok"):
+            raise ServerError(reply["error"])
+        return reply
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+async def serve(args):
+    """Run the server until interrupted."""
+    server = VaultServer(args.workers)
+    listener = await server.start(args.socket, args.port)
+    where = f"127.0.0.1:{args.port}" if args.port is not None else args.socket
+    print(f"Serving on {where}.")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="StegaPass local vault server")
+    parser.add_argument("--socket", default=SocketPath, help="Unix socket path")
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=None,
+        help="Listen on this localhost TCP port instead of a Unix socket",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of worker processes"
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,15 +1,345 @@
-from numpy import array
-from PIL import Image
+import io
+import os
+import struct
+import tempfile
+import zlib
+from collections import namedtuple
 
+from instrumentation import span
+from lazy import lazy_import
 
-def encode_img(img_path, data, out_path):
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+HEADER_BITS = 32
+
+# Multi-record container: magic, version, index slots and record count,
+# followed by a fixed-size index of (record id, bit offset, bit length).
+# Version 2 adds the bits per channel and channel mask used after the header.
+CONTAINER_MAGIC = b"SGP"
+CONTAINER_VERSION = 2
+CONTAINER_HEADER = struct.Struct(">3sBHH")
+CONTAINER_HEADER_V2 = struct.Struct(">3sBHHBB")
+INDEX_ENTRY = struct.Struct(">III")
+DEFAULT_SLOTS = 32
+MAX_BITS_PER_CHANNEL = 4
+# Bytes yielded at a time when a record is streamed back out
+STREAM_PIECE = 64 * 1024
+
+ContainerHeader = namedtuple(
+    "ContainerHeader", "version slots count bits_per_channel channel_mask"
+)
+
+# Lossless output backends: Pillow save options per profile
+SAVE_PROFILES = {
+    "default": {"format": "PNG"},
+    "fast": {"format": "PNG", "compress_level": 1, "compress_type": zlib.Z_RLE},
+    "small": {"format": "PNG", "compress_level": 9, "optimize": True},
+    "webp": {"format": "WEBP", "lossless": True, "exact": True},
+    "tiff": {"format": "TIFF"},
+    "bmp": {"format": "BMP"},
+    "ppm": {"format": "PPM"},
+}
+FORMAT_EXTENSIONS = {
+    "PNG": ".png",
+    "WEBP": ".webp",
+    "TIFF": ".tiff",
+    "BMP": ".bmp",
+    "PPM": ".ppm",
+}
+# Modes each format stores without converting the pixel values
+FORMAT_MODES = {
+    "PNG": None,
+    "WEBP": ("RGB", "RGBA"),
+    "TIFF": None,
+    "BMP": ("1", "L", "P", "RGB"),
+    "PPM": ("1", "L", "RGB"),
+}
+
+
+def _source(image):
+    """
+    Normalizes an image argument so it can be opened several times.
+
+    Paths and bytes are returned as they are, other bytes-like objects become
+    bytes, file objects are read once from their current position, and pixel
+    arrays are checked and used directly, without encoding them.
+
+    Raises:
+        ValueError: If a pixel array is not a 2D or 3D array of uint8 values.
+    """
+    if isinstance(image, (str, bytes, os.PathLike)):
+        return image
+    if isinstance(image, (bytearray, memoryview)):
+        return bytes(image)
+    if hasattr(image, "read"):
+        return image.read()
+    if isinstance(image, np.ndarray):
+        if image.dtype != np.uint8 or image.ndim not in (2, 3):
+            raise ValueError("Pixel arrays must be 2D or 3D arrays of uint8.")
+        return image
+    raise TypeError(f"Cannot read an image from {type(image).__name__}.")
+
+
+def _open(src):
+    """Open a normalized image source with Pillow, without decoding it."""
+    if isinstance(src, bytes):
+        # BytesIO shares the bytes object instead of copying it
+        return Image.open(io.BytesIO(src))
+    return Image.open(src)
+
+
+def _open_leading(img_path, count):
+    """
+    Opens an image so that only the leading rows holding `count` values get decoded.
+
+    Non-interlaced PNGs are decoded row by row, so the image is cut down to the
+    rows that cover the first `count` pixel values before it is loaded. Other
+    formats are loaded in full.
+
+    Args:
+        img_path (str | bytes | numpy.ndarray): An image normalized by _source.
+        count (int): The number of leading pixel values that are needed.
+
+    Returns:
+        PIL.Image.Image: The opened, possibly cropped, image.
+    """
+    image = _open(img_path)
+    width, height = image.size
+    row_len = width * len(image.getbands())
+    rows = min(height, max(1, -(-count // row_len)))
+
+    tile = image.tile[0] if len(image.tile) == 1 else None
+    if (
+        rows < height
+        and tile is not None
+        and image.format == "PNG"
+        and not image.info.get("interlace")
+    ):
+        image._size = (width, rows)
+        image.tile = [tile[:1] + ((0, 0, width, rows),) + tile[2:]]
+    return image
+
+
+def _read_values(img_path, count):
+    """
+    Reads the leading pixel values of an image as a flat read-only array.
+
+    Args:
+        img_path (str | bytes | numpy.ndarray): An image normalized by _source.
+        count (int): The number of leading pixel values that are needed.
+
+    Returns:
+        numpy.ndarray: A one-dimensional array holding at least the first
+            `count` pixel values, or all of them if the image is smaller.
+    """
+    if isinstance(img_path, np.ndarray):
+        return img_path.ravel()
+    with span("steg.read"):
+        return np.asarray(_open_leading(img_path, count)).ravel()
+
+
+def _image_shape(img_path):
+    """
+    Reads the size of an image from its header, without decoding it.
+
+    Args:
+        img_path (str | bytes | numpy.ndarray): An image normalized by _source.
+
+    Returns:
+        tuple[int, int]: The number of pixel values (pixels times bands) in the
+            image and the number of bands.
+    """
+    if isinstance(img_path, np.ndarray):
+        return img_path.size, _bands(img_path)
+    with _open(img_path) as image:
+        bands = len(image.getbands())
+        return image.width * image.height * bands, bands
+
+
+def load_pixels(image):
+    """
+    Decodes a whole image into a writable pixel array.
+
+    Args:
+        image (str | bytes | file object | numpy.ndarray): The path to the
+            image file, its contents, a binary file object to read it from,
+            or a pixel array, which is copied.
+
+    Returns:
+        numpy.ndarray: The pixel array; its ravel() is a view that can be
+            modified in place.
+    """
+    src = _source(image)
+    if isinstance(src, np.ndarray):
+        return np.array(src)
+    with span("steg.open"):
+        img = _open(src)
+        img.load()
+    with span("steg.array"), img:
+        return np.array(img)
+
+
+def profile_extension(profile):
+    """
+    Returns the file extension written by a save profile.
+
+    Args:
+        profile (str | dict): A SAVE_PROFILES name, or Pillow save options
+            including "format".
+
+    Raises:
+        ValueError: If the profile is unknown.
+
+    Returns:
+        str: The extension, e.g. ".png".
+    """
+    return FORMAT_EXTENSIONS[_resolve_profile(profile)["format"]]
+
+
+def _resolve_profile(profile):
+    """Look up a profile by name, or validate a dict of save options."""
+    if isinstance(profile, dict):
+        options = profile
+    elif profile in SAVE_PROFILES:
+        options = SAVE_PROFILES[profile]
+    else:
+        raise ValueError(f"Unknown save profile {profile!r}.")
+    if options.get("format") not in FORMAT_EXTENSIONS:
+        raise ValueError(f"Unsupported output format {options.get('format')!r}.")
+    return options
+
+
+def _save_options(out_path, profile):
+    """
+    Picks the Pillow save options for an output path.
+
+    Without a profile the format follows the extension, using the default
+    profile for PNG.
+
+    Raises:
+        ValueError: If the profile is unknown or does not match the extension.
+    """
+    ext = os.path.splitext(out_path)[1].lower()
+    if profile is None:
+        formats = [f for f, e in FORMAT_EXTENSIONS.items() if e == ext]
+        if not formats:
+            raise ValueError(f"No lossless output format for {ext!r} files.")
+        profile = "default" if formats[0] == "PNG" else formats[0].lower()
+    options = dict(_resolve_profile(profile))
+    if FORMAT_EXTENSIONS[options["format"]] != ext:
+        raise ValueError(f"Save profile writes {options['format']}, not {ext!r}.")
+    return options
+
+
+def save_pixels(pixels, out_path, profile=None):
+    """
+    Saves a pixel array as an image file with a lossless output backend.
+
+    Args:
+        pixels (numpy.ndarray): The pixel array.
+        out_path (str | file object): The path to save the image, or a
+            writable binary file object to write it to.
+        profile (str | dict): A SAVE_PROFILES name or Pillow save options.
+            Defaults to the format matching the extension of out_path, or
+            the default PNG profile for file objects.
+
+    Raises:
+        ValueError: If the format would not store the pixel values unchanged.
+
+    Returns:
+        None
+    """
+    if hasattr(out_path, "write"):
+        options = dict(_resolve_profile(profile or "default"))
+    else:
+        options = _save_options(out_path, profile)
+    image = Image.fromarray(pixels)
+    modes = FORMAT_MODES[options["format"]]
+    if modes is not None and image.mode not in modes:
+        raise ValueError(f"{options['format']} cannot store {image.mode} images.")
+    if hasattr(out_path, "write"):
+        with span("steg.save"):
+            image.save(out_path, **options)
+        return
+    # Write next to the target and rename, so readers never see a partial
+    # image; the name is unique, so concurrent writers never share it
+    fd, tmp_path = tempfile.mkstemp(
+        suffix=".tmp",
+        prefix=os.path.basename(out_path) + ".",
+        dir=os.path.dirname(out_path) or ".",
+    )
+    os.close(fd)
+    try:
+        with span("steg.save"):
+            image.save(tmp_path, **options)
+            os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def image_bytes(pixels, profile=None):
+    """
+    Encodes a pixel array as an image file in memory.
+
+    Args:
+        pixels (numpy.ndarray): The pixel array.
+        profile (str | dict): A SAVE_PROFILES name or Pillow save options.
+            Defaults to the default PNG profile.
+
+    Raises:
+        ValueError: If the format would not store the pixel values unchanged.
+
+    Returns:
+        bytes: The contents of the image file.
+    """
+    buffer = io.BytesIO()
+    save_pixels(pixels, buffer, profile)
+    return buffer.getvalue()
+
+
+def _to_bits(data):
+    """
+    Converts bytes into a flat array of bits, most significant bit first.
+
+    Args:
+        data (bytes): The bytes to convert.
+
+    Returns:
+        numpy.ndarray: A uint8 array holding one bit per element.
+    """
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+
+
+def _embed_bits(flat_pixels, bits, start=0):
+    """
+    Writes bits into the least significant bits of a flat pixel array in place.
+
+    Args:
+        flat_pixels (numpy.ndarray): A one-dimensional view of the pixel values.
+        bits (numpy.ndarray): The bits to write, one per element.
+        start (int): The index of the first pixel value to modify.
+
+    Returns:
+        None
+    """
+    region = flat_pixels[start : start + bits.size]
+    # & 254 clears the LSB and | bits sets it, for the whole region at once
+    region &= 254
+    region |= bits.astype(region.dtype, copy=False)
+
+
+def encode_img(img_path, data, out_path, profile=None):
     """
     Encodes binary data into the least significant bits of each pixel in an image.
 
     Args:
-        img_path (str): The path to the image file.
+        img_path (str | bytes | file object | numpy.ndarray): The carrier
+            image; see encode_records.
         data (bytes): The binary data to encode.
-        out_path (str): The path to save the encoded image.
+        out_path (str | file object): Where to save the encoded image.
+        profile (str | dict): The save profile; see SAVE_PROFILES.
 
     Raises:
         ValueError: If the data is too large to fit in the given image.
@@ -17,71 +347,883 @@ def encode_img(img_path, data, out_path):
     Returns:
         None
     """
-    img = Image.open(img_path)
-    pixels = array(img)
-
-    # Flattening the pixels array
-    flat_pixels = pixels.flatten()
-    flat_pixels_len = len(flat_pixels)
+    pixels = load_pixels(img_path)
 
-    # Converting byte data to binary string
-    bin_data = "".join([format(byte, "08b") for byte in data])
-    data_len = len(bin_data)
+    # Flat view of the pixels array, modified in place
+    flat_pixels = pixels.ravel()
+    data_len = len(data) * 8
 
     # Ensure the data is not too large to fit in the img
-    if data_len + 32 > flat_pixels_len:
+    if data_len + HEADER_BITS > flat_pixels.size:
         raise ValueError("Data is too large to fit in the given image.")
 
-    # Encoding Data length in first 32 bits
-    bin_data_len = bin(data_len)[2:].rjust(32, "0")
-    for i in range(32):
-        flat_pixels[i] = (flat_pixels[i] & 254) | int(bin_data_len[i])
+    # Data length in the first 32 bits, followed by the data itself
+    header = data_len.to_bytes(HEADER_BITS // 8, "big")
+    with span("steg.embed"):
+        _embed_bits(flat_pixels, _to_bits(header + bytes(data)))
 
-    # Encode data in LSB of each pixel after 32 bits
-    for i in range(32, data_len + 32):
-        # Modify the LSB of the current pixel with the current bit of data
-        # & 254 clears the LSB and | int(bin_data[i - 32]) sets the LSB
-        flat_pixels[i] = (flat_pixels[i] & 254) | int(bin_data[i - 32])
+    save_pixels(pixels, out_path, profile)
 
-    # Reshape the array back to its original shape
-    encoded_pixels = flat_pixels.reshape(pixels.shape)
 
-    encoded_img = Image.fromarray(encoded_pixels)
-    encoded_img.save(out_path)
+def _extract_bits(flat_pixels, start, count):
+    """
+    Reads bits from the least significant bits of a flat pixel array.
+
+    Args:
+        flat_pixels (numpy.ndarray): A one-dimensional view of the pixel values.
+        start (int): The index of the first pixel value to read.
+        count (int): The number of bits to read.
+
+    Returns:
+        bytes: The bits packed into bytes, most significant bit first.
+    """
+    return np.packbits(flat_pixels[start : start + count] & 1).tobytes()
+
+
+def _read_header(flat_pixels, total):
+    """
+    Reads and validates the 32-bit data length header of an encoded image.
+
+    Args:
+        flat_pixels (numpy.ndarray): A one-dimensional view of the leading pixel values.
+        total (int): The number of pixel values in the whole image.
+
+    Raises:
+        ValueError: If the header claims more bits than the image holds.
+
+    Returns:
+        int: The number of data bits following the header.
+    """
+    if total < HEADER_BITS:
+        raise ValueError("Image is too small to hold a header.")
+    data_len = int.from_bytes(_extract_bits(flat_pixels, 0, HEADER_BITS), "big")
+    if data_len % 8 or data_len + HEADER_BITS > total:
+        raise ValueError("Image header is corrupt or the image holds no data.")
+    return data_len
 
 
 def decode_img(img_path):
     """
     Decodes binary data from the least significant bits of each pixel in an image.
 
+    Only the leading rows that hold the header and the data are decoded, so the
+    cost depends on the size of the data rather than the size of the image.
+
     Args:
-        img_path (str): The path to the image file.
-        data_len (int): The length of the binary data to decode.
+        img_path (str | bytes | file object | numpy.ndarray): The image: a
+            path, the file's contents, a binary file object or a pixel array,
+            which is read without encoding.
 
     Raises:
-        None
+        ValueError: If the image header is corrupt.
 
     Returns:
         bytes: The decoded binary data.
     """
-    image = Image.open(img_path)
-    pixels = array(image)
+    img_path = _source(img_path)
+    total, _ = _image_shape(img_path)
+    data_len = _read_header(_read_values(img_path, HEADER_BITS), total)
+    flat_pixels = _read_values(img_path, HEADER_BITS + data_len)
+    return _extract_bits(flat_pixels, HEADER_BITS, data_len)
+
+
+def _pack_header(header):
+    """
+    Packs a container header into bytes.
+
+    Args:
+        header (ContainerHeader): The header to pack.
+
+    Returns:
+        bytes: The packed header, in the layout of its version.
+    """
+    if header.version == 1:
+        return CONTAINER_HEADER.pack(CONTAINER_MAGIC, 1, header.slots, header.count)
+    return CONTAINER_HEADER_V2.pack(
+        CONTAINER_MAGIC,
+        header.version,
+        header.slots,
+        header.count,
+        header.bits_per_channel,
+        header.channel_mask,
+    )
+
+
+def _parse_container_header(flat_pixels):
+    """
+    Reads and validates the header of a multi-record container.
+
+    The header is always stored in the LSB of the leading pixel values,
+    whatever the bits per channel used for the records.
+
+    Args:
+        flat_pixels (numpy.ndarray): A one-dimensional view of the leading pixel values.
+
+    Raises:
+        ValueError: If the image does not hold a supported container.
+
+    Returns:
+        ContainerHeader: The parsed header.
+    """
+    raw = _extract_bits(flat_pixels, 0, CONTAINER_HEADER_V2.size * 8)
+    if len(raw) < CONTAINER_HEADER.size:
+        raise ValueError("Image is too small to hold a container.")
+    magic, version, slots, count = CONTAINER_HEADER.unpack(raw[: CONTAINER_HEADER.size])
+    if magic != CONTAINER_MAGIC:
+        raise ValueError("Image does not hold a stego container.")
+
+    if version == 1:
+        bits_per_channel, channel_mask = 1, None
+    elif version == 2:
+        if len(raw) < CONTAINER_HEADER_V2.size:
+            raise ValueError("Image is too small to hold a container.")
+        *_, bits_per_channel, channel_mask = CONTAINER_HEADER_V2.unpack(raw)
+        if not 1 <= bits_per_channel <= MAX_BITS_PER_CHANNEL or not channel_mask:
+            raise ValueError("Container header is corrupt.")
+    else:
+        raise ValueError(f"Unsupported container version {version}.")
+    if count > slots:
+        raise ValueError("Container header is corrupt.")
+    return ContainerHeader(version, slots, count, bits_per_channel, channel_mask)
+
+
+def _stream_layout(header, bands):
+    """
+    Works out where and how the index and records of a container are stored.
+
+    Version 1 containers use the LSB of every pixel value from the first one,
+    header included. Version 2 containers start after the header, on a pixel
+    boundary, and use the low bits_per_channel bits of the channels in
+    channel_mask.
+
+    Args:
+        header (ContainerHeader): The container header.
+        bands (int): The number of values per pixel.
+
+    Raises:
+        ValueError: If the channel mask selects channels the image lacks.
+
+    Returns:
+        tuple[int, tuple[int, ...], int]: The first pixel value of the stream,
+            the channels used in each pixel and the bits used per channel.
+    """
+    if header.version == 1:
+        return 0, tuple(range(bands)), 1
+    if header.channel_mask >> bands:
+        raise ValueError("Container channel mask does not match the image.")
+    start = -(-CONTAINER_HEADER_V2.size * 8 // bands) * bands
+    channels = tuple(c for c in range(bands) if header.channel_mask >> c & 1)
+    return start, channels, header.bits_per_channel
+
+
+def _index_start(header):
+    """Return the stream bit offset of a container's index."""
+    return CONTAINER_HEADER.size * 8 if header.version == 1 else 0
+
+
+def _records_start(header):
+    """Return the stream bit offset at which a container's first record starts."""
+    return _index_start(header) + header.slots * INDEX_ENTRY.size * 8
+
+
+def _stream_capacity(layout, bands, total):
+    """Return the number of stream bits an image with `total` values can hold."""
+    start, channels, bits_per_channel = layout
+    return max(0, (total - start) // bands) * len(channels) * bits_per_channel
+
+
+def _stream_values_needed(layout, bands, end):
+    """Return how many leading pixel values hold the stream bits before `end`."""
+    start, channels, bits_per_channel = layout
+    end_slot = -(-end // bits_per_channel)
+    return start + -(-end_slot // len(channels)) * bands
+
+
+def _is_plain(layout, bands):
+    """Check whether a stream layout is the LSB of every value in order."""
+    _, channels, bits_per_channel = layout
+    return bits_per_channel == 1 and len(channels) == bands
+
+
+def _stream_block(flat_pixels, layout, bands, offset, count):
+    """
+    Locates the pixels and channel values holding a range of stream bits.
+
+    Returns:
+        tuple: The (pixels, bands) view of the covering pixels, the index of
+            the first and the end slot within their selected values, and the
+            bit offset of the range within the first slot.
+    """
+    start, channels, bits_per_channel = layout
+    first_slot = offset // bits_per_channel
+    end_slot = -(-(offset + count) // bits_per_channel)
+    first_pixel = first_slot // len(channels)
+    end_pixel = -(-end_slot // len(channels))
+    block = flat_pixels[start + first_pixel * bands : start + end_pixel * bands]
+    base = first_pixel * len(channels)
+    skip = offset - first_slot * bits_per_channel
+    return block.reshape(-1, bands), first_slot - base, end_slot - base, skip
+
+
+def _select_channels(block, channels):
+    """Return the selected channels of a (pixels, bands) block, as a view if all are used."""
+    if len(channels) == block.shape[1]:
+        return block
+    return block[:, channels]
+
+
+def _slot_bits(values, bits_per_channel):
+    """Split the low bits of each value into rows of bits, most significant first."""
+    if values.dtype == np.uint8:
+        bits = np.unpackbits(values[:, None], axis=1)[:, 8 - bits_per_channel :]
+        return np.ascontiguousarray(bits)
+    shifts = np.arange(bits_per_channel - 1, -1, -1)
+    return ((values[:, None] >> shifts) & 1).astype(np.uint8)
+
+
+def _slot_values(slot_bits, bits_per_channel):
+    """Join rows of bits, most significant first, back into small integers."""
+    return np.packbits(slot_bits, axis=1)[:, 0] >> (8 - bits_per_channel)
+
+
+def _slots_from_bytes(data, bits_per_channel):
+    """Split bytes into bits_per_channel-wide slot values, for widths dividing 8."""
+    per_byte = 8 // bits_per_channel
+    shifts = np.arange(per_byte - 1, -1, -1, dtype=np.uint8) * bits_per_channel
+    data = np.frombuffer(data, dtype=np.uint8)
+    return ((data[:, None] >> shifts) & ((1 << bits_per_channel) - 1)).ravel()
+
+
+def _bytes_from_slots(values, bits_per_channel):
+    """Join the low bits of slot values back into bytes, for widths dividing 8."""
+    per_byte = 8 // bits_per_channel
+    shifts = np.arange(per_byte - 1, -1, -1, dtype=np.uint8) * bits_per_channel
+    low = (values & ((1 << bits_per_channel) - 1)).astype(np.uint8)
+    return np.bitwise_or.reduce(low.reshape(-1, per_byte) << shifts, axis=1).tobytes()
+
+
+def _stream_read(flat_pixels, layout, bands, offset, count):
+    """
+    Reads a range of stream bits as bytes.
+
+    Args:
+        flat_pixels (numpy.ndarray): A one-dimensional view of the leading pixel values.
+        layout (tuple): The stream layout from _stream_layout.
+        bands (int): The number of values per pixel.
+        offset (int): The stream bit offset to read from.
+        count (int): The number of bits to read, a multiple of 8.
+
+    Returns:
+        bytes: The bits packed into bytes.
+    """
+    if _is_plain(layout, bands):
+        return _extract_bits(flat_pixels, layout[0] + offset, count)
+    _, channels, bits_per_channel = layout
+    block, first, end, skip = _stream_block(flat_pixels, layout, bands, offset, count)
+    values = _select_channels(block, channels).ravel()[first:end]
+    if skip == 0 and 8 % bits_per_channel == 0:
+        return _bytes_from_slots(values, bits_per_channel)
+    bits = _slot_bits(values, bits_per_channel).ravel()
+    return np.packbits(bits[skip : skip + count]).tobytes()
+
+
+def _stream_write(flat_pixels, layout, bands, offset, data):
+    """
+    Writes bytes into a range of stream bits in place.
+
+    Only the pixels covering the range are touched; bits of partially
+    covered slots outside the range keep their value.
+
+    Args:
+        flat_pixels (numpy.ndarray): A writable one-dimensional view of the pixel values.
+        layout (tuple): The stream layout from _stream_layout.
+        bands (int): The number of values per pixel.
+        offset (int): The stream bit offset to write at.
+        data (bytes): The bytes to write.
+
+    Returns:
+        None
+    """
+    bits = _to_bits(data)
+    if _is_plain(layout, bands):
+        _embed_bits(flat_pixels, bits, layout[0] + offset)
+        return
+    _, channels, bits_per_channel = layout
+    block, first, end, skip = _stream_block(
+        flat_pixels, layout, bands, offset, bits.size
+    )
+    selected = _select_channels(block, channels).reshape(-1)
+    values = selected[first:end]
+
+    if skip == 0 and 8 % bits_per_channel == 0:
+        # Whole bytes split evenly into slots, so no existing bits survive
+        low = _slots_from_bytes(data, bits_per_channel)
+    else:
+        slot_bits = _slot_bits(values, bits_per_channel)
+        slot_bits.reshape(-1)[skip : skip + bits.size] = bits
+        low = _slot_values(slot_bits, bits_per_channel)
+
+    keep = np.iinfo(values.dtype).max ^ ((1 << bits_per_channel) - 1)
+    values &= values.dtype.type(keep)
+    values |= low.astype(values.dtype)
+    if len(channels) < bands:
+        block[:, channels] = selected.reshape(-1, len(channels))
+
+
+def _parse_index(flat_pixels, total, bands):
+    """
+    Reads the record index of a multi-record container.
+
+    Args:
+        flat_pixels (numpy.ndarray): A one-dimensional view of the leading pixel
+            values, covering at least the header and the index.
+        total (int): The number of pixel values in the whole image.
+        bands (int): The number of values per pixel.
+
+    Raises:
+        ValueError: If the container or one of its index entries is corrupt.
+
+    Returns:
+        tuple[ContainerHeader, dict[int, tuple[int, int]]]: The header and a
+            mapping of record id to (stream bit offset, bit length).
+    """
+    header = _parse_container_header(flat_pixels)
+    layout = _stream_layout(header, bands)
+    capacity = _stream_capacity(layout, bands, total)
+    table = _stream_read(
+        flat_pixels,
+        layout,
+        bands,
+        _index_start(header),
+        header.count * INDEX_ENTRY.size * 8,
+    )
+
+    index = {}
+    for record_id, offset, length in INDEX_ENTRY.iter_unpack(table):
+        if offset < _records_start(header) or offset + length > capacity:
+            raise ValueError(f"Index entry for record {record_id} is corrupt.")
+        index[record_id] = (offset, length)
+    return header, index
+
+
+def _write_container(flat_pixels, bands, header, index, records):
+    """
+    Embeds records into a flat pixel array and rewrites the container index.
+
+    Only the new records, the header and the index are written; the bits of
+    records already present are left untouched.
+
+    Args:
+        flat_pixels (numpy.ndarray): A writable one-dimensional view of the pixel values.
+        bands (int): The number of values per pixel.
+        header (ContainerHeader): The container header.
+        index (dict[int, tuple[int, int]]): The existing records, updated in place.
+        records (list[bytes]): The records to append.
+
+    Raises:
+        ValueError: If the index is full or the records do not fit in the image.
+
+    Returns:
+        list[int]: The ids assigned to the new records.
+    """
+    if len(index) + len(records) > header.slots:
+        raise ValueError("Container index is full.")
+
+    layout = _stream_layout(header, bands)
+    end = max((o + n for o, n in index.values()), default=_records_start(header))
+    needed = end + sum(len(record) * 8 for record in records)
+    if needed > _stream_capacity(layout, bands, flat_pixels.size):
+        raise ValueError("Data is too large to fit in the given image.")
+
+    next_id = max(index, default=-1) + 1
+    ids = []
+    for record in records:
+        _stream_write(flat_pixels, layout, bands, end, record)
+        index[next_id] = (end, len(record) * 8)
+        ids.append(next_id)
+        end += len(record) * 8
+        next_id += 1
+
+    _write_index(flat_pixels, bands, header, index)
+    return ids
+
+
+def _write_stream(flat_pixels, bands, header, index, chunks):
+    """
+    Embeds one record, given as an iterable of byte chunks, into a container.
+
+    Chunks are written as they arrive, so the record is never held in memory
+    as a whole. Its length is only known, and the index only rewritten, once
+    the iterable is exhausted.
+
+    Args:
+        flat_pixels (numpy.ndarray): A writable one-dimensional view of the pixel values.
+        bands (int): The number of values per pixel.
+        header (ContainerHeader): The container header.
+        index (dict[int, tuple[int, int]]): The existing records, updated in place.
+        chunks (Iterable[bytes]): The record contents, in order.
+
+    Raises:
+        ValueError: If the index is full or the record does not fit in the image.
+
+    Returns:
+        int: The id assigned to the record.
+    """
+    if len(index) >= header.slots:
+        raise ValueError("Container index is full.")
+
+    layout = _stream_layout(header, bands)
+    capacity = _stream_capacity(layout, bands, flat_pixels.size)
+    start = max((o + n for o, n in index.values()), default=_records_start(header))
+    end = start
+    for chunk in chunks:
+        if end + len(chunk) * 8 > capacity:
+            raise ValueError("Data is too large to fit in the given image.")
+        _stream_write(flat_pixels, layout, bands, end, chunk)
+        end += len(chunk) * 8
+
+    record_id = max(index, default=-1) + 1
+    index[record_id] = (start, end - start)
+    _write_index(flat_pixels, bands, header, index)
+    return record_id
+
+
+def _write_index(flat_pixels, bands, header, index):
+    """Rewrite the header and index of a container to match `index`."""
+    layout = _stream_layout(header, bands)
+    header = header._replace(count=len(index))
+    _embed_bits(flat_pixels, _to_bits(_pack_header(header)))
+    table = b"".join(INDEX_ENTRY.pack(i, o, n) for i, (o, n) in index.items())
+    _stream_write(flat_pixels, layout, bands, _index_start(header), table)
+
+
+def _bands(pixels):
+    """Return the number of values per pixel of a pixel array."""
+    return 1 if pixels.ndim == 2 else pixels.shape[2]
+
+
+def _new_header(bands, slots, bits_per_channel, channel_mask):
+    """
+    Builds the header of a new container, validating the embedding mode.
+
+    Raises:
+        ValueError: If the bits per channel or channel mask are out of range.
+    """
+    if channel_mask is None:
+        channel_mask = (1 << bands) - 1
+    if not 1 <= bits_per_channel <= MAX_BITS_PER_CHANNEL:
+        raise ValueError(
+            f"Bits per channel must be between 1 and {MAX_BITS_PER_CHANNEL}."
+        )
+    if not 0 < channel_mask < 1 << bands:
+        raise ValueError(f"Channel mask must select some of the {bands} channels.")
+    return ContainerHeader(CONTAINER_VERSION, slots, 0, bits_per_channel, channel_mask)
+
+
+def container_capacity(
+    size, mode, slots=DEFAULT_SLOTS, bits_per_channel=1, channel_mask=None
+):
+    """
+    Computes how many bytes of records a new container can hold.
+
+    Args:
+        size (tuple[int, int]): The image width and height.
+        mode (str): The Pillow image mode.
+        slots (int): The number of records the index can hold.
+        bits_per_channel (int): The number of low bits used per channel value.
+        channel_mask (int): The channels used, one bit per channel. Defaults
+            to all channels.
+
+    Returns:
+        int: The number of record bytes that fit, or 0.
+    """
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    header = _new_header(bands, slots, bits_per_channel, channel_mask)
+    total = size[0] * size[1] * bands
+    capacity = _stream_capacity(_stream_layout(header, bands), bands, total)
+    return max(0, capacity - _records_start(header)) // 8
+
+
+def is_container(img_path):
+    """
+    Checks whether an image holds a multi-record container.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The image; see
+            decode_img.
+
+    Returns:
+        bool: True if the image starts with a valid container header.
+    """
+    try:
+        read_header(img_path)
+    except ValueError:
+        return False
+    return True
+
+
+def embed_records(
+    pixels,
+    records,
+    slots=DEFAULT_SLOTS,
+    bits_per_channel=1,
+    channel_mask=None,
+    append=False,
+):
+    """
+    Embeds records into a pixel array in place, without encoding an image file.
+
+    Args:
+        pixels (numpy.ndarray): A writable, C-contiguous uint8 pixel array,
+            e.g. from load_pixels.
+        records (list[bytes]): The records to embed.
+        slots (int): The number of records the index of a new container can hold.
+        bits_per_channel (int): The number of low bits used per channel value
+            in a new container.
+        channel_mask (int): The channels a new container uses, one bit per
+            channel. Defaults to all.
+        append (bool): Whether to add the records to the container the pixels
+            already hold; its slots and embedding mode are used instead.
+
+    Raises:
+        ValueError: If the array cannot be written in place, the records do
+            not fit, the embedding mode is invalid or, when appending, the
+            pixels hold no container or its index is full.
+
+    Returns:
+        list[int]: The ids assigned to the records, in order.
+    """
+    pixels = _source(pixels)
+    if not (pixels.flags.c_contiguous and pixels.flags.writeable):
+        raise ValueError("Pixel arrays must be writable and C-contiguous.")
+    bands = _bands(pixels)
+    flat_pixels = pixels.ravel()
+    with span("steg.embed"):
+        if append:
+            header, index = _parse_index(flat_pixels, flat_pixels.size, bands)
+        else:
+            header = _new_header(bands, slots, bits_per_channel, channel_mask)
+            index = {}
+        return _write_container(flat_pixels, bands, header, index, records)
+
+
+def encode_records(
+    img_path,
+    records,
+    out_path,
+    slots=DEFAULT_SLOTS,
+    profile=None,
+    bits_per_channel=1,
+    channel_mask=None,
+):
+    """
+    Creates a multi-record container holding the given records in an image.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The carrier
+            image: a path, the file's contents, a binary file object or a
+            pixel array, which is left unchanged.
+        records (list[bytes]): The records to embed, e.g. from encryption.add_data.
+        out_path (str | file object): The path to save the encoded image, or
+            a writable binary file object to write it to.
+        slots (int): The number of records the index can hold.
+        profile (str | dict): The save profile; see SAVE_PROFILES.
+        bits_per_channel (int): The number of low bits used per channel value,
+            from 1 to MAX_BITS_PER_CHANNEL. More bits hold more data in fewer
+            pixels, at the cost of a more visible change.
+        channel_mask (int): The channels used, one bit per channel, e.g. 0b0111
+            to leave the alpha channel of an RGBA image alone past the
+            container header, which always uses the LSB of every value of
+            the leading pixels. Defaults to all.
+
+    Raises:
+        ValueError: If the records do not fit in the given image or the
+            embedding mode is invalid.
+
+    Returns:
+        list[int]: The ids assigned to the records, in order.
+    """
+    pixels = load_pixels(img_path)
+    ids = embed_records(pixels, records, slots, bits_per_channel, channel_mask)
+    save_pixels(pixels, out_path, profile)
+    return ids
+
+
+def _default_out(img_path, out_path):
+    """Default the output of an append to its input, which must then be a path."""
+    if out_path is not None:
+        return out_path
+    if not isinstance(img_path, (str, os.PathLike)):
+        raise ValueError("An output is needed when appending to an in-memory image.")
+    return img_path
+
+
+def append_records(img_path, records, out_path=None, profile=None):
+    """
+    Appends records to an existing multi-record container.
+
+    The records use the bits per channel and channel mask the container was
+    created with.
 
-    # Flattening the pixels array
-    flat_pixels = pixels.flatten()
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The image
+            holding the container; see encode_records.
+        records (list[bytes]): The records to append.
+        out_path (str | file object): Where to save the encoded image.
+            Defaults to img_path, which must then be a path.
+        profile (str | dict): The save profile; see SAVE_PROFILES.
 
-    # Extract the number of bits to decode
-    len_bits = [flat_pixels[i] & 1 for i in range(32)]
-    data_len = int("".join(map(str, len_bits)), 2)
+    Raises:
+        ValueError: If the image holds no container, its index is full or the
+            records do not fit.
+
+    Returns:
+        list[int]: The ids assigned to the new records, in order.
+    """
+    out_path = _default_out(img_path, out_path)
+    pixels = load_pixels(img_path)
+    ids = embed_records(pixels, records, append=True)
+    save_pixels(pixels, out_path, profile)
+    return ids
+
+
+def encode_stream(
+    img_path,
+    chunks,
+    out_path,
+    slots=DEFAULT_SLOTS,
+    profile=None,
+    bits_per_channel=1,
+    channel_mask=None,
+):
+    """
+    Creates a multi-record container holding one record streamed from chunks.
+
+    Only the carrier's pixels and one chunk at a time are held in memory.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The carrier
+            image; see encode_records.
+        chunks (Iterable[bytes]): The record contents, e.g. from
+            encryption.encrypt_stream.
+        out_path (str | file object): Where to save the encoded image.
+        slots (int): The number of records the index can hold.
+        profile (str | dict): The save profile; see SAVE_PROFILES.
+        bits_per_channel (int): The number of low bits used per channel value.
+        channel_mask (int): The channels used, one bit per channel. Defaults to all.
+
+    Raises:
+        ValueError: If the record does not fit in the given image or the
+            embedding mode is invalid.
+
+    Returns:
+        int: The id assigned to the record.
+    """
+    pixels = load_pixels(img_path)
+    bands = _bands(pixels)
+    header = _new_header(bands, slots, bits_per_channel, channel_mask)
+    with span("steg.embed"):
+        record_id = _write_stream(pixels.ravel(), bands, header, {}, chunks)
+    save_pixels(pixels, out_path, profile)
+    return record_id
+
+
+def append_stream(img_path, chunks, out_path=None, profile=None):
+    """
+    Appends one record streamed from chunks to an existing multi-record container.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The image
+            holding the container; see encode_records.
+        chunks (Iterable[bytes]): The record contents, in order.
+        out_path (str | file object): Where to save the encoded image.
+            Defaults to img_path, which must then be a path.
+        profile (str | dict): The save profile; see SAVE_PROFILES.
+
+    Raises:
+        ValueError: If the image holds no container, its index is full or the
+            record does not fit.
 
-    # Extracting the LSB from each pixel
-    data_bits = [flat_pixels[i] & 1 for i in range(32, data_len + 32)]
+    Returns:
+        int: The id assigned to the record.
+    """
+    out_path = _default_out(img_path, out_path)
+    pixels = load_pixels(img_path)
+    bands = _bands(pixels)
+    flat_pixels = pixels.ravel()
+    with span("steg.embed"):
+        header, index = _parse_index(flat_pixels, flat_pixels.size, bands)
+        record_id = _write_stream(flat_pixels, bands, header, index, chunks)
+    save_pixels(pixels, out_path, profile)
+    return record_id
+
+
+def _read_container(img_path):
+    """
+    Reads the header and index of a container, decoding only the rows they use.
+
+    Returns:
+        tuple: The header, the stream layout, the number of values per pixel
+            and the index.
+    """
+    total, bands = _image_shape(img_path)
+    header = _parse_container_header(
+        _read_values(img_path, CONTAINER_HEADER_V2.size * 8)
+    )
+    layout = _stream_layout(header, bands)
+    needed = _stream_values_needed(layout, bands, _records_start(header))
+    _, index = _parse_index(_read_values(img_path, needed), total, bands)
+    return header, layout, bands, index
+
+
+def read_header(img_path):
+    """
+    Reads the header of a multi-record container.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The image
+            holding the container: a path, the file's contents, a binary
+            file object or a pixel array, which is read without encoding.
+
+    Raises:
+        ValueError: If the image holds no valid container.
+
+    Returns:
+        ContainerHeader: The header, with the embedding mode its records use.
+    """
+    img_path = _source(img_path)
+    return _parse_container_header(_read_values(img_path, CONTAINER_HEADER_V2.size * 8))
+
+
+def container_space(img_path):
+    """
+    Computes how much more a multi-record container can take.
+
+    Only the rows holding the header and index are decoded.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The image
+            holding the container: a path, the file's contents, a binary
+            file object or a pixel array, which is read without encoding.
+
+    Raises:
+        ValueError: If the image holds no valid container.
+
+    Returns:
+        tuple[int, int]: The number of free record bytes and free index slots.
+    """
+    img_path = _source(img_path)
+    total, _ = _image_shape(img_path)
+    header, layout, bands, index = _read_container(img_path)
+    end = max((o + n for o, n in index.values()), default=_records_start(header))
+    free = max(0, _stream_capacity(layout, bands, total) - end) // 8
+    return free, header.slots - len(index)
+
+
+def read_index(img_path):
+    """
+    Reads the record index of a multi-record container.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The image
+            holding the container: a path, the file's contents, a binary
+            file object or a pixel array, which is read without encoding.
+
+    Raises:
+        ValueError: If the image holds no valid container.
+
+    Returns:
+        dict[int, tuple[int, int]]: A mapping of record id to (bit offset, bit length).
+    """
+    img_path = _source(img_path)
+    return _read_container(img_path)[3]
+
+
+def decode_record(img_path, record_id):
+    """
+    Decodes a single record from a multi-record container.
+
+    Only the leading rows up to the end of the requested record are decoded.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The image
+            holding the container; see decode_records.
+        record_id (int): The id of the record to decode.
+
+    Raises:
+        ValueError: If the image holds no valid container.
+        KeyError: If the container has no record with the given id.
+
+    Returns:
+        bytes: The decoded record.
+    """
+    return decode_records(img_path, [record_id])[0]
+
+
+def decode_records(img_path, record_ids):
+    """
+    Decodes several records from a multi-record container at once.
+
+    The leading rows up to the end of the last requested record are decoded
+    a single time for all of them.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The image
+            holding the container: a path, the file's contents, a binary
+            file object or a pixel array, which is read without encoding.
+        record_ids (list[int]): The ids of the records to decode.
+
+    Raises:
+        ValueError: If the image holds no valid container.
+        KeyError: If the container has no record with one of the given ids.
+
+    Returns:
+        list[bytes]: The decoded records, in the order of record_ids.
+    """
+    img_path = _source(img_path)
+    _, layout, bands, index = _read_container(img_path)
+    spans = [index[record_id] for record_id in record_ids]
+    end = max((offset + length for offset, length in spans), default=0)
+    flat_pixels = _read_values(img_path, _stream_values_needed(layout, bands, end))
+    return [
+        _stream_read(flat_pixels, layout, bands, offset, length)
+        for offset, length in spans
+    ]
+
+
+def decode_stream(img_path, record_id, piece_size=STREAM_PIECE):
+    """
+    Decodes a single record from a multi-record container piece by piece.
+
+    The leading rows up to the end of the record are decoded once; the record
+    bits are then unpacked `piece_size` bytes at a time.
+
+    Args:
+        img_path (str | bytes | file object | numpy.ndarray): The image
+            holding the container: a path, the file's contents, a binary
+            file object or a pixel array, which is read without encoding.
+        record_id (int): The id of the record to decode.
+        piece_size (int): The number of bytes yielded at a time.
+
+    Raises:
+        ValueError: If the image holds no valid container.
+        KeyError: If the container has no record with the given id.
+
+    Returns:
+        Iterator[bytes]: Consecutive pieces of the record.
+    """
+    img_path = _source(img_path)
+    _, layout, bands, index = _read_container(img_path)
+    offset, length = index[record_id]
+    needed = _stream_values_needed(layout, bands, offset + length)
+    flat_pixels = _read_values(img_path, needed)
+    return _stream_pieces(flat_pixels, layout, bands, offset, length, piece_size)
 
-    # Convert the bits to bytes
-    data = bytearray()
-    for i in range(0, len(data_bits), 8):
-        byte = data_bits[i : i + 8]
-        byte_str = "".join(map(str, byte))
-        data.append(int(byte_str, 2))
 
-    return bytes(data)
+def _stream_pieces(flat_pixels, layout, bands, offset, length, piece_size):
+    """Yield a range of stream bits as bytes, `piece_size` bytes at a time."""
+    end = offset + length
+    while offset < end:
+        count = min(piece_size * 8, end - offset)
+        yield _stream_read(flat_pixels, layout, bands, offset, count)
+        offset += count
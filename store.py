@@ -0,0 +1,183 @@
+import hashlib
+import os
+import shutil
+import stat
+import time
+
+from instrumentation import span
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+# Linux ioctl cloning the extents of one file into another (a reflink)
+FICLONE = 0x40049409
+HASH_PIECE = 1024 * 1024
+BLOB_EXT = ".png"
+# Seconds before an abandoned temporary file in the store is deleted
+TMP_GRACE = 3600
+
+
+def hash_file(path: str) -> str:
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for piece in iter(lambda: f.read(HASH_PIECE), b""):
+            digest.update(piece)
+    return digest.hexdigest()
+
+
+def blob_path(store_dir: str, digest: str) -> str:
+    """Return where the blob with a digest lives in a store."""
+    return os.path.join(store_dir, digest[:2], digest + BLOB_EXT)
+
+
+def _clone_or_copy(src: str, dst: str):
+    """Copy a file, sharing its extents with the source where the filesystem can."""
+    if fcntl is not None:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(src, dst)
+
+
+def _link_or_clone(src: str, dst: str):
+    """Hard link a file, or clone or copy it where hard links are not possible."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        _clone_or_copy(src, dst)
+
+
+def add_blob(store_dir: str, src_path: str, digest: str = None) -> str:
+    """
+    Adds a copy of a file to a content-addressed store, unless it is already there.
+
+    The copy is a reflink where the filesystem supports one. Blobs are made
+    read-only, so a program writing to one of their links in place fails
+    instead of changing every carrier that shares it.
+
+    Args:
+        store_dir (str): The root directory of the store.
+        src_path (str): The file to add. It is left untouched.
+        digest (str): The digest of the file, if already known.
+
+    Returns:
+        str: The path of the blob.
+    """
+    digest = digest or hash_file(src_path)
+    path = blob_path(store_dir, digest)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        _clone_or_copy(src_path, tmp_path)
+        # Name the blob after what was copied, in case the source changed since
+        copied = hash_file(tmp_path)
+        if copied != digest:
+            path = blob_path(store_dir, copied)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def link_blob(blob: str, dst_path: str):
+    """
+    Atomically puts a blob at a path, as a hard link where possible.
+
+    Falls back to a reflink or a copy on filesystems without hard links, or
+    when the store is on another filesystem.
+    """
+    tmp_path = dst_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    _link_or_clone(blob, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+def import_file(store_dir: str, src_path: str, dst_path: str, digest: str = None):
+    """
+    Adds a file to a store and links the blob to a destination path.
+
+    Returns:
+        str: The path of the blob.
+    """
+    while True:
+        blob = add_blob(store_dir, src_path, digest)
+        try:
+            link_blob(blob, dst_path)
+            return blob
+        except FileNotFoundError:
+            # Collected between adding and linking; add it again
+            if os.path.exists(blob):
+                raise
+
+
+def adopt_file(store_dir: str, path: str) -> int:
+    """
+    Replaces a file outside the store by a link to the blob with its contents.
+
+    A file whose contents are not in the store yet becomes the blob itself,
+    through a hard link, so nothing is copied.
+
+    Returns:
+        int: The number of bytes freed.
+    """
+    blob = blob_path(store_dir, hash_file(path))
+    if os.path.exists(blob):
+        if os.path.samefile(blob, path):
+            return 0
+        info = os.stat(path)
+        link_blob(blob, path)
+        # Other links to the old file keep its contents alive
+        return info.st_size if info.st_nlink == 1 else 0
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+        os.link(path, blob)
+    except OSError:
+        # Without hard links the store would only hold a second copy
+        return 0
+    os.chmod(blob, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    return 0
+
+
+def collect_garbage(store_dir: str):
+    """
+    Deletes the blobs no carrier links to any more, and abandoned temporary files.
+
+    The link count of a blob is its reference count: every carrier sharing
+    it is a hard link. Blobs that were copied rather than linked have no
+    links either; deleting them only gives up deduplication of future imports.
+
+    Returns:
+        tuple[int, int]: The number of files deleted and the bytes freed.
+    """
+    deleted = freed = 0
+    if not os.path.isdir(store_dir):
+        return deleted, freed
+    with span("store.collect_garbage"):
+        for dir_path, _, file_names in os.walk(store_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                info = os.stat(path)
+                if file_name.endswith(".tmp"):
+                    # Possibly a blob another process is still adding
+                    if time.time() - info.st_mtime < TMP_GRACE:
+                        continue
+                elif info.st_nlink > 1:
+                    continue
+                os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+                os.remove(path)
+                deleted += 1
+                freed += info.st_size
+    return deleted, freed
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# The modules live at the repository root, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# Cheap key derivation, so tests do not spend their time in the KDF
+FastKdf = {"kdf": "pbkdf2", "iterations": 1000}
+
+
+def make_carrier(path, size=(64, 64), mode="RGB", seed=0):
+    """Save a random carrier image."""
+    channels = {"RGB": 3, "RGBA": 4, "L": 1}[mode]
+    shape = (size[1], size[0], channels) if channels > 1 else (size[1], size[0])
+    pixels = np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+    Image.fromarray(pixels, mode).save(path)
+    return pixels
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Point main at an empty data directory with fast key derivation."""
+    monkeypatch.setattr(main, "UsrDataDir", str(tmp_path / "user_data"))
+    monkeypatch.setattr(main, "load_kdf_params", lambda: dict(FastKdf))
+    return tmp_path / "user_data"
+
+
+@pytest.fixture
+def user(data_dir):
+    """Register alice with one carrier image, holiday, and return her key."""
+    main.register_user("alice", "master")
+    key = main.login_user("alice", "master")
+    make_carrier(data_dir / "alice" / main.InputDir / "holiday.png")
+    yield key
+    main.close_user_vault("alice")
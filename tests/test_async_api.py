@@ -0,0 +1,40 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import encryption as enc
+import main
+from async_api import AsyncStegaPass
+
+
+def test_bad_record_does_not_fail_its_neighbours(user):
+    key = user
+    good = enc.add_data(*enc.encrypt_pwd("good-password", key))
+    bad = bytes(len(good))
+    img_out_path, (good_id, bad_id) = main.store_records(
+        "alice", "holiday", [good, bad]
+    )
+    main.user_vault("alice").set_many(
+        {
+            "good": {"image_path": img_out_path, "record": good_id},
+            "bad": {"image_path": img_out_path, "record": bad_id},
+            "missing": {"image_path": img_out_path, "record": 99},
+        }
+    )
+
+    async def get_all():
+        api = AsyncStegaPass(executor=ThreadPoolExecutor(2))
+        try:
+            return await asyncio.gather(
+                api.get_password("alice", "good", key),
+                api.get_password("alice", "bad", key),
+                api.get_password("alice", "missing", key),
+                return_exceptions=True,
+            )
+        finally:
+            api.executor.shutdown()
+
+    good_result, bad_result, missing_result = asyncio.run(get_all())
+    assert good_result == "good-password"
+    assert isinstance(bad_result, ValueError)
+    assert isinstance(missing_result, KeyError)
+    assert main.get_password("alice", "good", key) == "good-password"
@@ -0,0 +1,155 @@
+import io
+import json
+import os
+import tarfile
+
+import pytest
+
+import backup
+import main
+
+
+def write(root, path, data):
+    full_path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb") as f:
+        f.write(data)
+
+
+def read_tree(root):
+    tree = {}
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            with open(path, "rb") as f:
+                tree[os.path.relpath(path, root).replace(os.sep, "/")] = f.read()
+    return tree
+
+
+def test_incremental_chain_restores(tmp_path):
+    src = str(tmp_path / "src")
+    write(src, "a", b"one")
+    write(src, "dir/b", b"two")
+    write(src, "c", b"three")
+    paths = ["a", "dir/b", "c", "missing"]
+    full = str(tmp_path / "full.tar")
+    backup.backup_files(src, paths, full, info={"username": "alice"})
+
+    write(src, "a", b"one, changed")
+    os.remove(os.path.join(src, "c"))
+    incremental = str(tmp_path / "incremental.tar")
+    manifest = backup.backup_files(src, paths, incremental, full)
+
+    assert manifest["base"] == "full.tar"
+    assert {p: e["archive"] for p, e in manifest["files"].items()} == {
+        "a": "incremental.tar",
+        "dir/b": "full.tar",
+    }
+    with tarfile.open(incremental) as tar:
+        assert tar.getnames() == [backup.MANIFEST_NAME, "a"]
+
+    dst = str(tmp_path / "dst")
+    backup.restore_files(incremental, dst)
+    assert read_tree(dst) == {"a": b"one, changed", "dir/b": b"two"}
+    with pytest.raises(FileExistsError):
+        backup.restore_files(incremental, dst)
+
+
+def test_restore_needs_the_base_archive(tmp_path):
+    src = str(tmp_path / "src")
+    write(src, "a", b"one")
+    write(src, "b", b"two")
+    full = str(tmp_path / "full.tar")
+    backup.backup_files(src, ["a", "b"], full)
+    write(src, "a", b"changed")
+    incremental = str(tmp_path / "incremental.tar")
+    backup.backup_files(src, ["a", "b"], incremental, full)
+    os.remove(full)
+
+    with pytest.raises(FileNotFoundError):
+        backup.restore_files(incremental, str(tmp_path / "dst"))
+    assert not os.path.exists(tmp_path / "dst")
+
+
+def test_corrupt_archive_leaves_destination_alone(tmp_path):
+    src = str(tmp_path / "src")
+    write(src, "a", b"original contents")
+    archive = str(tmp_path / "full.tar")
+    backup.backup_files(src, ["a"], archive)
+    with open(archive, "r+b") as f:
+        data = f.read()
+        f.seek(data.index(b"original contents"))
+        f.write(b"tampered")
+    dst = str(tmp_path / "dst")
+    write(dst, "kept", b"existing")
+
+    with pytest.raises(ValueError, match="corrupt"):
+        backup.restore_files(archive, dst, replace=True)
+    assert read_tree(dst) == {"kept": b"existing"}
+    assert sorted(os.listdir(tmp_path)) == ["dst", "full.tar", "src"]
+
+
+def test_replace_keeps_uncovered_paths(tmp_path):
+    src = str(tmp_path / "src")
+    write(src, "a", b"backed up")
+    archive = str(tmp_path / "alice-tuesday.tar")
+    backup.backup_files(src, ["a"], archive)
+    dst = str(tmp_path / "alice")
+    write(dst, "a", b"newer")
+    write(dst, "carriers/photo.png", b"carrier")
+
+    backup.restore_files(archive, dst, replace=True, keep=("carriers",))
+
+    assert read_tree(dst) == {"a": b"backed up", "carriers/photo.png": b"carrier"}
+    assert sorted(os.listdir(tmp_path)) == ["alice", "alice-tuesday.tar", "src"]
+
+
+def test_unsafe_paths_are_refused(tmp_path):
+    manifest = {
+        "version": backup.FORMAT_VERSION,
+        "created": "",
+        "base": None,
+        "info": {},
+        "files": {
+            "../escape": {"sha256": "", "size": 0, "mtime_ns": 0, "archive": "x.tar"}
+        },
+    }
+    archive = str(tmp_path / "x.tar")
+    data = json.dumps(manifest).encode("utf8")
+    with tarfile.open(archive, "w") as tar:
+        info = tarfile.TarInfo(backup.MANIFEST_NAME)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    with pytest.raises(ValueError, match="Refusing"):
+        backup.restore_files(archive, str(tmp_path / "dst"))
+
+
+def test_backup_and_restore_user(user, data_dir, tmp_path):
+    key = user
+    main.add_password("alice", "github", "pw1", key, "holiday")
+    full = str(tmp_path / "alice-monday.tar")
+    main.backup_user("alice", full)
+    main.add_password("alice", "gmail", "pw2", key, "holiday")
+    incremental = str(tmp_path / "alice-tuesday.tar")
+    main.backup_user("alice", incremental, full)
+
+    main.add_password("alice", "later", "pw3", key, "holiday")
+    assert main.restore_user(incremental, replace=True) == "alice"
+
+    assert main.get_password("alice", "github", key) == "pw1"
+    assert main.get_password("alice", "gmail", key) == "pw2"
+    assert main.get_password("alice", "later", key) is None
+    assert os.path.exists(data_dir / "alice" / main.InputDir / "holiday.png")
+
+
+def test_restore_refuses_invalid_user_names(data_dir, tmp_path):
+    src = str(tmp_path / "src")
+    write(src, main.UsrDataFile, b"{}")
+    for username in ["../../evil", ".images", ""]:
+        archive = str(tmp_path / "evil.tar")
+        backup.backup_files(
+            src, [main.UsrDataFile], archive, info={"username": username}
+        )
+        assert main.restore_user(archive, replace=True) is None
+    assert not os.path.exists(tmp_path / "evil")
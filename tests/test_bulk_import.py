@@ -0,0 +1,35 @@
+import main
+from conftest import make_carrier
+
+
+def test_entries_without_image_spread_over_carriers(user, data_dir):
+    key = user
+    for seed, name in enumerate(["beach", "city", "forest"], 1):
+        make_carrier(data_dir / "alice" / main.InputDir / f"{name}.png", seed=seed)
+    entries = [{"name": f"site{i}", "password": f"pw{i}"} for i in range(12)]
+    entries.append({"service": "named", "password": "pw", "image": "holiday"})
+
+    added, failures = main.add_passwords_bulk("alice", entries, key, workers=3)
+
+    assert (added, failures) == (13, [])
+    services = main.user_vault("alice").services
+    auto_images = {services[f"site{i}"]["image_path"] for i in range(12)}
+    assert len(auto_images) == 3
+    for i in range(12):
+        assert main.get_password("alice", f"site{i}", key) == f"pw{i}"
+    assert main.get_password("alice", "named", key) == "pw"
+
+
+def test_entries_that_fit_nowhere_fail_alone(user, data_dir):
+    key = user
+    entries = [
+        {"service": "small", "password": "pw"},
+        {"service": "huge", "password": "x" * 100_000},
+        {"service": "", "password": "pw"},
+    ]
+
+    added, failures = main.add_passwords_bulk("alice", entries, key, workers=1)
+
+    assert added == 1
+    assert sorted(service for service, _ in failures) == ["?", "huge"]
+    assert main.get_password("alice", "small", key) == "pw"
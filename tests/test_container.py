@@ -0,0 +1,128 @@
+import struct
+
+import numpy as np
+import pytest
+
+import encryption as enc
+import main
+import steganography as steg
+from conftest import make_carrier
+
+
+def write_lsb(pixels, data):
+    """Write bytes into the LSB of the leading pixel values, most significant bit first."""
+    flat = pixels.reshape(-1)
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    flat[: bits.size] = (flat[: bits.size] & 254) | bits
+    return pixels
+
+
+def test_records_round_trip(tmp_path):
+    img_path = str(tmp_path / "carrier.png")
+    out_path = str(tmp_path / "stego.png")
+    make_carrier(img_path)
+    records = [b"first", b"", bytes(range(256)), b"x" * 300]
+
+    ids = steg.encode_records(img_path, records, out_path, slots=8)
+
+    assert ids == [0, 1, 2, 3]
+    assert steg.is_container(out_path)
+    assert not steg.is_container(img_path)
+    header = steg.read_header(out_path)
+    assert (header.version, header.slots, header.count) == (2, 8, 4)
+    assert steg.decode_records(out_path, ids) == records
+    assert steg.decode_record(out_path, 2) == records[2]
+
+
+def test_append_keeps_existing_records(tmp_path):
+    img_path = str(tmp_path / "carrier.png")
+    out_path = str(tmp_path / "stego.png")
+    make_carrier(img_path)
+    steg.encode_records(img_path, [b"one", b"two"], out_path, slots=3)
+    free_before, slots_before = steg.container_space(out_path)
+
+    assert steg.append_records(out_path, [b"three"]) == [2]
+
+    assert steg.decode_records(out_path, [0, 1, 2]) == [b"one", b"two", b"three"]
+    assert steg.container_space(out_path) == (free_before - 5, slots_before - 1)
+    with pytest.raises(ValueError, match="index is full"):
+        steg.append_records(out_path, [b"four"])
+
+
+def test_records_that_do_not_fit(tmp_path):
+    img_path = str(tmp_path / "carrier.png")
+    make_carrier(img_path, size=(16, 16))
+    capacity = steg.container_capacity((16, 16), "RGB", slots=2)
+    out_path = str(tmp_path / "stego.png")
+
+    steg.encode_records(img_path, [bytes(capacity)], out_path, slots=2)
+    with pytest.raises(ValueError, match="too large"):
+        steg.encode_records(img_path, [bytes(capacity + 1)], out_path, slots=2)
+
+
+def test_missing_record_and_corrupt_index(tmp_path):
+    img_path = str(tmp_path / "carrier.png")
+    out_path = str(tmp_path / "stego.png")
+    make_carrier(img_path)
+    steg.encode_records(img_path, [b"only"], out_path)
+    with pytest.raises(KeyError):
+        steg.decode_record(out_path, 5)
+
+    # An index entry pointing past the end of the image
+    pixels = steg.load_pixels(out_path)
+    header = steg.read_header(out_path)
+    layout = steg._stream_layout(header, 3)
+    steg._stream_write(
+        pixels.reshape(-1), layout, 3, 0, steg.INDEX_ENTRY.pack(0, 2**31, 8)
+    )
+    with pytest.raises(ValueError, match="corrupt"):
+        steg.read_index(pixels)
+
+
+def test_decodes_version_1_containers(tmp_path):
+    # Version 1 as first written: header, a fixed index and the records, all
+    # in the LSB of every pixel value from the first one
+    slots = 4
+    records = [b"alpha", b"beta"]
+    start = (8 + slots * 12) * 8
+    offsets = [start, start + len(records[0]) * 8]
+    index = b"".join(
+        struct.pack(">III", i, offset, len(record) * 8)
+        for i, (offset, record) in enumerate(zip(offsets, records))
+    )
+    stream = struct.pack(">3sBHH", b"SGP", 1, slots, len(records)) + index
+    stream += bytes(slots * 12 - len(index)) + b"".join(records)
+    img_path = str(tmp_path / "v1.png")
+    pixels = make_carrier(img_path)
+    steg.save_pixels(write_lsb(pixels, stream), img_path)
+
+    assert steg.read_header(img_path).version == 1
+    assert steg.decode_records(img_path, [0, 1]) == records
+
+    # Appending keeps the version 1 layout
+    assert steg.append_records(img_path, [b"gamma"]) == [2]
+    assert steg.read_header(img_path).version == 1
+    assert steg.decode_records(img_path, [0, 1, 2]) == records + [b"gamma"]
+
+
+def test_decodes_baseline_single_secret_images(tmp_path):
+    data = b"legacy ciphertext"
+    img_path = str(tmp_path / "legacy.png")
+    pixels = make_carrier(img_path)
+    header = (len(data) * 8).to_bytes(4, "big")
+    steg.save_pixels(write_lsb(pixels, header + data), img_path)
+
+    assert steg.decode_img(img_path) == data
+    assert not steg.is_container(img_path)
+
+
+def test_baseline_vault_still_decodes(user, data_dir):
+    key = user
+    encrypted = enc.add_data(*enc.encrypt_pwd("hunter2", key))
+    img_path = str(data_dir / "alice" / main.OutputDir / "gmail.png")
+    pixels = make_carrier(img_path)
+    header = (len(encrypted) * 8).to_bytes(4, "big")
+    steg.save_pixels(write_lsb(pixels, header + encrypted), img_path)
+    main.save_user_data("alice", {"alice": {"gmail": {"image_path": img_path}}})
+
+    assert main.get_password("alice", "gmail", key) == "hunter2"
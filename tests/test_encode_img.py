@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import steganography as steg
+
+
+def baseline_encode(pixels, data):
+    """The original per-bit encode_img loop, returning the embedded pixels."""
+    flat_pixels = pixels.flatten()
+    bin_data = "".join([format(byte, "08b") for byte in data])
+    data_len = len(bin_data)
+    if data_len + 32 > len(flat_pixels):
+        raise ValueError("Data is too large to fit in the given image.")
+    bin_data_len = bin(data_len)[2:].rjust(32, "0")
+    for i in range(32):
+        flat_pixels[i] = (flat_pixels[i] & 254) | int(bin_data_len[i])
+    for i in range(32, data_len + 32):
+        flat_pixels[i] = (flat_pixels[i] & 254) | int(bin_data[i - 32])
+    return flat_pixels.reshape(pixels.shape)
+
+
+@pytest.mark.parametrize("mode, channels", [("RGB", 3), ("RGBA", 4), ("L", 1)])
+@pytest.mark.parametrize("size", [0, 1, 7, 100, 500])
+def test_encode_img_matches_baseline(tmp_path, mode, channels, size):
+    rng = np.random.default_rng(size)
+    shape = (64, 64, channels) if channels > 1 else (64, 64)
+    pixels = rng.integers(0, 256, shape, dtype=np.uint8)
+    img_path = str(tmp_path / "carrier.png")
+    out_path = str(tmp_path / "stego.png")
+    Image.fromarray(pixels, mode).save(img_path)
+    data = rng.bytes(size)
+
+    steg.encode_img(img_path, data, out_path)
+
+    expected = baseline_encode(pixels.copy(), data)
+    assert np.array_equal(np.array(Image.open(out_path)), expected)
+    assert steg.decode_img(out_path) == data
+
+
+def test_encode_img_too_large(tmp_path):
+    img_path = str(tmp_path / "carrier.png")
+    Image.new("L", (8, 8)).save(img_path)
+    with pytest.raises(ValueError):
+        steg.encode_img(img_path, bytes(8), str(tmp_path / "stego.png"))
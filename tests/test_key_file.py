@@ -0,0 +1,79 @@
+import base64
+import os
+
+import pytest
+from Cryptodome.Protocol.KDF import PBKDF2
+
+import encryption as enc
+import main
+import steganography as steg
+from conftest import FastKdf, make_carrier
+
+Scrypt = {"kdf": "scrypt", "n": 2**10, "r": 8, "p": 1}
+
+
+def baseline_key_file(password):
+    """A key file as the original gen_key wrote it: base64 of salt and PBKDF2 key."""
+    salt = os.urandom(enc.SALT_SIZE)
+    key = PBKDF2(password, salt, dkLen=enc.KEY_SIZE, count=enc.ITERATIONS)
+    return base64.b64encode(salt + key), key
+
+
+@pytest.mark.parametrize("params", [FastKdf, Scrypt])
+def test_key_file_round_trip(params):
+    data_key = os.urandom(enc.KEY_SIZE)
+    stored_key = enc.gen_key("master", params, data_key)
+
+    assert stored_key.startswith(enc.KEY_FILE_PREFIX)
+    assert enc.key_params(stored_key) == params
+    assert enc.unlock_key("master", stored_key) == data_key
+    assert enc.unlock_key("wrong", stored_key) is None
+    assert not enc.needs_rehash(stored_key, params)
+
+
+def test_key_file_header_is_authenticated():
+    stored_key = enc.gen_key("master", {"kdf": "pbkdf2", "iterations": 1000})
+    tampered = stored_key.replace(b"iterations=1000", b"iterations=1001")
+
+    assert enc.unlock_key("master", tampered) is None
+
+
+def test_kdf_params_format():
+    text = enc.format_kdf_params(Scrypt)
+    assert text == "scrypt$n=1024,p=1,r=8"
+    assert enc.parse_kdf_params(text) == Scrypt
+    with pytest.raises(ValueError):
+        enc.parse_kdf_params("md5$rounds=1")
+
+
+def test_baseline_key_file_unlocks():
+    stored_key, key = baseline_key_file("master")
+
+    assert enc.key_params(stored_key) == enc.DEFAULT_KDF
+    assert enc.unlock_key("master", stored_key) == key
+    assert enc.unlock_key("wrong", stored_key) is None
+    assert enc.extract_key(stored_key) == key
+    assert enc.needs_rehash(stored_key, enc.DEFAULT_KDF)
+
+
+def test_login_rehashes_baseline_user_and_keeps_their_data(data_dir):
+    user_dir = data_dir / "alice"
+    os.makedirs(user_dir / main.OutputDir)
+    stored_key, key = baseline_key_file("master")
+    (user_dir / "encryption_key.bin").write_bytes(stored_key)
+    img_path = str(user_dir / main.OutputDir / "gmail.png")
+    make_carrier(str(data_dir / "carrier.png"))
+    steg.encode_img(
+        str(data_dir / "carrier.png"),
+        enc.add_data(*enc.encrypt_pwd("hunter2", key)),
+        img_path,
+    )
+    main.save_user_data("alice", {"alice": {"gmail": {"image_path": img_path}}})
+
+    assert main.login_user("alice", "master") == key
+    rehashed = (user_dir / "encryption_key.bin").read_bytes()
+    assert enc.key_params(rehashed) == FastKdf
+    assert main.login_user("alice", "master") == key
+    assert main.login_user("alice", "wrong") is None
+    assert main.get_password("alice", "gmail", key) == "hunter2"
+    main.close_user_vault("alice")
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+import steganography as steg
+from conftest import make_carrier
+
+
+@pytest.mark.parametrize("bits", range(1, steg.MAX_BITS_PER_CHANNEL + 1))
+@pytest.mark.parametrize(
+    "mode, mask", [("RGB", None), ("RGBA", 0b0111), ("L", None), ("RGB", 0b101)]
+)
+def test_multi_bit_round_trip(tmp_path, bits, mode, mask):
+    img_path = str(tmp_path / "carrier.png")
+    out_path = str(tmp_path / "stego.png")
+    carrier = make_carrier(img_path, mode=mode)
+    records = [bytes(range(200)), b"second", b"\xff" * 33]
+
+    ids = steg.encode_records(
+        img_path, records, out_path, slots=4, bits_per_channel=bits, channel_mask=mask
+    )
+
+    header = steg.read_header(out_path)
+    assert (header.version, header.bits_per_channel) == (2, bits)
+    assert steg.decode_records(out_path, ids) == records
+    stego = steg.load_pixels(out_path).astype(int)
+    # Only the low bits change
+    assert np.all(np.abs(stego - carrier) < 1 << bits)
+    if mode == "RGBA":
+        # The header uses every channel of the leading pixels
+        first = steg._stream_layout(header, 4)[0] // 4
+        alpha = stego[..., 3].reshape(-1)[first:]
+        assert np.array_equal(alpha, carrier[..., 3].reshape(-1)[first:])
+
+    assert steg.append_records(out_path, [b"appended"]) == [3]
+    assert steg.read_header(out_path).bits_per_channel == bits
+    assert steg.decode_records(out_path, [0, 3]) == [records[0], b"appended"]
+
+
+def test_capacity_grows_with_bits():
+    capacities = [
+        steg.container_capacity((64, 64), "RGB", bits_per_channel=bits)
+        for bits in range(1, steg.MAX_BITS_PER_CHANNEL + 1)
+    ]
+    assert capacities == sorted(capacities)
+    assert capacities[1] > 1.9 * capacities[0]
+
+
+@pytest.mark.parametrize("bits, mask", [(0, None), (5, None), (1, 0), (1, 0b1000)])
+def test_invalid_embedding_modes(tmp_path, bits, mask):
+    img_path = str(tmp_path / "carrier.png")
+    make_carrier(img_path)
+    with pytest.raises(ValueError):
+        steg.encode_records(
+            img_path,
+            [b"x"],
+            str(tmp_path / "stego.png"),
+            bits_per_channel=bits,
+            channel_mask=mask,
+        )
+
+
+def test_corrupt_mode_in_header(tmp_path):
+    img_path = str(tmp_path / "carrier.png")
+    out_path = str(tmp_path / "stego.png")
+    make_carrier(img_path)
+    steg.encode_records(img_path, [b"x"], out_path, bits_per_channel=2)
+    pixels = steg.load_pixels(out_path)
+    header = steg.read_header(out_path)._replace(bits_per_channel=7)
+    steg._embed_bits(pixels.reshape(-1), steg._to_bits(steg._pack_header(header)))
+
+    with pytest.raises(ValueError, match="corrupt"):
+        steg.read_header(pixels)
+    assert not steg.is_container(pixels)
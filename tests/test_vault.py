@@ -0,0 +1,59 @@
+import json
+
+import vault as vlt
+
+
+def test_compact_keeps_other_instances_changes(tmp_path):
+    path = str(tmp_path / "services.json")
+    a = vlt.Vault(path, "alice")
+    b = vlt.Vault(path, "alice")
+    b.set_many({f"s{i}": {"image_path": f"img{i}.png"} for i in range(50)})
+    a.set("gui-added", {"image_path": "gui.png"})
+    a.compact()
+
+    with open(path) as f:
+        services = json.load(f)["alice"]
+    assert len(services) == 51
+    assert "gui-added" in services and "s49" in services
+    b.set("later", {"image_path": "later.png"})
+    assert len(vlt.Vault(path, "alice")) == 52
+
+
+def test_refresh_after_other_instance_compacts(tmp_path):
+    path = str(tmp_path / "services.json")
+    a = vlt.Vault(path, "alice")
+    b = vlt.Vault(path, "alice")
+    a.set("one", {"image_path": "one.png"})
+    b.set("two", {"image_path": "two.png"})
+    b.compact()
+    a.set("three", {"image_path": "three.png"})
+    a.compact()
+    b.refresh()
+    assert sorted(b.services) == ["one", "three", "two"]
+    assert b.search.search("th") == ["three"]
+
+
+def test_journal_replay_drops_torn_line(tmp_path):
+    path = str(tmp_path / "services.json")
+    a = vlt.Vault(path, "alice")
+    a.set("one", {"image_path": "one.png"})
+    a.set("two", {"image_path": "two.png"})
+    with open(path + vlt.JournalSuffix, "ab") as f:
+        f.write(b'{"op": "set", "service": "torn"')
+
+    b = vlt.Vault(path, "alice")
+    assert sorted(b.services) == ["one", "two"]
+    b.set("three", {"image_path": "three.png"})
+    assert sorted(vlt.Vault(path, "alice").services) == ["one", "three", "two"]
+
+
+def test_compaction_every_n_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(vlt, "CompactEvery", 3)
+    path = str(tmp_path / "services.json")
+    a = vlt.Vault(path, "alice")
+    for i in range(4):
+        a.set(f"s{i}", {"image_path": f"{i}.png"})
+    a.delete("s0")
+    with open(path) as f:
+        assert sorted(json.load(f)["alice"]) == ["s0", "s1", "s2"]
+    assert sorted(vlt.Vault(path, "alice").services) == ["s1", "s2", "s3"]
@@ -0,0 +1,256 @@
+import contextlib
+import json
+import os
+import threading
+
+from instrumentation import span
+from search import ServiceIndex
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+JournalSuffix = ".journal"
+CompactEvery = 100
+
+_open_vaults = {}
+
+
+class Vault:
+    """
+    In-memory index of a user's services, persisted through an append-only journal.
+
+    The snapshot file keeps the services.json layout ({username: {service: data}}).
+    Changes are appended to a journal next to it as one JSON line per change and
+    folded back into the snapshot by an atomic rename every CompactEvery changes.
+    A search index over the service names is kept in step with every change.
+
+    Several processes may open the same vault, e.g. the GUI and a CLI import.
+    Appends and compactions hold an exclusive flock on the journal and first
+    catch up on what other processes wrote, so none of their changes is lost.
+    """
+
+    def __init__(self, path: str, username: str):
+        """
+        Loads the snapshot and replays the journal.
+
+        Args:
+            path (str): The path to the services.json snapshot.
+            username (str): The user the services belong to.
+        """
+        self.path = path
+        self.username = username
+        self.journal_path = path + JournalSuffix
+        self.services = {}
+        self.search = ServiceIndex()
+        self.journal_len = 0
+        # What was read so far: the snapshot's identity and the journal's length
+        self.snapshot_stat = None
+        self.journal_offset = 0
+        self.thread_lock = threading.RLock()
+        self.lock_depth = 0
+        with self._locked():
+            self._load()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the vault against other threads, and processes where flock exists."""
+        with self.thread_lock:
+            if (
+                self.lock_depth
+                or fcntl is None
+                or not os.path.isdir(os.path.dirname(self.path) or ".")
+            ):
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                return
+            # flock conflicts between open files even within one process, so
+            # a nested hold must not open the journal again
+            with open(self.journal_path, "ab") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+
+    def _snapshot_stat(self):
+        """Return what identifies the current snapshot file, or None if there is none."""
+        try:
+            info = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (info.st_ino, info.st_size, info.st_mtime_ns)
+
+    def _load(self):
+        """Read the snapshot, then apply every complete journal line on top of it."""
+        self.services = {}
+        self.journal_len = 0
+        self.journal_offset = 0
+        self.snapshot_stat = self._snapshot_stat()
+        if self.snapshot_stat is not None:
+            with open(self.path, "r") as f:
+                self.services = json.load(f).get(self.username, {})
+        self.search = ServiceIndex(self.services)
+        self._replay()
+
+    def _replay(self):
+        """Apply the complete journal lines past what was already read."""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb") as f:
+            f.seek(self.journal_offset)
+            journal = f.read()
+        good_len = 0
+        for line in journal.split(b"\n")[:-1]:
+            try:
+                change = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            self._apply(change)
+            self.journal_len += 1
+            good_len += len(line) + 1
+        self.journal_offset += good_len
+        # A crash mid-append leaves a torn last line; drop it so that
+        # later appends start on a line of their own. Appends hold the
+        # lock too, so this is never a line still being written.
+        if good_len < len(journal):
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(self.journal_offset)
+
+    def _refresh(self):
+        """Catch up on changes other processes made; the caller holds the lock."""
+        try:
+            journal_size = os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            journal_size = 0
+        # A new snapshot or a shorter journal means another process compacted
+        if (
+            self._snapshot_stat() != self.snapshot_stat
+            or journal_size < self.journal_offset
+        ):
+            self._load()
+        elif journal_size > self.journal_offset:
+            self._replay()
+
+    def refresh(self):
+        """Pick up the changes other processes made since the vault was last read."""
+        with self._locked():
+            self._refresh()
+
+    def _apply(self, change: dict):
+        """Apply a single journal change to the in-memory index."""
+        if change["op"] == "set":
+            self.services[change["service"]] = change["data"]
+            self.search.add(change["service"])
+        elif change["op"] == "del":
+            self.services.pop(change["service"], None)
+            self.search.remove(change["service"])
+
+    def _append(self, changes: list):
+        """Apply changes and append them to the journal in one durable write."""
+        lines = "".join(json.dumps(change) + "\n" for change in changes)
+        data = lines.encode("utf8")
+        with self._locked():
+            self._refresh()
+            for change in changes:
+                self._apply(change)
+            with span("vault.journal"), open(self.journal_path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_len += len(changes)
+            self.journal_offset += len(data)
+            if self.journal_len >= CompactEvery:
+                self._compact()
+
+    def get(self, service: str):
+        """Return the stored data for a service, or None if it does not exist."""
+        return self.services.get(service)
+
+    def __contains__(self, service: str):
+        return service in self.services
+
+    def __len__(self):
+        return len(self.services)
+
+    def set(self, service: str, data: dict):
+        """Add or replace a service."""
+        self._append([{"op": "set", "service": service, "data": data}])
+
+    def set_many(self, services: dict):
+        """Add or replace several services with a single journal write."""
+        if services:
+            self._append(
+                [
+                    {"op": "set", "service": service, "data": data}
+                    for service, data in services.items()
+                ]
+            )
+
+    def delete(self, service: str):
+        """Remove a service if it exists."""
+        with self._locked():
+            self._refresh()
+            if service in self.services:
+                self._append([{"op": "del", "service": service}])
+
+    def replace(self, services: dict):
+        """Replace every service and write a fresh snapshot."""
+        with self._locked():
+            self.services = dict(services)
+            self.search = ServiceIndex(self.services)
+            self._compact()
+
+    def compact(self):
+        """Write the snapshot, including other processes' changes, and empty the journal."""
+        with self._locked():
+            self._refresh()
+            self._compact()
+
+    def _compact(self):
+        """Write the snapshot and truncate the journal; the caller holds the lock."""
+        tmp_path = self.path + ".tmp"
+        with span("vault.compact"), open(tmp_path, "w") as f:
+            json.dump({self.username: self.services}, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # Replaying a journal over a newer snapshot is harmless, so a crash
+        # before this truncation loses nothing
+        with open(self.journal_path, "w"):
+            pass
+        self.snapshot_stat = self._snapshot_stat()
+        self.journal_len = 0
+        self.journal_offset = 0
+
+
+def open_vault(path: str, username: str) -> Vault:
+    """
+    Return the session's vault for a snapshot path, loading it on first use.
+
+    Args:
+        path (str): The path to the services.json snapshot.
+        username (str): The user the services belong to.
+
+    Returns:
+        Vault: The loaded vault, shared by every caller in this process and
+            caught up with the changes other processes made.
+    """
+    vault = _open_vaults.get(path)
+    if vault is None:
+        vault = _open_vaults[path] = Vault(path, username)
+    else:
+        vault.refresh()
+    return vault
+
+
+def close_vault(path: str):
+    """Compact and forget the vault for a snapshot path, if it is open."""
+    vault = _open_vaults.pop(path, None)
+    if vault is not None and vault.journal_len:
+        vault.compact()